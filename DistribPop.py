@@ -3,30 +3,45 @@ DistribPop
 Created by: Kirsten R. Hazler
 Created on: 2018-10-03
 Version:  ArcGIS Pro / Python 3.x
-Last Edit: 2021-05-18
+Last Edit: 2026-10-17
 
 Summary:
 Distributes population from census blocks or block groups to pixels assumed to be actually occupied, based on land
 cover or road density. Yields a raster representing persons per pixel.
 
 Usage:
+Rasters are processed by window (see rasterBlocks), so peak memory is bounded by the window size
+(rasterBlocks.tile_size), not the extent of the rasters.
 IMPORTANT NOTE: If blocks or other census units are clipped to a processing boundary, the population for the
 remaining polygon fragments MUST be adjusted prior to running a population distribution function. Example:
 If clipping results in 40% of a polygon's area remaining, the population value should be adjusted to 40% of
-the original value.
+the original value. Use clipPopulation to clip units and add the adjusted population fields (e.g. `total_pop_clip`)
+in one step, and use an adjusted field as fldPop. clipPopulation requires the original (unclipped) census units, with
+the raw population field. main uses units which already have `total_pop_clip` as is; other units are clipped by
+clipPopulation, and must have the raw ACS total population in `total_pop`.
 """
 
 # Import Helper module and functions
 from Helper import *
+import concurrent.futures
+import itertools
+import numpy
+import rasterBlocks
 
 
-def MergeCensusBlocks(blockShpDir, outBlocks, boundary, VABlocks="tl_2020_51_tabblock20.shp"):
+def MergeCensusBlocks(blockShpDir, outBlocks, boundary, VABlocks="tl_2020_51_tabblock20.shp", workers=None,
+                      chunk=50000):
    """
-   Merge block shapefiles from multiple states into a new feature class, subset to a given boundary.
+   Merge block shapefiles from multiple states into a new feature class, subset to a given boundary. Each state
+   shapefile is read in chunks: records are first discarded by bounding box against a coarse grid index of the
+   boundary, and the remaining records are tested for exact intersection. States are read in parallel, and all blocks
+   are written to outBlocks with a single insert cursor.
    :param blockShpDir: Directory holding individual state shapefiles with census blocks
    :param outBlocks: output blocks feature class
    :param boundary: polygon boundary; blocks intersecting this will be included in outBlocks
-   :param VABlocks: name of the shapefile for Virginia blocks
+   :param VABlocks: name of the shapefile for Virginia blocks. Its fields and coordinate system are used for outBlocks.
+   :param workers: Number of parallel processes. Default is one per processor.
+   :param chunk: Number of records read at a time
    :return: outBlocks
 
    Pre-requisite: state-level block shapefiles (with population attribute) downloaded from U.S. Census:
@@ -35,20 +50,172 @@ def MergeCensusBlocks(blockShpDir, outBlocks, boundary, VABlocks="tl_2020_51_tab
    # Get list of shapefiles
    inFC = blockShpDir + os.sep + VABlocks
    with arcpy.EnvManager(workspace=blockShpDir):
-      appendFC = [blockShpDir + os.sep + a for a in arcpy.ListFeatureClasses() if a != os.path.basename(inFC)]
-   with arcpy.EnvManager(extent=boundary):
-      if not arcpy.Exists(outBlocks):
-         print('Creating merged feature class...')
-         arcpy.FeatureClassToFeatureClass_conversion(inFC, os.path.dirname(outBlocks), os.path.basename(outBlocks))
-         for i in appendFC:
-            print('Appending ' + i + '...')
-            lyr = arcpy.MakeFeatureLayer_management(i)
-            arcpy.SelectLayerByLocation_management(lyr, "INTERSECT", boundary)
-            arcpy.Append_management(lyr, outBlocks, "NO_TEST")
+      stateFC = [inFC] + [blockShpDir + os.sep + a for a in arcpy.ListFeatureClasses() if a != os.path.basename(inFC)]
+   if not arcpy.Exists(outBlocks):
+      print('Creating merged feature class...')
+      sr = arcpy.Describe(inFC).spatialReference
+      arcpy.CreateFeatureclass_management(os.path.dirname(outBlocks), os.path.basename(outBlocks), "POLYGON", inFC,
+                                          spatial_reference=sr)
+      fields = [f.name for f in arcpy.ListFields(outBlocks) if f.type not in ['OID', 'Geometry'] and f.editable]
+      tasks = [(fc, boundary, sr.exportToString(), fields, chunk) for fc in stateFC]
+      with arcpy.da.InsertCursor(outBlocks, ['SHAPE@WKB'] + fields) as curs:
+         with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            for fc, n, rows in pool.map(_mergeState, tasks):
+               print('Appending ' + str(len(rows)) + ' of ' + str(n) + ' blocks from ' + fc + '...')
+               for row in rows:
+                  curs.insertRow(row)
    return outBlocks
 
 
-def DistribPop_nlcd(inBlocks, fldPop, inLandCover, inImpervious, inRoads, outPop, tmpDir):
+def _boundaryIndex(wkbs, size=512):
+   '''
+   Coarse grid index of a boundary, for discarding records by bounding box. Grid cells are marked if they are inside
+   the boundary or within one cell of its edges, so any geometry intersecting the boundary has a bounding box
+   overlapping a marked cell.
+   :param wkbs: List of boundary polygons, as WKB
+   :param size: Number of grid cells along the longer side of the boundary's extent
+   :return: tuple of (grid dictionary, summed-area table of marked cells)
+   '''
+   rings = [r for w in wkbs for r in rasterBlocks.wkbRings(w)]
+   xy = numpy.concatenate(rings)
+   (x0, y0), (x1, y1) = xy.min(axis=0), xy.max(axis=0)
+   cell = max(x1 - x0, y1 - y0, 1e-9) / size
+   # One cell of padding on all sides
+   grid = {'xmin': x0 - cell, 'ymax': y1 + cell, 'cell': cell, 'nrows': int((y1 - y0) / cell) + 3,
+           'ncols': int((x1 - x0) / cell) + 3, 'sr': None}
+   inside = numpy.zeros((grid['nrows'], grid['ncols']), dtype=bool)
+   r, c, n = rasterBlocks.polygonCells(rings, grid, 2)
+   inside[r, c] = True
+   # Cells along edges, from points at half-cell spacing, expanded by one cell
+   edge = numpy.zeros(inside.shape, dtype=bool)
+   for ring in rings:
+      d = numpy.hypot(*numpy.diff(ring, axis=0).T)
+      n = numpy.maximum(numpy.ceil(d / (cell / 2)), 1).astype('int64')
+      seg = numpy.repeat(numpy.arange(len(d)), n)
+      t = (numpy.arange(n.sum()) - numpy.repeat(numpy.cumsum(n) - n, n)) / numpy.repeat(n, n)
+      pts = numpy.vstack([ring[seg] + (ring[seg + 1] - ring[seg]) * t[:, None], ring[-1:]])
+      r = ((grid['ymax'] - pts[:, 1]) / cell).astype('int64')
+      edge[r, ((pts[:, 0] - grid['xmin']) / cell).astype('int64')] = True
+   pad = numpy.pad(edge, 1)
+   for dr in range(3):
+      for dc in range(3):
+         inside |= pad[dr:dr + grid['nrows'], dc:dc + grid['ncols']]
+   sat = numpy.zeros((grid['nrows'] + 1, grid['ncols'] + 1), dtype='int64')
+   sat[1:, 1:] = inside.cumsum(axis=0).cumsum(axis=1)
+   return grid, sat
+
+
+def _bboxCandidates(grid, sat, bbox):
+   '''
+   Boolean array of bounding boxes overlapping a marked cell of a boundary index (see _boundaryIndex).
+   :param bbox: (n, 4) array of (xmin, ymin, xmax, ymax)
+   '''
+   cell = grid['cell']
+   c0 = numpy.clip(numpy.floor((bbox[:, 0] - grid['xmin']) / cell), 0, grid['ncols']).astype('int64')
+   c1 = numpy.clip(numpy.floor((bbox[:, 2] - grid['xmin']) / cell) + 1, 0, grid['ncols']).astype('int64')
+   r0 = numpy.clip(numpy.floor((grid['ymax'] - bbox[:, 3]) / cell), 0, grid['nrows']).astype('int64')
+   r1 = numpy.clip(numpy.floor((grid['ymax'] - bbox[:, 1]) / cell) + 1, 0, grid['nrows']).astype('int64')
+   count = sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0]
+   return (c1 > c0) & (r1 > r0) & (count > 0)
+
+
+def _mergeState(args):
+   '''
+   Read the blocks of one state intersecting a boundary (see MergeCensusBlocks). Run in a worker process.
+   :return: tuple of (state feature class, number of blocks read, list of rows (WKB and fields) to insert)
+   '''
+   fc, boundary, wkt, fields, chunk = args
+   sr = arcpy.SpatialReference()
+   sr.loadFromString(wkt)
+   with arcpy.da.SearchCursor(boundary, ['SHAPE@WKB', 'SHAPE@'], spatial_reference=sr) as curs:
+      shapes = [a for a in curs if a[0] is not None]
+   grid, sat = _boundaryIndex([a[0] for a in shapes])
+   bnd = shapes[0][1]
+   for a in shapes[1:]:
+      bnd = bnd.union(a[1])
+   flds = [f.name for f in arcpy.ListFields(fc)]
+   read = [f for f in fields if f in flds]
+   pos = [read.index(f) + 1 if f in read else None for f in fields]
+   rows = []
+   n = 0
+   with arcpy.da.SearchCursor(fc, ['SHAPE@WKB'] + read, spatial_reference=sr) as curs:
+      while True:
+         part = list(itertools.islice(curs, chunk))
+         if len(part) == 0:
+            break
+         n += len(part)
+         part = [a for a in part if a[0] is not None]
+         bbox = numpy.array([numpy.r_[xy.min(axis=0), xy.max(axis=0)] for xy in
+                             (numpy.concatenate(rasterBlocks.wkbRings(a[0])) for a in part)])
+         for a in itertools.compress(part, _bboxCandidates(grid, sat, bbox)):
+            if not bnd.disjoint(arcpy.FromWKB(bytearray(a[0]), sr)):
+               rows.append((a[0],) + tuple(None if p is None else a[p] for p in pos))
+   return fc, n, rows
+
+
+def clipPopulation(inUnits, boundary, outUnits, fldsPop, suffix='_clip'):
+   '''Clips census units to a processing boundary, and adjusts population to the area retained: each clipped unit
+   gets the population of the original unit multiplied by (clipped area / original area), in new fields named with a
+   suffix (e.g. `total_pop` -> `total_pop_clip`), for use as fldPop in the population distribution functions. The
+   retained area fraction is written to `area_frac`. Areas are read in bulk, and all new fields are written in one
+   pass. Units crossing two boundary features are split between them. inUnits must be unclipped units with raw
+   (unadjusted) population fields. Units which already have `area_frac` or an adjusted field (e.g. `total_pop_clip`)
+   raise a ValueError, since clipping them again would adjust population from fragment areas, not the original units'
+   areas, and overwrite the adjusted population with the unadjusted one.
+
+   :param inUnits: Census blocks, block groups, or other census unit feature class (unclipped)
+   :param boundary: Processing boundary (polygons)
+   :param outUnits: Output feature class of clipped units
+   :param fldsPop: Population field, or list of population fields, to adjust
+   :param suffix: Suffix for adjusted population fields
+   :return: outUnits
+   '''
+   if isinstance(fldsPop, str):
+      fldsPop = [fldsPop]
+   unitFlds = [a.name for a in arcpy.ListFields(inUnits)]
+   done = [f for f in ['area_frac'] + [f + suffix for f in fldsPop] if f in unitFlds]
+   if len(done) > 0:
+      raise ValueError(inUnits + ' has already been clipped (it has ' + ', '.join('`' + f + '`' for f in done) +
+                       '). Use the original census units.')
+   missing = [f for f in fldsPop if f not in unitFlds]
+   if len(missing) > 0:
+      raise ValueError('Population field(s) not found in ' + inUnits + ': ' + ', '.join(missing) + '.')
+   printMsg('Clipping census units to boundary...')
+   arcpy.PairwiseIntersect_analysis([inUnits, boundary], outUnits, "ALL")
+   # Keep the census unit fields, and the OID of the original unit
+   fidFlds = [a.name for a in arcpy.ListFields(outUnits) if a.name.startswith('FID_')]
+   fldFID = 'FID_' + os.path.splitext(os.path.basename(inUnits))[0]
+   if fldFID not in fidFlds:
+      fldFID = fidFlds[0]
+   drop = [a.name for a in arcpy.ListFields(outUnits)
+           if a.name not in unitFlds + [fldFID] and a.editable and not a.required]
+   if len(drop) > 0:
+      arcpy.DeleteField_management(outUnits, drop)
+
+   # Retained area fraction, by clipped unit
+   printMsg('Adjusting population to retained area...')
+   sr = arcpy.Describe(outUnits).spatialReference
+   orig = arcpy.da.FeatureClassToNumPyArray(inUnits, ['OID@', 'SHAPE@AREA'], spatial_reference=sr)
+   clip = arcpy.da.FeatureClassToNumPyArray(outUnits, ['OID@', fldFID, 'SHAPE@AREA'], spatial_reference=sr)
+   o = numpy.argsort(orig['OID@'])
+   area = orig['SHAPE@AREA'][o][numpy.searchsorted(orig['OID@'][o], clip[fldFID])]
+   frac = numpy.minimum(numpy.divide(clip['SHAPE@AREA'], area, out=numpy.zeros(len(clip)), where=area > 0), 1)
+
+   cols = readColumns(outUnits, fldsPop)
+   frac = frac[numpy.argsort(clip['OID@'])][numpy.searchsorted(numpy.sort(clip['OID@']), cols['OID@'])]
+   out = {'OID@': cols['OID@'], 'area_frac': frac}
+   for f in fldsPop:
+      out[f + suffix] = cols[f] * frac
+   writeColumns(outUnits, out, types=dict([(f, 'DOUBLE') for f in out]))
+   total = readColumns(inUnits, fldsPop)
+   for f in fldsPop:
+      print('Population retained in `' + f + suffix + '`: ' + str(round(numpy.nansum(out[f + suffix]), 1)) + ' of ' +
+            str(round(numpy.nansum(total[f]), 1)) + '.')
+
+   return outUnits
+
+
+def DistribPop_nlcd(inBlocks, fldPop, inLandCover, inImpervious, inRoads, outPop, tmpDir=None):
    '''Distributes population from census blocks to developed pixels based on NLCD land cover, yielding a raster representing persons per pixel.
    inBlocks = input shapefile delineating census blocks.
    fldPop = field within inBlocks designating the population for each block 
@@ -56,7 +223,7 @@ def DistribPop_nlcd(inBlocks, fldPop, inLandCover, inImpervious, inRoads, outPop
    inImpervious = NLCD imperviousness raster
    inRoads = raster representation of major roads / uninhabitable pixels
    outPop = output raster representing population per pixel
-   tmpDir = directory to store intermediate files'''
+   tmpDir = ignored; kept (in its original position) so existing calls still work'''
    
    # Apply environment settings
    arcpy.env.snapRaster = inLandCover
@@ -67,81 +234,41 @@ def DistribPop_nlcd(inBlocks, fldPop, inLandCover, inImpervious, inRoads, outPop
    printMsg('Re-projecting census blocks...')
    Blocks_prj = ProjectToMatch (inBlocks, inLandCover)
    
-   # Apply more environment settings
-   arcpy.env.mask = Blocks_prj
-   arcpy.env.extent = Blocks_prj
+   # Census blocks, rasterized by window on the land cover grid limited to the blocks' extent
+   printMsg('Reading census blocks...')
+   grid = rasterBlocks.subGrid(rasterBlocks.gridInfo(inLandCover), arcpy.Describe(Blocks_prj).extent)
+   polys = rasterBlocks.readPolygons(Blocks_prj, grid)
+   zonePop = {a[0]: a[1] or 0 for a in arcpy.da.SearchCursor(Blocks_prj, ['OID@', fldPop])}
    
-   # Extract developed pixels
+   # Developed pixels, by window
    # Criteria: NLCD class in (22, 23, 24) OR NLCD imperviousness gte 10, but with major roads excluded
-   lcDev = tmpDir + os.sep + "lcDev.tif"
-   rclsString = "0 0;11 0;21 0;22 1;23 1;24 1;31 0;41 0;42 0;43 0;52 0;71 0;81 0;82 0;90 0;95 0"
-   printMsg('Reclassifying land cover...')
-   arcpy.gp.Reclassify_sa(inLandCover, "Value", rclsString, lcDev, "NODATA")
-   
-   impDev = tmpDir + os.sep + "impDev.tif"
-   rclsString = "0 9.9999 0;9.9999 100 1;100 1000 0"
-   printMsg('Reclassifying imperviousness...')
-   arcpy.gp.Reclassify_sa(inImpervious, "Value", rclsString, impDev, "NODATA")
-   
-   nlcdDev = tmpDir + os.sep + "nlcdDev.tif"
-   printMsg('Combining land cover and imperviousness...')
-   tmpRast = SetNull(((Raster(impDev) == 0) & (Raster(lcDev) == 0)), 1)
-   tmpRast.save(nlcdDev)
-   
-   mskDev = tmpDir + os.sep + "mskDev.tif"
-   printMsg('Removing major road pixels...')
-   tmpRast = Con(IsNull(inRoads), nlcdDev)
-   tmpRast.save(mskDev)
+   lcClasses = [0, 11, 21, 22, 23, 24, 31, 41, 42, 43, 52, 71, 81, 82, 90, 95]
+   impRemap = [[0, 9.9999, 0], [9.9999, 100, 1], [100, 1000, 0]]
+   inputs = [inLandCover, inImpervious, inRoads]
+   nd = [rasterBlocks.nodataValue(r) for r in inputs]
    
-   # Convert census blocks to raster zones
-   blockZones = tmpDir + os.sep + "blockZones.tif"
-   printMsg('Converting census blocks to raster zones...')
-   arcpy.PolygonToRaster_conversion(in_features = Blocks_prj, 
-                                    value_field = "FID", 
-                                    out_rasterdataset = blockZones, 
-                                    cell_assignment = "MAXIMUM_AREA", 
-                                    priority_field = "NONE", 
-                                    cellsize = inLandCover)
+   def devWeight(grid, w):
+      lc, imp, roads = [rasterBlocks.readWindow(r, grid, w, v) for r, v in zip(inputs, nd)]
+      lcDev = numpy.isin(lc, [22, 23, 24])
+      impDev = rasterBlocks.remapRange(imp, impRemap, nd[1], out_nodata=255, missing="NODATA")
+      dev = numpy.isin(lc, lcClasses) & (impDev != 255) & (lcDev | (impDev == 1)) & rasterBlocks.isNodata(roads, nd[2])
+      return numpy.where(dev, 1.0, numpy.nan)
    
-   # Get the sum of developed cells by zone
-   arcpy.env.mask = mskDev
-   blockSumDev = tmpDir + os.sep + "blockSumDev"
-   printMsg('Summing developed cells within zones...')
-   tmpRast = ZonalStatistics(blockZones, "Value", mskDev, "SUM", "DATA")
-   tmpRast.save(blockSumDev)
-   
-   # Convert census blocks to raw population raster
-   blockPop = tmpDir + os.sep + "blockPop.tif"
-   printMsg('Converting census blocks to raw population raster...')
-   arcpy.PolygonToRaster_conversion(in_features = Blocks_prj, 
-                                    value_field = fldPop, 
-                                    out_rasterdataset = blockPop, 
-                                    cell_assignment = "MAXIMUM_AREA", 
-                                    priority_field = "NONE", 
-                                    cellsize = inLandCover)
-   
-   # Get persons per pixel by distributing population to developed pixels only
-   pixelPop = tmpDir + os.sep + "pixelPop.tif"
-   printMsg('Generating final output...')
-   tmpRast = Raster(blockPop)/Raster(blockSumDev)
-   tmpRast.save(pixelPop)
-   
-   # Set zeros to nulls
-   arcpy.env.mask = Blocks_prj
-   tmpRast = SetNull(Raster(pixelPop) == 0, pixelPop)
-   tmpRast.save(outPop)
+   # Get persons per pixel by distributing population to developed pixels only. Zeros are set to null.
+   printMsg('Distributing population to developed pixels...')
+   distribCoverage(polys, zonePop, devWeight, grid, outPop)
    
    printMsg('Finished.')
    return outPop
 
 
-def DistribPop_roadDens(inBlocks, fldPop, inRoadDens, outPop, tmpDir, popMask=None):
+def DistribPop_roadDens(inBlocks, fldPop, inRoadDens, outPop, tmpDir=None, popMask=None):
    '''Distributes population from census blocks or other unit to pixels based on road density, yielding a raster representing persons per pixel.
    inBlocks = input shapefile delineating census blocks, block groups, or other census unit.
    fldPop = field within inBlocks designating the population for each block 
    inRoadDens = raster representing road density
    outPop = output raster representing population per pixel
-   tmpDir = directory to store intermediate files
+   tmpDir = ignored; kept (in its original position) so existing calls still work
    popMask = optional raster mask, NoData areas will not have population allocated
    '''
    
@@ -150,105 +277,116 @@ def DistribPop_roadDens(inBlocks, fldPop, inRoadDens, outPop, tmpDir, popMask=No
    arcpy.env.cellSize = inRoadDens
    arcpy.env.extent = inRoadDens
    arcpy.env.outputCoordinateSystem = inRoadDens
-   if popMask:
-      # This becomes processing mask. Note that env.mask does not apply to PolygonToRaster, but will apply to all
-      # other raster operations.
-      arcpy.env.mask = popMask
-   else:
-      arcpy.env.mask = inRoadDens
    
    # Re-project census blocks to match road density raster
    printMsg('Re-projecting census blocks...')
    Blocks_prj = ProjectToMatch (inBlocks, inRoadDens)
-   fld_id = [a.name for a in arcpy.ListFields(Blocks_prj) if a.type == 'OID'][0]
    
-   # Apply more environment settings
-   # arcpy.env.mask = Blocks_prj
-   # arcpy.env.extent = Blocks_prj
-   
-   # Convert census blocks to raster zones
-   blockZones = tmpDir + os.sep + "blockZones.tif"
-   printMsg('Converting census blocks to raster zones...')
-   arcpy.PolygonToRaster_conversion(in_features = Blocks_prj, 
-                                    value_field = fld_id, 
-                                    out_rasterdataset = blockZones,
-                                    cell_assignment = "MAXIMUM_AREA", 
-                                    priority_field = "NONE", 
-                                    cellsize = inRoadDens)
-
-   # Get the sum of road density values by zone
-   blockSumDens = tmpDir + os.sep + "blockSumDens.tif"
-   printMsg('Summing road density values within zones...')
-   tmpRast = ZonalStatistics(blockZones, "Value", inRoadDens, "SUM", "DATA")
-   tmpRast.save(blockSumDens)
-   
-   # Get the proportional road density per pixel
-   propDens = tmpDir + os.sep + "propDens.tif"
-   printMsg('Calculating proportional road density values...')
-   tmpRast = Raster(inRoadDens)/Raster(blockSumDens)
-   tmpRast.save(propDens)
-   
-   # Convert census blocks to raw population raster
-   blockPop = tmpDir + os.sep + "blockPop.tif"
-   printMsg('Converting census blocks to raw population raster...')
-   arcpy.PolygonToRaster_conversion(in_features = Blocks_prj, 
-                                    value_field = fldPop, 
-                                    out_rasterdataset = blockPop, 
-                                    cell_assignment = "MAXIMUM_AREA", 
-                                    priority_field = "NONE", 
-                                    cellsize = inRoadDens)
-   
-   # Get persons per pixel by distributing population according to proportional road density
-   pixelPop = tmpDir + os.sep + "pixelPop.tif"
+   # Census blocks, rasterized by window. Small or thin blocks are kept, so their population is not lost.
+   printMsg('Reading census blocks...')
+   grid = rasterBlocks.gridInfo(inRoadDens)
+   polys = rasterBlocks.readPolygons(Blocks_prj, grid)
+   zonePop = {a[0]: a[1] or 0 for a in arcpy.da.SearchCursor(Blocks_prj, ['OID@', fldPop])}
+
+   # Distribute population according to proportional road density. Zeros are set to null.
    printMsg('Distributing population according to road density...')
-   tmpRast = Raster(blockPop)*Raster(propDens)
-   tmpRast.save(pixelPop)
-   
-   # Set zeros to nulls
-   arcpy.env.mask = inRoadDens
-   printMsg('Setting zeros to null...')
-   tmpRast = SetNull(pixelPop, pixelPop, "Value <= 0")
-   tmpRast.save(outPop)
+   distribCoverage(polys, zonePop, inRoadDens, grid, outPop, popMask)
    arcpy.BuildPyramids_management(outPop)
    
    printMsg('Finished.')
    return outPop
 
 
+def distribCoverage(polys, zonePop, weight, grid, outPop, mask=None, size=None):
+   '''Distributes population from census units to pixels in proportion to coverage and a weight (e.g. road density,
+   or 1 for developed pixels). A unit gives each pixel it covers pop[unit] * frac * weight / sum[unit], where frac is
+   the fraction of the pixel covered by the unit and sum[unit] is the sum of frac * weight over the unit's pixels.
+   Coverage is computed window by window (rasterBlocks.windowCoverage), so memory is bounded by the window size. Sums
+   are accumulated with bincount in a first pass over windows, and outPop is written in a second pass, which computes
+   the coverage of each window again. Pixels with no population (including pixels with zero weight) are NoData.
+   Population is conserved, except for units with no weight (e.g. entirely masked out), which is not allocated.
+
+   :param polys: Census units (from rasterBlocks.readPolygons)
+   :param zonePop: Dictionary of population by unit id
+   :param weight: Weight raster aligned to the grid, or a function of (grid, window) returning an array of weights for
+      the window (nan for NoData)
+   :param grid: Grid dictionary of the output raster
+   :param outPop: Output raster representing population per pixel
+   :param mask: Optional raster mask, aligned to the grid. NoData areas will not have population allocated.
+   :param size: Window size (cells). Default is rasterBlocks.tile_size.
+   :return: outPop
+   '''
+   ids = numpy.fromiter(zonePop.keys(), 'int64', len(zonePop))
+   n = int(max(ids.max(initial=0), polys['id'].max(initial=0))) + 1
+   pop = numpy.zeros(n)
+   pop[ids] = numpy.fromiter(zonePop.values(), 'float64', len(zonePop))
+   rasters = ([] if callable(weight) else [weight]) + ([] if mask is None else [mask])
+
+   def readBlocks():
+      # Coverage entries in pixels with weight, and their frac * weight, by window
+      for w, core, arrs, valid in rasterBlocks.iterBlocks(rasters, grid, size):
+         if callable(weight):
+            wt = weight(grid, w).astype('float64')
+            ok = ~numpy.isnan(wt)
+         else:
+            wt = arrs[0].astype('float64')
+            ok = valid[0]
+         if mask is not None:
+            ok &= valid[-1]
+         cover = rasterBlocks.windowCoverage(polys, grid, w)
+         r, c = cover['row'] - w[0], cover['col'] - w[2]
+         cover = {f: v[ok[r, c]] for f, v in cover.items()}
+         r, c = cover['row'] - w[0], cover['col'] - w[2]
+         yield w, cover, wt[r, c] * cover['frac']
+
+   # Persons per unit of frac * weight, by unit
+   wsum = numpy.zeros(n)
+   for w, cover, fw in readBlocks():
+      wsum += numpy.bincount(cover['id'], weights=fw, minlength=n)
+   rate = numpy.divide(pop, wsum, out=numpy.zeros(n), where=wsum > 0)
+   print('Population in units with no weight (not allocated): ' + str(round(pop[wsum <= 0].sum(), 1)) + '.')
+
+   def blocks():
+      for w, cover, fw in readBlocks():
+         arr = rasterBlocks.sparseWindow(cover, w, rate[cover['id']] * fw).astype('float32')
+         arr[~(arr > 0)] = numpy.nan
+         yield w, arr
+
+   rasterBlocks.writeBlocks(blocks(), grid, outPop, nodata=numpy.nan)
+   return outPop
+
+
 def makePopMask_blocks(blocks, snapMask, out, clause="POP10 > 0", erase=None):
-   ''' Makes a feature and raster mask from census blocks, indicating where population CAN be allocated. Default is to
-   include only blocks where population is greater than 0.
+   ''' Makes a raster mask from census blocks, indicating where population CAN be allocated. Default is to include
+   only blocks where population is greater than 0. Pixels covered by any part of a selected block are included, so
+   small blocks/strips are not left out at 30 meters, except pixels mostly (half or more) covered by erase features.
+   Coverage is computed window by window, so memory is bounded by the window size.
 
    :param blocks: Census blocks feature class
    :param snapMask: Raster defining extent, snap, cellsize, mask
-   :param out: Output feature class. Rasterized mask will have use this name with a '_rast' suffix.
+   :param out: Output name. Rasterized mask will have use this name with a '_rast' suffix.
    :param clause: clause used to select census blocks to include
+   :param erase: Feature class of areas where population cannot be allocated (e.g. public lands)
    :return: raster mask
    '''
-
-   lyr = arcpy.MakeFeatureLayer_management(blocks, where_clause=clause)
-   print('Buffering blocks by 10 meters...')
-   # This is to ensure small blocks/strips don't get left out of rasterized surface (30 meter pixels)
-   arcpy.PairwiseBuffer_analysis(lyr, 'tmp_buff', "10 Meters")
-   print('Dissolving blocks...')
+   grid = rasterBlocks.gridInfo(snapMask)
+   print('Reading census blocks...')
+   polys = [rasterBlocks.readPolygons(blocks, grid, clause)]
    if erase is not None:
-      arcpy.PairwiseDissolve_analysis('tmp_buff', 'tmp_diss', multi_part="MULTI_PART")
-      print('Erasing features...')
-      arcpy.Erase_analysis('tmp_diss', erase, out)
-   else:
-      arcpy.PairwiseDissolve_analysis('tmp_buff', out, multi_part="MULTI_PART")
-   arcpy.CalculateField_management(out, 'pop', 1, field_type="SHORT")
-   print('Created feature mask `' + out + '`.')
-
-   with arcpy.EnvManager(snapRaster=snapMask, cellSize=snapMask, mask=snapMask, outputCoordinateSystem=snapMask, extent=snapMask):
-      arcpy.PolygonToRaster_conversion(out, 'pop', 'tmp_rast', "MAXIMUM_AREA", cellsize=snapMask)
-      arcpy.sa.ExtractByMask('tmp_rast', snapMask).save(out + '_rast')
+      print('Reading erase features...')
+      polys.append(rasterBlocks.readPolygons(erase, grid))
+
+   def maskBlocks():
+      for w, core, arrs, valid in rasterBlocks.iterBlocks([snapMask], grid):
+         frac = [rasterBlocks.sparseWindow(rasterBlocks.windowCoverage(p, grid, w), w) for p in polys]
+         keep = valid[0] & (frac[0] > 0)
+         if erase is not None:
+            keep &= frac[1] < 0.5
+         yield w, keep.astype('uint8')
+
+   rasterBlocks.writeBlocks(maskBlocks(), grid, out + '_rast', nodata=0)
    print('Created raster mask `' + out + '_rast' + '`.')
-
-   # Clean up
-   # arcpy.DeleteField_management(out, 'pop')
    arcpy.BuildPyramids_management(out + '_rast')
-   arcpy.Delete_management(['tmp_rast', 'tmp_buff'])
 
    return out + '_rast'
 
@@ -277,8 +415,15 @@ def makePopMask_custom(feats, featBoundary, inRaster, outMask):
    arcpy.SelectLayerByLocation_management(lyr, "INTERSECT", featBoundary)
    printMsg("Rasterizing features...")
    arcpy.PolygonToRaster_conversion(lyr, 'rast', 'popMask_rast0', cellsize=inRaster)
+   fld_id = [a.name for a in arcpy.ListFields(featBoundary) if a.type == 'OID'][0]
+   arcpy.PolygonToRaster_conversion(featBoundary, fld_id, 'popMask_bnd', cellsize=inRaster)
    printMsg("Creating raster mask...")
-   arcpy.sa.SetNull(arcpy.sa.IsNull('popMask_rast0'), 1, "Value = 0").save(outMask)
+   # Cells within the boundary and not covered by exclusion features, by window
+   grid = rasterBlocks.gridInfo(inRaster)
+   blocks = ((w, (valid[1] & ~valid[0]).astype('uint8'))
+             for w, core, arrs, valid in rasterBlocks.iterBlocks(['popMask_rast0', 'popMask_bnd'], grid))
+   rasterBlocks.writeBlocks(blocks, grid, outMask, nodata=0)
+   arcpy.Delete_management('popMask_bnd')
    arcpy.BuildPyramids_management(outMask)
 
    return outMask
@@ -294,6 +439,8 @@ def main():
    arcpy.env.snapRaster = snap
    arcpy.env.cellSize = snap
    arcpy.env.extent = snap
+   # Window size for block processing, so that peak memory stays well within the memory available
+   rasterBlocks.tile_size = rasterBlocks.memoryTileSize(2048)
 
    # create a merged blocks feature class
    blockShpDir = r'F:\David\GIS_data\US_CENSUS_TIGER\Census_block_pop\shapefiles\2020'
@@ -315,20 +462,28 @@ def main():
    ppa = r'D:\projects\rec_model\rec_datasets\rec_datasets_working_2021.gdb\public_lands_final'
    popMask = makePopMask_blocks(blocks, snap, 'census_blocks_populated', erase=ppa)
 
+   # Census units with population adjusted to the boundary in `total_pop_clip`. ACS_2015_2019_5yr_BG is already
+   # clipped and adjusted, so it is used as is. To use another census unit layer, set inUnits to the original
+   # (unclipped) units, with the raw ACS total population in `total_pop`: clipPopulation clips them and adds
+   # `total_pop_clip` (see IMPORTANT NOTE).
+   inUnits = r'D:\projects\rec_model\rec_model_processing\input_recmodel.gdb\ACS_2015_2019_5yr_BG'  # r'H:\Working\ACS_2016\ACS_2016_5yr_BG.shp'
+   if 'total_pop_clip' in [a.name for a in arcpy.ListFields(inUnits)]:
+      inBlocks = inUnits
+   else:
+      inBlocks = clipPopulation(inUnits, boundary, inUnits + '_clip', 'total_pop')
+
    # Make population density raster
-   inBlocks = r'D:\projects\rec_model\rec_model_processing\input_recmodel.gdb\ACS_2015_2019_5yr_BG'  # r'H:\Working\ACS_2016\ACS_2016_5yr_BG.shp'
    fldPop = 'total_pop_clip'  # 'TotPop_clp'
    # inRoadDens = r'F:\David\projects\RCL_processing\Tiger_2020\roads_proc.gdb\Roads_kdens_250_noZero'  # r'H:\Working\RecMod\RecModProducts.gdb\Roads_kdens_250'
    inRoadDens = r'D:\projects\OSM\OSM_RoadsProc.gdb\OSM_Roads_20210422_kdens'
    outPop = r'D:\projects\rec_model\rec_model_processing\input_recmodel.gdb\distribPop_kdens_2019'  # r'H:\Working\RecMod\RecModProducts.gdb\distribPop_kdens'
-   tmpDir = r'D:\scratch\raster'  # r'H:\Working\TMP'
 
    # Specify function to run
-   DistribPop_roadDens(inBlocks, fldPop, inRoadDens, outPop, tmpDir, popMask)
+   DistribPop_roadDens(inBlocks, fldPop, inRoadDens, outPop, popMask=popMask)
 
    # QA/QC: double-check that sums match reasonably:
-   a = arcpy.RasterToNumPyArray(outPop, nodata_to_value=0)
-   print('Raster sum of population: ' + str(a.sum()) + '.')
+   total, n = rasterBlocks.rasterSum(outPop)
+   print('Raster sum of population: ' + str(total) + '.')
    print('Polygon sum of population: ' + str(sum([a[0] for a in arcpy.da.SearchCursor(inBlocks, fldPop)])) + '.')
 
 if __name__ == '__main__':
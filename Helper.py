@@ -21,6 +21,7 @@ import traceback
 import numpy
 import time
 import re
+import rasterBlocks
 
 arcpy.CheckOutExtension("Spatial")
 from arcpy.sa import *
@@ -30,6 +31,93 @@ arcpy.env.overwriteOutput = True
 arcpy.env.maintainAttachments = False
 
 
+def isRaster(data):
+   # Catchments can be polygons, or a label raster with attributes in its raster attribute table
+   return arcpy.Describe(data).dataType in ['RasterDataset', 'RasterLayer', 'RasterBand']
+
+
+def zonalTable(zoneRast, valRast, zoneFld, outTab):
+   # Zonal statistics (SUM, MEAN, COUNT) of a value raster for a zone raster, as a table like ZonalStatisticsAsTable.
+   # Computed with bincount in one streamed pass (see rasterBlocks.zonalStats).
+   zs = rasterBlocks.zonalStats(zoneRast, {'val': valRast})
+   arr = numpy.zeros(len(zs), dtype=[(zoneFld, 'int32'), ('COUNT', 'int64'), ('SUM', 'float64'), ('MEAN', 'float64')])
+   arr[zoneFld] = zs['zone']
+   arr['COUNT'] = zs['val_count']
+   arr['SUM'] = zs['val_sum']
+   arr['MEAN'] = zs['val_mean']
+   # Zones with no data in the value raster are excluded, as in ZonalStatisticsAsTable
+   arr = arr[arr['COUNT'] > 0]
+   if arcpy.Exists(outTab):
+      arcpy.Delete_management(outTab)
+   # NumPyArrayToTable needs a full path
+   arcpy.da.NumPyArrayToTable(arr, os.path.join(arcpy.env.workspace, outTab))
+   return outTab
+
+
+def secApportion(secPPA, servCatRast, grpFld, impRast, outTab, ppa_access="ppa_access", fld_prefix="sec_"):
+   # Apportion secondary PPAs to label raster catchments, in memory. Equivalent to the intersect/dissolve/merge steps
+   # in servCatStats, with areas of PPAs within catchments from the fraction of each cell covered by each PPA
+   # (rasterBlocks.windowCoverage, by window), so PPAs smaller than a cell are kept. PPAs with ppa_access = 1 are
+   # combined by cell (coverage summed, up to the whole cell) before summing by catchment, so overlapping PPAs are
+   # counted once, as in the dissolve by grpFld. Their impervious mean is weighted by the combined coverage. PPAs with
+   # ppa_access = 0 are each apportioned by their own coverage, as in the intersect. PPAs with a null ppa_access are
+   # dropped, as in the ppa_access = 1 / = 0 selections. Output table has grpFld and <fld_prefix>acres, _impacc_acres,
+   # and _accgreen_acres fields.
+   oid = arcpy.Describe(secPPA).OIDFieldName
+   grid = rasterBlocks.gridInfo(servCatRast)
+   polys = rasterBlocks.readPolygons(secPPA, grid)
+   # Null ppa_access is read as -1 (neither accessible nor not), so those PPAs are dropped
+   ppa = numpy.sort(arcpy.da.TableToNumPyArray(secPPA, [oid, ppa_access, 'accgreen_acres', 'Shape_Area'],
+                                               null_value={ppa_access: -1, 'accgreen_acres': 0, 'Shape_Area': 0}),
+                    order=oid)
+   # By window: combined coverage of ppa_access = 1 PPAs by cell (with catchment, and coverage-weighted impervious
+   # sums and counts), and coverage of ppa_access = 0 PPAs by (PPA, catchment)
+   acc_parts, notacc_parts = [], []
+   for w, core, arrs, valid in rasterBlocks.iterBlocks([servCatRast, impRast], grid):
+      cover = rasterBlocks.windowCoverage(polys, grid, w)
+      r, c = cover['row'] - w[0], cover['col'] - w[2]
+      ok = valid[0][r, c]
+      r, c, frac = r[ok], c[ok], cover['frac'][ok].astype('float64')
+      i = numpy.searchsorted(ppa[oid], cover['id'][ok])
+      acc = ppa[ppa_access][i] == 1
+      notacc = (ppa[ppa_access][i] == 0) & (ppa['Shape_Area'][i] > 0)
+      cell, k = numpy.unique(r[acc] * (w[3] - w[2]) + c[acc], return_inverse=True)
+      comb = numpy.minimum(numpy.bincount(k.ravel(), weights=frac[acc], minlength=len(cell)), 1)
+      cr, cc = cell // (w[3] - w[2]), cell % (w[3] - w[2])
+      imp_ok = valid[1][cr, cc]
+      acc_parts.append((arrs[0][cr, cc].astype('int64'), comb, numpy.where(imp_ok, comb * arrs[1][cr, cc], 0),
+                        comb * imp_ok))
+      key, k = numpy.unique(numpy.column_stack([i[notacc], arrs[0][r, c][notacc]]).astype('int64'), axis=0,
+                            return_inverse=True)
+      notacc_parts.append((key, numpy.bincount(k.ravel(), weights=frac[notacc], minlength=len(key))))
+   acc_cat = numpy.concatenate([p[0] for p in acc_parts])
+   key = numpy.concatenate([p[0] for p in notacc_parts]).reshape(-1, 2)
+   cats, j = numpy.unique(numpy.concatenate([acc_cat, key[:, 1]]), return_inverse=True)
+   j = j.ravel()
+   ja, jn = j[:len(acc_cat)], j[len(acc_cat):]
+   n = len(cats)
+   cell_area = grid['cell'] ** 2
+   # ppa_access = 1: impervious/accessible green acres from impervious mean of the accessible area in each servCat
+   acres = numpy.bincount(ja, weights=numpy.concatenate([p[1] for p in acc_parts]), minlength=n) * cell_area / 4046.856
+   imp_sum = numpy.bincount(ja, weights=numpy.concatenate([p[2] for p in acc_parts]), minlength=n)
+   imp_ct = numpy.bincount(ja, weights=numpy.concatenate([p[3] for p in acc_parts]), minlength=n)
+   imp_perc = numpy.divide(imp_sum, imp_ct, out=numpy.zeros(n), where=imp_ct > 0)
+   # ppa_access = 0: accgreen_acres, proportional to the area of the PPA in each servCat
+   i = key[:, 0]
+   prop = numpy.concatenate([p[1] for p in notacc_parts]) * cell_area / ppa['Shape_Area'][i]
+   green0 = numpy.bincount(jn, weights=ppa['accgreen_acres'][i] * prop, minlength=n)
+   arr = numpy.zeros(n, dtype=[(grpFld, 'int32'), (fld_prefix + 'acres', 'float64'),
+                               (fld_prefix + 'impacc_acres', 'float64'), (fld_prefix + 'accgreen_acres', 'float64')])
+   arr[grpFld] = cats
+   arr[fld_prefix + 'acres'] = acres
+   arr[fld_prefix + 'impacc_acres'] = (imp_perc / 100) * acres
+   arr[fld_prefix + 'accgreen_acres'] = (1 - imp_perc / 100) * acres + green0
+   if arcpy.Exists(outTab):
+      arcpy.Delete_management(outTab)
+   arcpy.da.NumPyArrayToTable(arr, os.path.join(arcpy.env.workspace, outTab))
+   return outTab
+
+
 def servCatStats(servCatFeat, grpFld, popRast, secPPA=None, impRast=None, ppa_access="ppa_access"):
    # servCatFeat='servCat'
    # grpFld = "servCat_group_id"
@@ -37,10 +125,20 @@ def servCatStats(servCatFeat, grpFld, popRast, secPPA=None, impRast=None, ppa_ac
 
    print('Calculating population statistics...')
    tab = servCatFeat + '_stats'
-   arcpy.sa.ZonalStatisticsAsTable(servCatFeat, grpFld, popRast, tab, statistics_type="SUM")
+   if isRaster(servCatFeat):
+      # Label raster catchments (zone = grpFld = Value): one streamed pass with bincount
+      zonalTable(servCatFeat, popRast, grpFld, tab)
+   else:
+      arcpy.sa.ZonalStatisticsAsTable(servCatFeat, grpFld, popRast, tab, statistics_type="SUM")
    arcpy.CalculateField_management(tab, 'pop_total', 'round(!SUM!)', field_type="LONG")
 
-   if secPPA:
+   if secPPA and isRaster(servCatFeat):
+      print('Apportioning secondary PPAs to servCats...')
+      secApportion(secPPA, servCatFeat, grpFld, impRast, 'tmp_notimp_stats', ppa_access)
+      flds = ['sec_acres', 'sec_impacc_acres', 'sec_accgreen_acres']
+      arcpy.JoinField_management(tab, grpFld, 'tmp_notimp_stats', grpFld, flds)
+      flds2 = ['pop_total', 'sec_accgreen_acres']
+   elif secPPA:
       print('Intersecting secondary PPAs with servCats...')
       arcpy.CalculateField_management(secPPA, 'ShapeArea_secPPA', '!Shape_Area!', field_type="FLOAT")
       arcpy.PairwiseIntersect_analysis([secPPA, servCatFeat], 'tmp_sec0')
@@ -100,23 +198,94 @@ def servCatStats(servCatFeat, grpFld, popRast, secPPA=None, impRast=None, ppa_ac
    return servCatFeat
 
 
+# Field aliases, applied by fldAlias and to new fields in writeColumns
+fld_aliases = {
+   "src_table": "Source feature dataset",
+   "src_fid": "Source feature OID",
+   "src_name": "Source feature name",
+   "a_wct": "Watercraft access",
+   "a_fsh": "Fishing access",
+   "a_swm": "Swimming access",
+   "a_gen": "Unspecified aquatic access",
+   "t_trl": "Trail access",
+   "t_lnd": "Public land access",
+   "use": "Model use flag",
+   "use_why": "Model use comment",
+   "join_table": "Join table",
+   "join_fid": "Join PPA OID",
+   "join_name": "Join PPA name",
+   "join_score": "Join PPA score",
+   "focal_src_table": "Focal source feature dataset",
+   "focal_src_name": "Focal source feature name",
+   "focal_join_name": "Focal join PPA name",
+   "accgreen_acres": "AG (acres)",
+   "focal_accgreen_acres": "Focal PPA AG (acres)",
+   "sec_accgreen_acres": "Secondary PPA AG (acres)",
+   "access": "Catchment/gap flag",
+   "group_id": "Feature group ID",
+   "ppa_group_id": "PPA group ID",
+   "pop_total": "Population",
+   "agapt": "AG (acres) per 1000",
+   "rec_pressure": "Recreation pressure"
+}
+
+
+def readColumns(inTab, flds):
+   # Read fields of a table (or raster attribute table) in one pass, as a dictionary of float columns by field name
+   # (nulls as nan), with OIDs under 'OID@'.
+   types = dict([(a.name, a.type) for a in arcpy.ListFields(inTab)])
+   # Integer fields cannot hold nan, so nulls are read as a sentinel value
+   null = dict([(f, -2147483648 if types[f] in ['Integer', 'SmallInteger'] else numpy.nan) for f in flds])
+   arr = arcpy.da.TableToNumPyArray(inTab, ['OID@'] + flds, skip_nulls=False, null_value=null)
+   cols = {'OID@': arr['OID@']}
+   for f in flds:
+      c = arr[f].astype('float64')
+      if types[f] in ['Integer', 'SmallInteger']:
+         c[arr[f] == -2147483648] = numpy.nan
+      cols[f] = c
+   return cols
+
+
+def writeColumns(inTab, cols, types={}):
+   # Write columns (as returned by readColumns) to a table in one pass. Existing fields are replaced, and all fields are
+   # added in one step (with aliases from fld_aliases). Values are written with a single UpdateCursor, with nan as null.
+   flds = [f for f in cols if f != 'OID@']
+   arcpy.DeleteField_management(inTab, [a.name for a in arcpy.ListFields(inTab) if a.name in flds])
+   arcpy.AddFields_management(inTab, [[f, types.get(f, 'FLOAT'), fld_aliases.get(f, f)] for f in flds])
+   row = dict([(o, i) for i, o in enumerate(cols['OID@'])])
+   with arcpy.da.UpdateCursor(inTab, ['OID@'] + flds) as curs:
+      for r in curs:
+         i = row[r[0]]
+         vals = [cols[f][i] for f in flds]
+         curs.updateRow([r[0]] + [None if numpy.isnan(v) else (int(v) if types.get(f) == 'LONG' else float(v))
+                                  for f, v in zip(flds, vals)])
+   return inTab
+
+
+def agaptValues(pop, ac):
+   # Acres of greenspace per thousand persons: 0 where there are no acres, null where there is no population.
+   with numpy.errstate(divide='ignore', invalid='ignore'):
+      ag = numpy.where(pop > 0, ac / (pop / 1000), numpy.nan)
+   ag[ac == 0] = 0
+   return ag
+
+
+def pressureValues(pop, score, per=10000, adj=1):
+   # Recreation pressure (0-100): population per unit of score (adjusted by adj), with `per` persons per unit of score at
+   # the middle of the range (50). Rounded as python's round (half to even).
+   mid = (1 / per) * 50
+   with numpy.errstate(divide='ignore', invalid='ignore'):
+      return numpy.minimum(100, numpy.round(mid * pop / (adj + score)))
+
+
 def agapt(servCatFeat, fldPop="pop_total", fldAc="accgreen_acres", prefix=""):
    if prefix != "":
       ag = prefix + '_agapt'
    else:
       ag = 'agapt'
    print('Calculating `' + ag + '` field...')
-   arcpy.DeleteField_management(servCatFeat, [ag])
-   cb = '''def fn(pop, ac):
-      if ac == 0:
-         return 0
-      else:
-         if pop > 0:
-            return ac / (pop / 1000)
-         else:
-            return None'''
-   calc = 'fn(!' + fldPop + '!, !' + fldAc + '!)'
-   arcpy.CalculateField_management(servCatFeat, ag, calc, code_block=cb, field_type="FLOAT")
+   cols = readColumns(servCatFeat, [fldPop, fldAc])
+   writeColumns(servCatFeat, {'OID@': cols['OID@'], ag: agaptValues(cols[fldPop], cols[fldAc])})
 
    return servCatFeat
 
@@ -125,19 +294,28 @@ def servCatPressure(servCatFeat, fldPop="pop_total", fldScore="access", per=1000
    # Note: 'per' is the number of persons per unit of fldScore, which denotes the middle of the scoring range (50).
 
    print('Calculating `' + fldPressure + '`...')
-   arcpy.DeleteField_management(servCatFeat, [fldPressure])
+   cols = readColumns(servCatFeat, [fldPop, fldScore])
+   # aquatic access point adjustment, or PPA adjustment
+   adj = 0.01 if fldScore == 'access' else 1
+   pres = pressureValues(cols[fldPop], cols[fldScore], per, adj)
+   writeColumns(servCatFeat, {'OID@': cols['OID@'], fldPressure: pres}, {fldPressure: 'LONG'})
+
+   fldAlias(servCatFeat)
+   return servCatFeat
 
-   if fldScore == 'access':
-      # aquatic access point adjustment
-      adj = str(0.01)
-   else:
-      # PPA adjustment
-      adj = str(1)
 
-   # calculate pressure
-   mid = str((1 / per) * 50)
-   calc = "min(100, round(" + mid + " * !" + fldPop + "! / (" + adj + " + !" + fldScore + "!)))"
-   arcpy.CalculateField_management(servCatFeat, fldPressure, calc, field_type="LONG")
+def catchmentMetrics(servCatFeat, fldPop="pop_total", fldAc="accgreen_acres", fldScore="access", per=10000,
+                     fldPressure="rec_pressure", calc_agapt=False):
+   # Calculate agapt (optional) and servCatPressure fields in memory, with one read and one write of the table
+   print('Calculating catchment metrics...')
+   flds = [fldPop, fldScore] + ([fldAc] if calc_agapt else [])
+   cols = readColumns(servCatFeat, list(dict.fromkeys(flds)))
+   out = {'OID@': cols['OID@']}
+   if calc_agapt:
+      out['agapt'] = agaptValues(cols[fldPop], cols[fldAc])
+   adj = 0.01 if fldScore == 'access' else 1
+   out[fldPressure] = pressureValues(cols[fldPop], cols[fldScore], per, adj)
+   writeColumns(servCatFeat, out, {fldPressure: 'LONG'})
 
    fldAlias(servCatFeat)
    return servCatFeat
@@ -145,39 +323,10 @@ def servCatPressure(servCatFeat, fldPop="pop_total", fldScore="access", per=1000
 
 def fldAlias(inTab):
    print('Updating table aliases...')
-   # Create a master list of fields with alias to apply
-   fa = {
-      "src_table": "Source feature dataset",
-      "src_fid": "Source feature OID",
-      "src_name": "Source feature name",
-      "a_wct": "Watercraft access",
-      "a_fsh": "Fishing access",
-      "a_swm": "Swimming access",
-      "a_gen": "Unspecified aquatic access",
-      "t_trl": "Trail access",
-      "t_lnd": "Public land access",
-      "use": "Model use flag",
-      "use_why": "Model use comment",
-      "join_table": "Join table",
-      "join_fid": "Join PPA OID",
-      "join_name": "Join PPA name",
-      "join_score": "Join PPA score",
-      "focal_src_table": "Focal source feature dataset",
-      "focal_src_name": "Focal source feature name",
-      "focal_join_name": "Focal join PPA name",
-      "accgreen_acres": "AG (acres)",
-      "focal_accgreen_acres": "Focal PPA AG (acres)",
-      "sec_accgreen_acres": "Secondary PPA AG (acres)",
-      "access": "Catchment/gap flag",
-      "group_id": "Feature group ID",
-      "ppa_group_id": "PPA group ID",
-      "pop_total": "Population",
-      "agapt": "AG (acres) per 1000",
-      "rec_pressure": "Recreation pressure"
-   }
-   fld = [a.name for a in arcpy.ListFields(inTab) if a.name in fa.keys()]
+   # Only fields with a different alias are altered
+   fld = [a.name for a in arcpy.ListFields(inTab) if a.name in fld_aliases and a.aliasName != fld_aliases[a.name]]
    for f in fld:
-      arcpy.AlterField_management(inTab, f, new_field_alias=fa[f])
+      arcpy.AlterField_management(inTab, f, new_field_alias=fld_aliases[f])
    return inTab
 
 
@@ -0,0 +1,1466 @@
+"""
+networkGraph
+Created on: 2026-10-17
+Version:  ArcGIS Pro / Python 3.x
+
+NumPy/SciPy road graph and travel-time engine, used as an alternative to Network Analyst solves in
+networkServiceAreas.py. Includes functions for:
+   - roadsToGraph, which reads OSM road lines into a segment-based graph (one node per unique vertex)
+   - loadRoadGraph, which loads a road graph from a versioned .npz cache, rebuilding it when the roads or graph
+      parameters change (see saveGraph, graphHash)
+   - graphMatrix, which builds the compressed sparse row (CSR) matrix of edge travel times used by the solvers
+   - snapToNodes, which locates facilities on the nearest node of a road where facilities can be located
+   - snapToEdges, which locates facilities on the nearest road segment (and position along it) where facilities can
+      be located, and locateFacilities, which caches these locations by point geometry hash
+   - coalesceLocations, which reduces facilities of the same group located at the same place on the network to one
+      source before solving
+   - sourceMatrix, which adds located facilities to the CSR matrix as source nodes
+   - solveNearest, a single multi-source shortest-path solve (minutes to nearest facility, for every node)
+   - iterGroupReach, a bounded reachability search by facility group, solved in batches of groups
+   - solveGroupCounts, which counts the facility groups reaching each node (overlapping service areas)
+   - updateNearest, which updates nearest facility solves for added and removed facilities, re-solving only the nodes
+      which can change (used for scenarios, see scenarios.py)
+   - solveGroupMasks, which combines bitmasks (e.g. activity types) of the facility groups reaching each node
+   - solveTiled, which splits nearest facility and overlap count solves into spatial tiles (with a halo sized by the
+      cutoff at the maximum road speed), solves tiles in parallel processes, and merges the results
+   - solveNearestGroups, a k-label multi-source search for the k nearest facility groups of every node
+   - buildNearestIndex, which stores the k nearest facility groups (and travel times) of every node in memory-mapped
+      files, so that any subset of the facilities can be answered with queryNearestIndex instead of a new solve
+   - buildODMatrix, which stores travel times from points (e.g. populated raster cells) to all facilities within a
+      cutoff as a memory-mapped sparse (CSR) matrix, so that metrics such as nearest time (odNearest), facilities
+      within a time (odCount) or catchments (odCatchment) are sparse reductions instead of new solves
+   - floatingCatchment, enhanced two-step floating catchment (E2SFCA) accessibility with distance decay, as sparse
+      matrix-vector products over an OD matrix (see odGroups, decayWeights)
+   - nodeLabels, which maps nearest source nodes to facility groups (network Voronoi catchments)
+   - segmentSamples, which samples node travel times (and labels) at points along road segments
+   - graphToGrid, which transfers sampled values to raster cells within a trim distance of the roads
+
+General usage notes:
+- Graph coordinates are in the road feature class's coordinate system, which must be a projected system in meters
+(e.g. the Albers system used for the network dataset and raster template).
+- Travel times are in minutes. Road speeds come from the `maxspeed` field (km/h) when populated, otherwise from
+road_speeds by OSM `code`. One-way roads follow the OSM `oneway` field (B = both, F = forward, T = backward).
+- Lines are connected at any shared vertex (like 'Any vertex' connectivity in a network dataset).
+- Only graph reading and raster output require arcpy; building and solving work with NumPy/SciPy alone.
+"""
+
+try:
+   import arcpy
+except ImportError:
+   # arcpy is only needed to read roads/facilities, not to build or solve graphs.
+   arcpy = None
+import os
+import json
+import hashlib
+import concurrent.futures
+import numpy
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+
+# Default speeds (km/h) by OSM road code, used where `maxspeed` is not populated.
+road_speeds = {
+   5111: 105, 5112: 90, 5113: 80, 5114: 70, 5115: 55,  # motorway, trunk, primary, secondary, tertiary
+   5121: 50, 5122: 40, 5123: 15,  # unclassified, residential, living street
+   5131: 65, 5132: 55, 5133: 50, 5134: 45, 5135: 40,  # links
+   5141: 25, 5142: 20, 5143: 20, 5144: 20, 5145: 20, 5146: 20, 5147: 20  # service, tracks
+}
+# Road codes included in the graph (driveable roads).
+drive_codes = sorted(road_speeds.keys())
+# Road codes where facilities can be located (default only driveable, non-highway roads).
+locate_codes = [5112, 5113, 5114, 5115, 5121, 5122, 5123, 5132, 5133, 5134, 5135, 5141, 5142, 5143, 5144, 5145, 5146,
+                5147]
+
+# Version of the graph format and building procedure. Increment when either changes, so cached graphs are rebuilt.
+graph_version = 1
+# Graph arrays (stored in cached graphs)
+graph_arrays = ['xy', 'seg_u', 'seg_v', 'seg_tf', 'seg_tb', 'seg_loc']
+
+# Maximum length (meters) of the segment pieces indexed for snapping (see snapToEdges), and the version of the snapping
+# procedure. Increment snap_version when snapping changes, so cached locations are located again.
+snap_piece = 100
+snap_version = 2
+
+# Enhanced two-step floating catchment (E2SFCA) distance decay: Gaussian weights for 10-minute travel time zones
+# (Luo & Qi 2009), as [upper, weight] steps.
+e2sfca_weights = [[10, 1], [20, 0.68], [30, 0.22]]
+
+# Conversion of linear unit names (as used in Network Analyst distance strings) to meters.
+unit_meters = {'meters': 1, 'kilometers': 1000, 'feet': 0.3048, 'miles': 1609.344, 'yards': 0.9144}
+
+
+def linearUnit(dist):
+   '''
+   Convert a linear unit string (e.g. "0.3 Miles") to meters. Numbers are returned as-is (assumed meters).
+   :param dist: Distance string or number
+   :return: distance in meters
+   '''
+   if isinstance(dist, (int, float)):
+      return float(dist)
+   val, unit = dist.split()
+   unit = unit.lower()
+   if not unit.endswith('s'):
+      unit += 's'
+   return float(val) * unit_meters[unit]
+
+
+def linesToGraph(xy, line_id, codes, oneway=None, maxspeed=None, speeds=road_speeds, locate=locate_codes,
+                 tolerance=0.01):
+   '''
+   Build a road graph from line vertices. Each pair of consecutive vertices in a line becomes one segment.
+   :param xy: Vertex coordinates (n x 2 array), ordered along each line
+   :param line_id: Line ID for each vertex (vertices of one line must be consecutive)
+   :param codes: OSM road code for each vertex (constant within a line)
+   :param oneway: OSM oneway code ('B', 'F', 'T') for each vertex. If None, all roads are two-way.
+   :param maxspeed: Speed (km/h) for each vertex. Values <= 0 use the default speed for the road code.
+   :param speeds: Dictionary of default speeds (km/h) by road code
+   :param locate: Road codes where facilities can be located
+   :param tolerance: Vertices within this distance (map units) are considered the same node
+   :return: graph dictionary
+   '''
+   xy = numpy.asarray(xy, dtype='float64')
+   line_id = numpy.asarray(line_id)
+   codes = numpy.asarray(codes)
+
+   # Unique vertices become nodes
+   key = numpy.round(xy / tolerance).astype('int64')
+   key, node = numpy.unique(key, axis=0, return_inverse=True)
+   node = node.ravel()
+   node_xy = key * tolerance
+
+   # Segments between consecutive vertices of the same line
+   same = line_id[1:] == line_id[:-1]
+   u = node[:-1][same]
+   v = node[1:][same]
+   keep = u != v
+   i = numpy.flatnonzero(same)[keep]
+   u, v = u[keep], v[keep]
+   length = numpy.hypot(*(xy[i + 1] - xy[i]).T)
+
+   # Travel time (minutes)
+   code = codes[i]
+   lut_code = numpy.array(list(speeds.keys()))
+   lut_speed = numpy.array(list(speeds.values()), dtype='float64')
+   order = numpy.argsort(lut_code)
+   pos = numpy.searchsorted(lut_code[order], code).clip(0, len(lut_code) - 1)
+   spd = numpy.where(lut_code[order][pos] == code, lut_speed[order][pos], numpy.nan)
+   if maxspeed is not None:
+      ms = numpy.asarray(maxspeed, dtype='float64')[i]
+      spd = numpy.where(ms > 0, ms, spd)
+   minutes = length / 1000 / spd * 60
+   minutes = numpy.maximum(minutes, 1e-6)  # zero-length weights are not edges in sparse graphs
+
+   tf = minutes.copy()
+   tb = minutes.copy()
+   if oneway is not None:
+      ow = numpy.asarray(oneway)[i]
+      tf[ow == 'T'] = numpy.inf
+      tb[ow == 'F'] = numpy.inf
+
+   graph = {
+      'xy': node_xy,
+      'seg_u': u.astype('int64'),
+      'seg_v': v.astype('int64'),
+      'seg_tf': tf,
+      'seg_tb': tb,
+      'seg_loc': numpy.isin(code, locate)
+   }
+   return graph
+
+
+def roadsToGraph(roads, code_field='code', oneway_field='oneway', speed_field='maxspeed', codes=drive_codes,
+                 speeds=road_speeds, locate=locate_codes):
+   '''
+   Read road line feature classes into a road graph (see linesToGraph).
+   :param roads: Road line feature class, or list of feature classes (e.g. Roads_Local and Roads_Hwy)
+   :param code_field: Field holding the OSM road code
+   :param oneway_field: Field holding the OSM oneway code. Ignored if not present.
+   :param speed_field: Field holding speeds (km/h). Ignored if not present.
+   :param codes: Road codes to include in the graph
+   :param speeds: Dictionary of default speeds (km/h) by road code
+   :param locate: Road codes where facilities can be located
+   :return: graph dictionary
+   '''
+   if isinstance(roads, str):
+      roads = [roads]
+   where = '"' + code_field + '" IN (' + ', '.join(str(c) for c in codes) + ')'
+   sr = arcpy.Describe(roads[0]).spatialReference
+   arrs = []
+   n = 0
+   for r in roads:
+      print('Reading road vertices from ' + r + '...')
+      flds = [a.name for a in arcpy.ListFields(r)]
+      f = ['OID@', 'SHAPE@X', 'SHAPE@Y', code_field] + [a for a in [oneway_field, speed_field] if a in flds]
+      a = arcpy.da.FeatureClassToNumPyArray(r, f, where, spatial_reference=sr, explode_to_points=True)
+      # Offset line IDs so they are unique across feature classes
+      ids = a['OID@'].astype('int64') + n
+      n = ids.max() + 1 if len(ids) > 0 else n
+      arrs.append((a, ids))
+   xy = numpy.concatenate([numpy.column_stack([a['SHAPE@X'], a['SHAPE@Y']]) for a, ids in arrs])
+   line_id = numpy.concatenate([ids for a, ids in arrs])
+   code = numpy.concatenate([a[code_field] for a, ids in arrs])
+   oneway = None
+   maxspeed = None
+   if all(oneway_field in a.dtype.names for a, ids in arrs):
+      oneway = numpy.concatenate([a[oneway_field].astype('U1') for a, ids in arrs])
+   if all(speed_field in a.dtype.names for a, ids in arrs):
+      maxspeed = numpy.concatenate([a[speed_field] for a, ids in arrs])
+   print('Building graph from ' + str(len(xy)) + ' vertices...')
+   graph = linesToGraph(xy, line_id, code, oneway, maxspeed, speeds, locate)
+   graph['wkt'] = sr.exportToString()
+   print('Graph has ' + str(len(graph['xy'])) + ' nodes and ' + str(len(graph['seg_u'])) + ' segments.')
+   return graph
+
+
+def graphHash(graph):
+   '''
+   Content hash of a graph's arrays. Used to identify results (e.g. cached facility locations) from a given graph.
+   :param graph: graph dictionary
+   :return: hex digest
+   '''
+   h = hashlib.sha1()
+   for a in graph_arrays:
+      h.update(numpy.ascontiguousarray(graph[a]).tobytes())
+   return h.hexdigest()
+
+
+def datasetSignature(data):
+   '''
+   Inexpensive signature of a dataset: path, record count, extent, and the latest modification time of its files
+   (the whole geodatabase for geodatabase datasets, since feature class file names are not known).
+   :param data: Feature class or table
+   :return: dictionary
+   '''
+   d = arcpy.Describe(data)
+   ext = d.extent
+   path = d.catalogPath
+   gdb = path
+   while gdb and not gdb.lower().endswith('.gdb') and os.path.dirname(gdb) != gdb:
+      gdb = os.path.dirname(gdb)
+   if gdb.lower().endswith('.gdb'):
+      files = [os.path.join(gdb, f) for f in os.listdir(gdb)]
+   else:
+      base = os.path.splitext(path)[0]
+      files = [base + e for e in ['.shp', '.dbf', '.shx', '.prj'] if os.path.exists(base + e)]
+   return {'path': path, 'count': int(arcpy.GetCount_management(data)[0]),
+           'extent': [ext.XMin, ext.YMin, ext.XMax, ext.YMax], 'modified': max([os.path.getmtime(f) for f in files])}
+
+
+def saveGraph(graph, path, signature=None):
+   '''
+   Save a graph (including its CSR matrices) to an uncompressed .npz file.
+   :param graph: graph dictionary
+   :param path: Output .npz file
+   :param signature: Signature of the graph inputs, used by loadRoadGraph to check if the cache is current
+   :return: path
+   '''
+   arrs = {a: graph[a] for a in graph_arrays}
+   for travDir in ["TO_FACILITIES", "FROM_FACILITIES"]:
+      m = graphMatrix(graph, travDir)
+      arrs.update({travDir + '_indptr': m.indptr, travDir + '_indices': m.indices, travDir + '_data': m.data})
+   meta = {'version': graph_version, 'hash': graphHash(graph), 'wkt': graph.get('wkt'), 'signature': signature}
+   numpy.savez(path, meta=json.dumps(meta), **arrs)
+   return path
+
+
+def loadGraph(path):
+   '''
+   Load a graph saved with saveGraph.
+   :param path: .npz file
+   :return: graph dictionary. The graph's metadata is stored under the 'meta' key.
+   '''
+   with numpy.load(path) as f:
+      meta = json.loads(str(f['meta']))
+      graph = {a: f[a] for a in graph_arrays}
+      n = len(graph['xy'])
+      for travDir in ["TO_FACILITIES", "FROM_FACILITIES"]:
+         graph['csr_' + travDir] = sparse.csr_matrix(
+            (f[travDir + '_data'], f[travDir + '_indices'], f[travDir + '_indptr']), shape=(n, n))
+   graph['wkt'] = meta['wkt']
+   graph['hash'] = meta['hash']
+   graph['meta'] = meta
+   return graph
+
+
+def loadRoadGraph(roads, cache, rebuild=False, **kwargs):
+   '''
+   Load a road graph from a cache file, building (and caching) it with roadsToGraph if the cache does not exist or is
+   out of date. The cache is out of date if the graph version, the roadsToGraph parameters, or the signature of any
+   road feature class (count, extent, modification time) has changed.
+   :param roads: Road line feature class, or list of feature classes
+   :param cache: Cache file (.npz)
+   :param rebuild: Force rebuilding the graph
+   :param kwargs: Parameters passed to roadsToGraph
+   :return: graph dictionary
+   '''
+   if isinstance(roads, str):
+      roads = [roads]
+   params = {'code_field': 'code', 'oneway_field': 'oneway', 'speed_field': 'maxspeed', 'codes': drive_codes,
+             'speeds': road_speeds, 'locate': locate_codes}
+   params.update(kwargs)
+   sig = {'params': json.loads(json.dumps(params)), 'roads': [datasetSignature(r) for r in roads]}
+   if os.path.exists(cache) and not rebuild:
+      graph = loadGraph(cache)
+      if graph['meta']['version'] == graph_version and graph['meta']['signature'] == sig:
+         print('Loaded road graph from ' + cache + '.')
+         return graph
+      print('Road graph cache ' + cache + ' is out of date.')
+   graph = roadsToGraph(roads, **params)
+   print('Saving road graph to ' + cache + '...')
+   saveGraph(graph, cache, sig)
+   return loadGraph(cache)
+
+
+def readPoints(facil, graph, fields=[], null_value=None):
+   '''
+   Read point coordinates (in the graph's coordinate system) and attributes from a feature class.
+   :param facil: Point feature class
+   :param graph: graph dictionary
+   :param fields: Attribute fields to read
+   :param null_value: Value to use for null attributes
+   :return: tuple of (xy array, structured array of attributes)
+   '''
+   sr = arcpy.SpatialReference()
+   sr.loadFromString(graph['wkt'])
+   a = arcpy.da.FeatureClassToNumPyArray(facil, ['SHAPE@X', 'SHAPE@Y'] + fields, spatial_reference=sr,
+                                         null_value=null_value)
+   return numpy.column_stack([a['SHAPE@X'], a['SHAPE@Y']]), a
+
+
+def graphMatrix(graph, travDir="TO_FACILITIES"):
+   '''
+   Build the CSR matrix of travel times (minutes) between nodes.
+   :param graph: graph dictionary
+   :param travDir: Travel direction. For "TO_FACILITIES", the matrix is reversed, so that solving from facilities
+      gives the travel time from each node to the facilities.
+   :return: scipy.sparse.csr_matrix (nodes x nodes)
+   '''
+   if 'csr_' + travDir in graph:
+      return graph['csr_' + travDir]
+   u = numpy.concatenate([graph['seg_u'], graph['seg_v']])
+   v = numpy.concatenate([graph['seg_v'], graph['seg_u']])
+   w = numpy.concatenate([graph['seg_tf'], graph['seg_tb']])
+   if travDir == "TO_FACILITIES":
+      u, v = v, u
+   ok = numpy.isfinite(w)
+   u, v, w = u[ok], v[ok], w[ok]
+   # Keep only the fastest of duplicate (parallel) edges; csr_matrix would otherwise sum them.
+   o = numpy.lexsort((w, v, u))
+   u, v, w = u[o], v[o], w[o]
+   first = numpy.ones(len(u), dtype=bool)
+   first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+   n = len(graph['xy'])
+   return sparse.csr_matrix((w[first], (u[first], v[first])), shape=(n, n))
+
+
+def snapToNodes(graph, xy, max_dist):
+   '''
+   Locate points on the nearest node of a road segment where facilities can be located.
+   :param graph: graph dictionary
+   :param xy: Point coordinates (n x 2 array)
+   :param max_dist: Search distance limit (meters, or a linear unit string)
+   :return: node index for each point (-1 where no node is within max_dist)
+   '''
+   loc = numpy.unique(numpy.concatenate([graph['seg_u'][graph['seg_loc']], graph['seg_v'][graph['seg_loc']]]))
+   d, i = cKDTree(graph['xy'][loc]).query(numpy.asarray(xy, dtype='float64'), distance_upper_bound=linearUnit(max_dist))
+   node = numpy.full(len(d), -1, dtype='int64')
+   found = numpy.isfinite(d)
+   node[found] = loc[i[found]]
+   return node
+
+
+def snapToEdges(graph, xy, max_dist, k=16, locate=True, piece=None):
+   '''
+   Locate points on the nearest road segment where facilities can be located (as MATCH_TO_CLOSEST in AddLocations).
+   Segments are split into pieces of at most piece length, and the midpoints of the pieces are indexed in a KD-tree.
+   Every segment within max_dist of a point has a piece midpoint within max_dist plus half a piece of it, so the
+   pieces within that radius include the nearest segment, however long it is. Candidates are the k nearest pieces
+   within the radius; points with k pieces in the radius (which may have more) get all of them from a radius query.
+   Exact point-to-segment distances are calculated for all candidates at once.
+   :param graph: graph dictionary
+   :param xy: Point coordinates (n x 2 array)
+   :param max_dist: Search distance limit (meters, or a linear unit string)
+   :param k: Number of candidate pieces per point from the nearest-neighbor query
+   :param locate: If False, points are located on any segment (e.g. raster cells, see buildODMatrix)
+   :param piece: Maximum segment piece length (meters) indexed in the KD-tree. Default is snap_piece.
+   :return: dictionary with arrays seg (segment index, -1 where not located), frac (position along the segment from
+      seg_u to seg_v, 0-1) and dist (distance from the point to the segment)
+   '''
+   max_dist = linearUnit(max_dist)
+   if piece is None:
+      piece = snap_piece
+   xy = numpy.asarray(xy, dtype='float64').reshape(-1, 2)
+   if locate:
+      loc = numpy.flatnonzero(graph['seg_loc'])
+   else:
+      loc = numpy.arange(len(graph['seg_u']))
+   a, b = graph['xy'][graph['seg_u'][loc]], graph['xy'][graph['seg_v'][loc]]
+   if len(loc) == 0 or len(xy) == 0:
+      return {'seg': numpy.full(len(xy), -1, dtype='int64'), 'frac': numpy.zeros(len(xy)),
+              'dist': numpy.full(len(xy), numpy.inf)}
+   tree = ('_loc_tree' if locate else '_seg_tree', piece)
+   if tree not in graph:
+      # Pieces of each segment, indexed by their midpoints
+      length = numpy.hypot(*(b - a).T)
+      npc = numpy.maximum(numpy.ceil(length / piece), 1).astype('int64')
+      pseg = numpy.repeat(numpy.arange(len(loc)), npc)
+      t = (numpy.arange(npc.sum()) - numpy.repeat(numpy.cumsum(npc) - npc, npc) + 0.5) / npc[pseg]
+      graph[tree] = (cKDTree(a[pseg] + (b - a)[pseg] * t[:, None]), pseg, (length / npc).max() / 2)
+   kd, pseg, half = graph[tree]
+   radius = max_dist + half
+
+   def segDist(p, cand):
+      # Position along and distance to candidate segments (p broadcasts against cand)
+      ab = b[cand] - a[cand]
+      ap = p - a[cand]
+      den = (ab ** 2).sum(axis=-1)
+      frac = numpy.clip((ap * ab).sum(axis=-1) / numpy.where(den > 0, den, 1), 0, 1)
+      return frac, numpy.sqrt(((ap - frac[..., None] * ab) ** 2).sum(axis=-1))
+
+   k = min(k, len(pseg))
+   md, near = kd.query(xy, k=k, distance_upper_bound=radius)
+   near = near.reshape(len(xy), k)
+   valid = near < len(pseg)
+   cand = pseg[numpy.where(valid, near, 0)]
+   frac, dist = segDist(xy[:, None, :], cand)
+   dist[~valid] = numpy.inf
+   best = dist.argmin(axis=1)
+   rows = numpy.arange(len(xy))
+   seg, frac, dist = cand[rows, best], frac[rows, best], dist[rows, best]
+   full = numpy.flatnonzero(valid[:, -1])
+   if len(full) > 0:
+      # Points with k pieces in the radius may have more: test all pieces in the radius
+      ball = kd.query_ball_point(xy[full], radius)
+      pt = numpy.repeat(numpy.arange(len(full)), [len(i) for i in ball])
+      fc = pseg[numpy.concatenate(list(ball)).astype('int64')]
+      ff, fd = segDist(xy[full][pt], fc)
+      o = numpy.lexsort((fd, pt))
+      first = o[numpy.r_[True, pt[o][1:] != pt[o][:-1]]]
+      seg[full], frac[full], dist[full] = fc[first], ff[first], fd[first]
+   found = dist <= max_dist
+   return {'seg': numpy.where(found, loc[seg], -1), 'frac': numpy.where(found, frac, 0),
+           'dist': numpy.where(found, dist, numpy.inf)}
+
+
+def pointKeys(xy, precision=0.001):
+   '''
+   Hash point geometries (coordinates rounded to precision) to unsigned 64-bit keys.
+   :param xy: Point coordinates (n x 2 array)
+   :param precision: Coordinate precision (map units)
+   :return: key array
+   '''
+   q = numpy.round(numpy.asarray(xy, dtype='float64') / precision).astype('int64').view('uint64')
+   with numpy.errstate(over='ignore'):
+      h = q[:, 0] * numpy.uint64(0x9E3779B97F4A7C15) ^ q[:, 1]
+      h ^= h >> numpy.uint64(31)
+      h *= numpy.uint64(0xBF58476D1CE4E5B9)
+      h ^= h >> numpy.uint64(29)
+   return h
+
+
+def locateFacilities(graph, xy, max_dist, cache=None):
+   '''
+   Locate points on road segments (see snapToEdges), re-using locations stored in a cache file. Cached locations are
+   keyed by point geometry hash, and only used if the graph (content hash), max_dist and snap_version are unchanged.
+   New locations are added to the cache.
+   :param graph: graph dictionary
+   :param xy: Point coordinates (n x 2 array)
+   :param max_dist: Search distance limit (meters, or a linear unit string)
+   :param cache: Cache file (.npz). If None, locations are not cached.
+   :return: location dictionary (see snapToEdges)
+   '''
+   xy = numpy.asarray(xy, dtype='float64').reshape(-1, 2)
+   key = pointKeys(xy)
+   ghash = graph.get('hash') or graphHash(graph)
+   meta = {'graph': ghash, 'max_dist': linearUnit(max_dist), 'version': snap_version}
+   old = {'key': numpy.zeros(0, dtype='uint64'), 'seg': numpy.zeros(0, dtype='int64'),
+          'frac': numpy.zeros(0), 'dist': numpy.zeros(0)}
+   if cache is not None and os.path.exists(cache):
+      with numpy.load(cache) as f:
+         if json.loads(str(f['meta'])) == meta:
+            old = {a: f[a] for a in old.keys()}
+   pos = numpy.searchsorted(old['key'], key).clip(0, max(len(old['key']) - 1, 0))
+   hit = (old['key'][pos] == key) if len(old['key']) > 0 else numpy.zeros(len(key), dtype=bool)
+   loc = {'seg': numpy.full(len(xy), -1, dtype='int64'), 'frac': numpy.zeros(len(xy)),
+          'dist': numpy.full(len(xy), numpy.inf)}
+   for a in ['seg', 'frac', 'dist']:
+      loc[a][hit] = old[a][pos[hit]]
+   if (~hit).any():
+      new = snapToEdges(graph, xy[~hit], max_dist)
+      for a in ['seg', 'frac', 'dist']:
+         loc[a][~hit] = new[a]
+      if cache is not None:
+         k, i = numpy.unique(numpy.concatenate([old['key'], key[~hit]]), return_index=True)
+         arrs = {a: numpy.concatenate([old[a], new[a]])[i] for a in ['seg', 'frac', 'dist']}
+         # Write to a temporary file first, so that analyses running in parallel never read a partial cache
+         tmp = os.path.splitext(cache)[0] + '_' + str(os.getpid()) + '.npz'
+         numpy.savez(tmp, meta=json.dumps(meta), key=k, **arrs)
+         os.replace(tmp, cache)
+   print('Located ' + str((loc['seg'] >= 0).sum()) + ' of ' + str(len(xy)) + ' points (' + str(hit.sum()) +
+         ' from cache).')
+   return loc
+
+
+def coalesceLocations(graph, loc, group=None, tolerance=0):
+   '''
+   Coalesce facilities in the same group located at the same place on the network: on the same node, or on the same
+   segment within the tolerance distance along the segment of the set's first facility (so sets never span more than
+   the tolerance). Each set of coalesced facilities is represented by its first facility.
+   :param graph: graph dictionary
+   :param loc: location dictionary (see snapToEdges)
+   :param group: Facility group for each facility. If None, all facilities are one group.
+   :param tolerance: Network distance within which facilities are coalesced (meters, or a linear unit string)
+   :return: array of the representative facility for each facility (-1 = not located)
+   '''
+   tolerance = linearUnit(tolerance)
+   seg, frac = loc['seg'], loc['frac']
+   nf = len(seg)
+   if group is None:
+      group = numpy.zeros(nf, dtype='int64')
+   ok = numpy.flatnonzero(seg >= 0)
+   s = seg[ok]
+   length = numpy.hypot(*(graph['xy'][graph['seg_v'][s]] - graph['xy'][graph['seg_u'][s]]).T)
+   pos = frac[ok] * length
+   # Facilities at (or within tolerance of) a segment end are keyed by the node, as -(node + 1)
+   key = s.copy()
+   at_u = pos <= tolerance
+   at_v = ~at_u & (length - pos <= tolerance)
+   key[at_u] = -(graph['seg_u'][s[at_u]] + 1)
+   key[at_v] = -(graph['seg_v'][s[at_v]] + 1)
+   pos[at_u | at_v] = 0
+   grp = numpy.asarray(group)[ok]
+   o = numpy.lexsort((pos, key, grp))
+   grp, key, pos = grp[o], key[o], pos[o]
+   # Runs of facilities with the same group and key. Within a run, a source is represented by its first facility and
+   # takes the facilities within the tolerance of it; the next facility beyond starts a new source.
+   run = numpy.ones(len(o), dtype=bool)
+   run[1:] = (grp[1:] != grp[:-1]) | (key[1:] != key[:-1])
+   rid = numpy.cumsum(run) - 1
+   end = numpy.append(numpy.flatnonzero(run)[1:], len(o))[rid]
+   # Position offset by run, so one search finds the next facility beyond the tolerance within each run
+   span = (pos.max() if len(pos) > 0 else 0) + tolerance + 1
+   spos = rid * span + pos
+   nxt = numpy.searchsorted(spos, spos + tolerance, side='right')
+   new = run.copy()
+   cur = numpy.flatnonzero(run)
+   while len(cur) > 0:
+      cur = nxt[cur][nxt[cur] < end[cur]]
+      new[cur] = True
+   first = numpy.flatnonzero(new)
+   rep = numpy.full(nf, -1, dtype='int64')
+   rep[ok[o]] = ok[o][first[numpy.cumsum(new) - 1]]
+   return rep
+
+
+def sourceMatrix(graph, loc, travDir="TO_FACILITIES"):
+   '''
+   Add located facilities to the CSR matrix as source nodes, connected to both ends of their segment with the
+   travel time for the part of the segment between the facility and that end (respecting one-way roads).
+   :param graph: graph dictionary
+   :param loc: location dictionary (see snapToEdges)
+   :param travDir: Travel direction ("TO_FACILITIES" or "FROM_FACILITIES")
+   :return: tuple of (matrix, node), where node is the source node for each facility (-1 = not located)
+   '''
+   m = graphMatrix(graph, travDir)
+   n = len(graph['xy'])
+   nf = len(loc['seg'])
+   ok = numpy.flatnonzero(loc['seg'] >= 0)
+   seg, f = loc['seg'][ok], loc['frac'][ok]
+   u, v = graph['seg_u'][seg], graph['seg_v'][seg]
+   tf, tb = graph['seg_tf'][seg], graph['seg_tb'][seg]
+   if travDir == "TO_FACILITIES":
+      # From u to the facility travels forward along the segment, from v travels backward.
+      w_u, w_v = f * tf, (1 - f) * tb
+   else:
+      w_u, w_v = f * tb, (1 - f) * tf
+   src = n + ok
+   rows = numpy.concatenate([src, src])
+   cols = numpy.concatenate([u, v])
+   w = numpy.maximum(numpy.concatenate([w_u, w_v]), 1e-6)
+   keep = numpy.isfinite(w)
+   add = sparse.csr_matrix((w[keep], (rows[keep], cols[keep])), shape=(n + nf, n + nf))
+   matrix = (sparse.vstack([sparse.hstack([m, sparse.csr_matrix((n, nf))]), sparse.csr_matrix((nf, n + nf))]) +
+             add).tocsr()
+   node = numpy.full(nf, -1, dtype='int64')
+   node[ok] = src
+   return matrix, node
+
+
+def solveNearest(graph, sources, cutoff=numpy.inf, travDir="TO_FACILITIES", matrix=None):
+   '''
+   Solve travel time from every node to the nearest source node, in a single multi-source shortest-path search.
+   :param graph: graph dictionary
+   :param sources: Source (facility) node indices, from snapToNodes or sourceMatrix
+   :param cutoff: Travel time limit (minutes). Nodes beyond this are unreached.
+   :param travDir: Travel direction ("TO_FACILITIES" or "FROM_FACILITIES")
+   :param matrix: Pre-built matrix from graphMatrix (optional)
+   :return: tuple of (minutes, nearest source node) arrays. Unreached nodes have minutes = inf, source = -1.
+   '''
+   if matrix is None:
+      matrix = graphMatrix(graph, travDir)
+   sources = numpy.unique(numpy.asarray(sources)[numpy.asarray(sources) >= 0])
+   dist, pred, src = csgraph.dijkstra(matrix, directed=True, indices=sources, limit=cutoff, min_only=True,
+                                      return_predecessors=True)
+   # Drop facility source nodes added by sourceMatrix
+   n = len(graph['xy'])
+   dist, src = dist[:n], src[:n]
+   src = numpy.where(numpy.isfinite(dist), src, -1)
+   return dist, src
+
+
+def iterGroupReach(graph, node, group, cutoff, travDir="TO_FACILITIES", batch_size=8, matrix=None):
+   '''
+   Find the nodes within the cutoff of each facility group (i.e. the group's service area), in batches of groups.
+   Sources are solved together in one multi-source search per batch, then combined by group.
+   :param graph: graph dictionary
+   :param node: Source node for each facility, from snapToNodes or sourceMatrix (-1 = not located)
+   :param group: Facility group for each facility
+   :param cutoff: Travel time limit (minutes)
+   :param travDir: Travel direction ("TO_FACILITIES" or "FROM_FACILITIES")
+   :param batch_size: Maximum number of sources per batch. Memory use is about batch_size * number of nodes * 8 bytes.
+   :param matrix: Pre-built matrix from graphMatrix (optional)
+   :return: generator of (groups, reached) tuples, where reached is a boolean array (groups x nodes)
+   '''
+   if matrix is None:
+      matrix = graphMatrix(graph, travDir)
+   n = len(graph['xy'])
+   node = numpy.asarray(node)
+   group = numpy.asarray(group)
+   ok = node >= 0
+   # Unique (group, node) sources, sorted by group
+   pairs = numpy.unique(numpy.column_stack([group[ok], node[ok]]), axis=0)
+   grp, start, nsrc = numpy.unique(pairs[:, 0], return_index=True, return_counts=True)
+   i = 0
+   while i < len(grp):
+      if nsrc[i] > batch_size:
+         # Large group: one multi-source search
+         src = pairs[start[i]:start[i] + nsrc[i], 1]
+         d = csgraph.dijkstra(matrix, directed=True, indices=src, limit=cutoff, min_only=True)
+         yield grp[i:i + 1], numpy.isfinite(d[:n])[None, :]
+         i += 1
+         continue
+      # Batch of groups, up to batch_size sources
+      j = i + 1
+      while j < len(grp) and nsrc[i:j + 1].sum() <= batch_size:
+         j += 1
+      src = pairs[start[i]:start[j - 1] + nsrc[j - 1], 1]
+      d = csgraph.dijkstra(matrix, directed=True, indices=src, limit=cutoff)
+      reached = numpy.logical_or.reduceat(numpy.isfinite(d[:, :n]), start[i:j] - start[i], axis=0)
+      yield grp[i:j], reached
+      i = j
+
+
+def solveGroupCounts(graph, node, group, cutoff, travDir="TO_FACILITIES", batch_size=8, matrix=None):
+   '''
+   Count the number of facility groups within the cutoff of each node (i.e. overlapping service areas).
+   See iterGroupReach for parameters.
+   :return: count array (one per graph node)
+   '''
+   counts = numpy.zeros(len(graph['xy']), dtype='int32')
+   for grp, reached in iterGroupReach(graph, node, group, cutoff, travDir, batch_size, matrix):
+      counts += reached.sum(axis=0, dtype='int32')
+   return counts
+
+
+def groupMasks(group, masks):
+   '''
+   Combine facility bitmasks by group (bitwise OR).
+   :param group: Facility group for each facility
+   :param masks: Bitmask for each facility
+   :return: tuple of (groups, masks) arrays
+   '''
+   group = numpy.asarray(group)
+   masks = numpy.asarray(masks)
+   o = numpy.argsort(group, kind='stable')
+   grp, start = numpy.unique(group[o], return_index=True)
+   return grp, numpy.bitwise_or.reduceat(masks[o], start) if len(o) > 0 else masks[:0]
+
+
+def solveGroupMasks(graph, node, group, masks, cutoff, travDir="TO_FACILITIES", batch_size=8, matrix=None):
+   '''
+   Combine the bitmasks of all facility groups within the cutoff of each node (bitwise OR), e.g. to find which
+   activity types can be reached. A group's bitmask combines the bitmasks of its facilities. See iterGroupReach for
+   other parameters.
+   :param masks: Bitmask (integer) for each facility
+   :return: bitmask array (one per graph node)
+   '''
+   grp_all, grp_mask = groupMasks(group, masks)
+   out = numpy.zeros(len(graph['xy']), dtype=grp_mask.dtype)
+   for grp, reached in iterGroupReach(graph, node, group, cutoff, travDir, batch_size, matrix):
+      gm = grp_mask[numpy.searchsorted(grp_all, grp)]
+      out |= numpy.bitwise_or.reduce(numpy.where(reached, gm[:, None], 0), axis=0).astype(out.dtype)
+   return out
+
+
+def updateNearest(graph, matrix, minutes, src, remove=[], add=[], cutoff=numpy.inf, sources=None):
+   '''
+   Update travel time to nearest source after removing and adding sources, re-solving only the nodes which can
+   change. Nodes whose nearest source is removed are re-solved from the surrounding nodes (a search from their
+   boundary, starting at the boundary nodes' travel times), and added sources are solved with the cutoff. Results
+   equal a new solveNearest with the same sources, except for ties.
+   :param graph: graph dictionary
+   :param matrix: Matrix including all (removed, remaining and added) source nodes, from sourceMatrix
+   :param minutes: Travel time (minutes) for each node, from solveNearest
+   :param src: Nearest source node for each node, from solveNearest (-1 = unreached)
+   :param remove: Source nodes to remove
+   :param add: Source nodes to add
+   :param cutoff: Travel time limit (minutes), as used for minutes
+   :param sources: Source nodes used for minutes (before the update). Default is all source nodes in the matrix.
+   :return: tuple of (minutes, source, changed) arrays, where changed is True for nodes with a new travel time or
+      nearest source
+   '''
+   n = len(graph['xy'])
+   nn = matrix.shape[0]
+   minutes, src = numpy.array(minutes, dtype='float64'), numpy.array(src)
+   changed = numpy.zeros(n, dtype=bool)
+   remove = numpy.unique(numpy.asarray(remove, dtype='int64'))
+   remove = remove[remove >= 0]
+   add = numpy.unique(numpy.asarray(add, dtype='int64'))
+   add = add[add >= 0]
+   if len(remove) > 0:
+      aff = numpy.flatnonzero(numpy.isin(src, remove))
+      minutes[aff] = numpy.inf
+      src[aff] = -1
+      changed[aff] = True
+      # Times and sources of all matrix nodes; source nodes in use are their own source (other source nodes in the
+      # matrix, and removed sources, are unreached)
+      t_all = numpy.concatenate([minutes, numpy.zeros(nn - n)])
+      s_all = numpy.concatenate([src, numpy.arange(n, nn)])
+      if sources is not None:
+         unused = numpy.ones(nn, dtype=bool)
+         unused[:n] = False
+         sources = numpy.asarray(sources, dtype='int64')
+         unused[sources[sources >= 0]] = False
+         t_all[unused] = numpy.inf
+         s_all[unused] = -1
+      t_all[remove] = numpy.inf
+      s_all[remove] = -1
+      # Boundary: reached nodes with an edge to a node being re-solved
+      into = matrix[:, aff].tocoo().row
+      bnd = numpy.unique(into[numpy.isfinite(t_all[into])])
+      idx = numpy.concatenate([bnd, aff])
+      # Search from a virtual node connected to the boundary nodes, with their travel times as edge weights
+      eps = 1e-6
+      sub = matrix[idx][:, idx].tocoo()
+      k = len(idx)
+      rows = numpy.concatenate([sub.row, numpy.full(len(bnd), k)])
+      cols = numpy.concatenate([sub.col, numpy.arange(len(bnd))])
+      w = numpy.concatenate([sub.data, t_all[bnd] + eps])
+      d, pred = csgraph.dijkstra(sparse.csr_matrix((w, (rows, cols)), shape=(k + 1, k + 1)), directed=True,
+                                 indices=k, limit=cutoff + eps, return_predecessors=True)
+      # Source of each node: the source of the boundary node its path starts from (by pointer jumping)
+      lab = numpy.full(k + 1, -1, dtype='int64')
+      lab[:len(bnd)] = numpy.where(pred[:len(bnd)] == k, s_all[bnd], -1)
+      ptr = numpy.where(pred >= 0, pred, k)
+      todo = numpy.flatnonzero((lab < 0) & (pred >= 0) & (pred != k))
+      while len(todo) > 0:
+         lab[todo] = lab[ptr[todo]]
+         ptr[todo] = ptr[ptr[todo]]
+         todo = todo[(lab[todo] < 0) & (ptr[todo] != k)]
+      d_aff = d[len(bnd):k] - eps
+      ok = numpy.isfinite(d_aff)
+      minutes[aff[ok]] = d_aff[ok]
+      src[aff[ok]] = lab[len(bnd):k][ok]
+   if len(add) > 0:
+      d, pred, s = csgraph.dijkstra(matrix, directed=True, indices=add, limit=cutoff, min_only=True,
+                                    return_predecessors=True)
+      better = d[:n] < minutes
+      minutes[better] = d[:n][better]
+      src[better] = s[:n][better]
+      changed |= better
+   minutes[~numpy.isfinite(minutes)] = numpy.inf
+   src[~numpy.isfinite(minutes)] = -1
+   return minutes, src, changed
+
+
+def maxSpeed(graph):
+   '''
+   Maximum travel speed on any segment of the graph.
+   :param graph: graph dictionary
+   :return: speed (meters per minute)
+   '''
+   length = numpy.hypot(*(graph['xy'][graph['seg_v']] - graph['xy'][graph['seg_u']]).T)
+   return (length / numpy.minimum(graph['seg_tf'], graph['seg_tb'])).max()
+
+
+def _solveTile(args):
+   '''
+   Solve one tile for solveTiled (in a worker process).
+   '''
+   sub_graph, sub_matrix, sub_node, sub_group, masks, cutoff, core, batch_size = args
+   d, src = solveNearest(sub_graph, sub_node, cutoff, matrix=sub_matrix)
+   counts = None
+   if sub_group is not None and masks is not None:
+      counts = solveGroupMasks(sub_graph, sub_node, sub_group, masks, cutoff, batch_size=batch_size,
+                               matrix=sub_matrix)[core]
+   elif sub_group is not None:
+      counts = solveGroupCounts(sub_graph, sub_node, sub_group, cutoff, batch_size=batch_size, matrix=sub_matrix)[core]
+   return d[core], src[core], counts
+
+
+def solveTiled(graph, matrix, node, cutoff, group=None, tile_size=None, workers=None, batch_size=8, masks=None):
+   '''
+   Solve travel time to nearest source (and optionally overlap counts by group) in spatial tiles, in parallel. Each
+   tile is solved on the part of the graph within a halo of the tile, sized so that any path within the cutoff to a
+   node in the tile is inside the halo (cutoff times the maximum road speed). Results are taken for the nodes in each
+   tile, and merged in tile order: minimum travel time (and its source), summed counts, and combined bitmasks. By
+   default there is about one tile per worker; nodes in the halos of neighboring tiles are solved more than once, which
+   is the cost of the parallelism. With one tile (or one worker), the graph is solved without tiling.
+   :param graph: graph dictionary
+   :param matrix: Matrix with facility source nodes (see sourceMatrix)
+   :param node: Source node for each facility (-1 = not located)
+   :param cutoff: Travel time limit (minutes)
+   :param group: Facility group for each facility. If given, overlap counts by group are also solved.
+   :param tile_size: Tile width and height (map units). Default is the size giving about one tile per worker.
+   :param workers: Number of worker processes (default is the number of processors)
+   :param batch_size: Maximum number of sources solved at once, for counts
+   :param masks: Bitmask for each facility. If given with group, group bitmasks are combined instead of counted
+      (see solveGroupMasks).
+   :return: tuple of (minutes, nearest source node, counts) arrays, where counts is None if group is not given (or
+      bitmasks, if masks are given)
+   '''
+   n = len(graph['xy'])
+   matrix = matrix.tocsr()
+   node = numpy.asarray(node)
+   srcs = numpy.unique(node[node >= 0])
+   # Source nodes connect to their segment ends: a source is in a tile's halo if either end is
+   srcs = srcs[matrix.indptr[srcs + 1] > matrix.indptr[srcs]]
+   nend = matrix.indptr[srcs + 1] - matrix.indptr[srcs]
+   end_src = numpy.repeat(numpy.arange(len(srcs)), nend)
+   end_xy = graph['xy'][matrix.indices[numpy.repeat(matrix.indptr[srcs] - numpy.cumsum(nend) + nend, nend) +
+                                       numpy.arange(nend.sum())]]
+   halo = cutoff * maxSpeed(graph)
+   if workers is None:
+      workers = os.cpu_count()
+   xy = graph['xy']
+   x0, y0 = xy.min(axis=0)
+   width, height = numpy.maximum(xy.max(axis=0) - (x0, y0), 1e-6)
+   if tile_size is None:
+      # About one tile per worker, in columns and rows proportional to the extent
+      nx = max(1, int(round(numpy.sqrt(workers * width / height))))
+      ny = max(1, int(round(workers / nx)))
+      tw, th = width / nx * (1 + 1e-9), height / ny * (1 + 1e-9)
+   else:
+      tw, th = tile_size, tile_size
+   tx = ((xy[:, 0] - x0) // tw).astype('int64')
+   ty = ((xy[:, 1] - y0) // th).astype('int64')
+   tile = tx * (ty.max() + 1) + ty
+   if workers == 1 or tile.max() == tile.min():
+      print('Solving without tiles...')
+      return _solveTile((graph, matrix, node, group, masks, cutoff, numpy.arange(n), batch_size))
+   tasks = []
+   meta = []
+   for t in numpy.unique(tile):
+      core = numpy.flatnonzero(tile == t)
+      xmin, ymin = x0 + tx[core[0]] * tw - halo, y0 + ty[core[0]] * th - halo
+      xmax, ymax = xmin + tw + 2 * halo, ymin + th + 2 * halo
+      near = numpy.flatnonzero((xy[:, 0] >= xmin) & (xy[:, 0] < xmax) & (xy[:, 1] >= ymin) & (xy[:, 1] < ymax))
+      end_in = (end_xy[:, 0] >= xmin) & (end_xy[:, 0] < xmax) & (end_xy[:, 1] >= ymin) & (end_xy[:, 1] < ymax)
+      s_in = srcs[numpy.bincount(end_src[end_in], minlength=len(srcs)) > 0]
+      if len(s_in) == 0:
+         continue
+      loc = numpy.concatenate([near, s_in])
+      sub_matrix = matrix[loc][:, loc]
+      f = numpy.isin(node, s_in)
+      sub_node = numpy.full(len(node), -1, dtype='int64')
+      sub_node[f] = len(near) + numpy.searchsorted(s_in, node[f])
+      sub_group = None if group is None else numpy.asarray(group)
+      tasks.append(({'xy': xy[near]}, sub_matrix, sub_node, sub_group, masks, cutoff,
+                    numpy.searchsorted(near, core), batch_size))
+      meta.append((core, loc))
+   print('Solving ' + str(len(tasks)) + ' tiles...')
+   minutes = numpy.full(n, numpy.inf)
+   nearest = numpy.full(n, -1, dtype='int64')
+   counts = None
+   if group is not None:
+      counts = numpy.zeros(n, dtype='int32' if masks is None else numpy.asarray(masks).dtype)
+   with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+      for (core, loc), (d, src, ct) in zip(meta, pool.map(_solveTile, tasks)):
+         better = d < minutes[core]
+         minutes[core] = numpy.where(better, d, minutes[core])
+         nearest[core] = numpy.where(better, loc[src], nearest[core])
+         if counts is not None and masks is not None:
+            counts[core] |= ct
+         elif counts is not None:
+            counts[core] += ct
+   return minutes, nearest, counts
+
+
+def solveNearestGroups(graph, node, group=None, k=8, cutoff=numpy.inf, travDir="TO_FACILITIES", matrix=None,
+                       delta=None):
+   '''
+   Travel time to the k nearest facility groups of every node, in one k-label multi-source search: each node keeps the
+   best time of up to k distinct groups (and the facility giving that time). Labels are propagated in rounds, in
+   buckets of travel time (as in delta-stepping), so that most labels are final the first time they are propagated.
+   :param graph: graph dictionary
+   :param node: Source node for each facility, from snapToNodes or sourceMatrix (-1 = not located)
+   :param group: Facility group for each facility. Default is one group per facility.
+   :param k: Number of nearest groups kept per node
+   :param cutoff: Travel time limit (minutes)
+   :param travDir: Travel direction ("TO_FACILITIES" or "FROM_FACILITIES")
+   :param matrix: Pre-built matrix from graphMatrix or sourceMatrix (optional)
+   :param delta: Width (minutes) of the travel time buckets. Default is the median edge time.
+   :return: tuple of (time, facility) arrays (nodes x k), sorted by time. Time is inf and facility is -1 where fewer
+      than k groups are within the cutoff.
+   '''
+   if matrix is None:
+      matrix = graphMatrix(graph, travDir)
+   matrix = matrix.tocsr()
+   n = len(graph['xy'])
+   nn = matrix.shape[0]
+   node = numpy.asarray(node)
+   group = numpy.arange(len(node)) if group is None else numpy.asarray(group)
+   gcode = numpy.unique(group, return_inverse=True)[1].astype('int32')
+   ngroups = int(gcode.max(initial=0)) + 1
+   if delta is None:
+      delta = max(float(numpy.median(matrix.data)), 1e-6) if matrix.nnz > 0 else 1.0
+   # Labels of every matrix node: time, group, facility, and whether the label has been propagated
+   T = numpy.full((nn, k), numpy.inf)
+   G = numpy.full((nn, k), -1, dtype='int32')
+   F = numpy.full((nn, k), -1, dtype='int32')
+   P = numpy.ones((nn, k), dtype=bool)
+   # Lowest time of a label not yet propagated, by node
+   dirty = numpy.full(nn, numpy.inf)
+
+   def merge(v, t, g, f):
+      # Merge candidate labels into the labels of their nodes: best time per (node, group), then the k best groups
+      tgt = numpy.unique(v)
+      v = numpy.concatenate([numpy.repeat(tgt, k), v])
+      t = numpy.concatenate([T[tgt].ravel(), t])
+      g = numpy.concatenate([G[tgt].ravel(), g])
+      f = numpy.concatenate([F[tgt].ravel(), f])
+      p = numpy.concatenate([P[tgt].ravel(), numpy.zeros(len(t) - len(tgt) * k, dtype=bool)])
+      live = numpy.isfinite(t)
+      v, t, g, f, p = v[live], t[live], g[live], f[live], p[live]
+      # Sorts are stable and existing labels come first, so existing labels win ties (and are not propagated again)
+      key = v.astype('int64') * (ngroups + 1) + g
+      o = numpy.lexsort((t, key))
+      v, t, g, f, p, key = v[o], t[o], g[o], f[o], p[o], key[o]
+      first = numpy.ones(len(v), dtype=bool)
+      first[1:] = key[1:] != key[:-1]
+      v, t, g, f, p = v[first], t[first], g[first], f[first], p[first]
+      o = numpy.lexsort((t, v))
+      v, t, g, f, p = v[o], t[o], g[o], f[o], p[o]
+      start = numpy.ones(len(v), dtype=bool)
+      start[1:] = v[1:] != v[:-1]
+      idx = numpy.arange(len(v))
+      rank = idx - numpy.maximum.accumulate(numpy.where(start, idx, 0))
+      top = rank < k
+      v, t, g, f, p, rank = v[top], t[top], g[top], f[top], p[top], rank[top]
+      T[tgt], G[tgt], F[tgt], P[tgt] = numpy.inf, -1, -1, True
+      T[v, rank], G[v, rank], F[v, rank], P[v, rank] = t, g, f, p
+      dirty[tgt] = numpy.inf
+      numpy.minimum.at(dirty, v[~p], t[~p])
+
+   ok = numpy.flatnonzero(node >= 0)
+   if len(ok) > 0:
+      merge(node[ok], numpy.zeros(len(ok)), gcode[ok], ok.astype('int32'))
+   bound = delta
+   while True:
+      fr = numpy.flatnonzero(dirty < bound)
+      if len(fr) == 0:
+         m = dirty.min()
+         if not numpy.isfinite(m):
+            break
+         bound = (numpy.floor(m / delta) + 1) * delta
+         continue
+      # Propagate the new labels of the frontier nodes along their edges
+      r, j = numpy.nonzero(~P[fr])
+      u = fr[r]
+      t, g, f = T[u, j], G[u, j], F[u, j]
+      P[u, j] = True
+      dirty[fr] = numpy.inf
+      cnt = matrix.indptr[u + 1] - matrix.indptr[u]
+      e = numpy.repeat(matrix.indptr[u], cnt) + numpy.arange(cnt.sum()) - numpy.repeat(numpy.cumsum(cnt) - cnt, cnt)
+      v = matrix.indices[e]
+      tv = numpy.repeat(t, cnt) + matrix.data[e]
+      # Candidates no better than a node's k-th label cannot enter its labels
+      keep = (tv <= cutoff) & (tv < T[v, k - 1])
+      if keep.any():
+         merge(v[keep], tv[keep], numpy.repeat(g, cnt)[keep], numpy.repeat(f, cnt)[keep])
+   return T[:n], F[:n]
+
+
+def buildNearestIndex(graph, node, path, k=8, cutoff=numpy.inf, travDir="TO_FACILITIES", attributes=None,
+                      group=None, loc=None, matrix=None):
+   '''
+   Build an on-disk index of the k nearest facility groups of each node, from one k-label search (see
+   solveNearestGroups). The index is a folder of NumPy files:
+      - time.npy: travel time (minutes) to the k nearest groups (nodes x k, sorted; inf = none within cutoff)
+      - facility.npy: facility index (row of facilities.npy) of the nearest facility of each of the k nearest groups
+         (nodes x k; -1 = none)
+      - facilities.npy: facility table (node, group, location if given, plus any attributes)
+      - meta.json: parameters
+   :param graph: graph dictionary
+   :param node: Source node for each facility, from snapToNodes or sourceMatrix (-1 = not located)
+   :param path: Output folder
+   :param k: Number of nearest groups to store per node
+   :param cutoff: Travel time limit (minutes)
+   :param travDir: Travel direction ("TO_FACILITIES" or "FROM_FACILITIES")
+   :param attributes: Structured array of facility attributes to store with the index (e.g. OBJECTID, acres)
+   :param group: Facility group (integer) for each facility (e.g. park ID). Default is one group per facility.
+   :param loc: Facility locations used for node (see snapToEdges). If given, they are stored so that nodes the index
+      cannot answer can be re-solved (see queryNearestIndex).
+   :param matrix: Pre-built matrix from graphMatrix or sourceMatrix (optional)
+   :return: path
+   '''
+   if not os.path.exists(path):
+      os.makedirs(path)
+   node = numpy.asarray(node)
+   group = numpy.arange(len(node)) if group is None else numpy.asarray(group)
+   time, facility = solveNearestGroups(graph, node, group, k, cutoff, travDir, matrix)
+   n = len(time)
+   tm = numpy.lib.format.open_memmap(os.path.join(path, 'time.npy'), mode='w+', dtype='float32', shape=(n, k))
+   fc = numpy.lib.format.open_memmap(os.path.join(path, 'facility.npy'), mode='w+', dtype='int32', shape=(n, k))
+   tm[:] = time
+   fc[:] = facility
+   tm.flush()
+   fc.flush()
+   dt = [('node', 'int64'), ('group', 'int64')] + ([] if loc is None else [('seg', 'int64'), ('frac', 'float64')])
+   fac = numpy.zeros(len(node), dtype=dt)
+   fac['node'], fac['group'] = node, group
+   if loc is not None:
+      fac['seg'], fac['frac'] = loc['seg'], loc['frac']
+   if attributes is not None:
+      from numpy.lib import recfunctions
+      fac = recfunctions.merge_arrays([fac, attributes], flatten=True, usemask=False)
+   numpy.save(os.path.join(path, 'facilities.npy'), fac)
+   with open(os.path.join(path, 'meta.json'), 'w') as f:
+      json.dump({'k': k, 'cutoff': float(cutoff), 'travDir': travDir, 'nodes': n}, f)
+   return path
+
+
+def loadNearestIndex(path):
+   '''
+   Load a nearest facility index (see buildNearestIndex). Node arrays are memory-mapped, not read into memory.
+   :param path: Index folder
+   :return: index dictionary, with keys time, facility, facilities, and the parameters in meta.json
+   '''
+   with open(os.path.join(path, 'meta.json')) as f:
+      index = json.load(f)
+   index['time'] = numpy.load(os.path.join(path, 'time.npy'), mmap_mode='r')
+   index['facility'] = numpy.load(os.path.join(path, 'facility.npy'), mmap_mode='r')
+   index['facilities'] = numpy.load(os.path.join(path, 'facilities.npy'))
+   return index
+
+
+def queryNearestIndex(index, keep, chunk=1000000, graph=None):
+   '''
+   Travel time to the nearest facility in a subset of the indexed facilities. A node is answered by the first of its
+   nearest groups with a selected facility, if that group's nearest facility is selected. Nodes are unresolved when
+   their k nearest groups have no selected facility (the nearest selected facility is not in the index), or when the
+   first group with selected facilities has its nearest facility not selected.
+   :param index: index dictionary (see loadNearestIndex)
+   :param keep: Boolean array (one per indexed facility) for the facilities to include
+   :param chunk: Number of nodes processed at once
+   :param graph: graph dictionary used to build the index. If given (and the index stores facility locations),
+      unresolved nodes are re-solved exactly with solveNearest on the selected facilities.
+   :return: tuple of (minutes, facility, unresolved) arrays. Minutes are inf where no included facility is within the
+      cutoff. Unresolved nodes have minutes = nan, unless they were re-solved.
+   '''
+   keep = numpy.asarray(keep, dtype=bool)
+   fac = index['facilities']
+   gcode = numpy.unique(fac['group'], return_inverse=True)[1]
+   nkeep = numpy.bincount(gcode, weights=keep, minlength=gcode.max(initial=-1) + 1)
+   partial = ((nkeep > 0) & (nkeep < numpy.bincount(gcode)))[gcode]
+   # Label state by facility: 1 = selected (answers the node), 2 = group partly selected but its nearest facility is
+   # not (unresolved), 0 = group not selected (skipped). Facility -1 is never selected.
+   state = numpy.append(numpy.where(keep, 1, numpy.where(partial, 2, 0)), 0).astype('int8')
+   n, k = index['time'].shape
+   minutes = numpy.full(n, numpy.inf, dtype='float32')
+   facility = numpy.full(n, -1, dtype='int32')
+   unresolved = numpy.zeros(n, dtype=bool)
+   for c in range(0, n, chunk):
+      tm = numpy.asarray(index['time'][c:c + chunk])
+      fc = numpy.asarray(index['facility'][c:c + chunk])
+      st = state[fc]
+      hit = st > 0
+      first = hit.argmax(axis=1)
+      found = hit.any(axis=1)
+      rows = numpy.arange(len(tm))
+      answer = found & (st[rows, first] == 1)
+      minutes[c:c + chunk] = numpy.where(answer, tm[rows, first], numpy.inf)
+      facility[c:c + chunk] = numpy.where(answer, fc[rows, first], -1)
+      unresolved[c:c + chunk] = (found & ~answer) | (~found & numpy.isfinite(tm[:, -1]))
+   minutes[unresolved] = numpy.nan
+   if graph is not None and unresolved.any() and 'seg' in fac.dtype.names:
+      print('Re-solving ' + str(unresolved.sum()) + ' nodes not answered by the index...')
+      loc = {'seg': numpy.where(keep, fac['seg'], -1), 'frac': fac['frac']}
+      matrix, node = sourceMatrix(graph, loc, index['travDir'])
+      d, src = solveNearest(graph, node, index['cutoff'], index['travDir'], matrix)
+      n0 = len(graph['xy'])
+      minutes[unresolved] = d[unresolved]
+      facility[unresolved] = numpy.where(src[unresolved] >= 0, src[unresolved] - n0, -1)
+   return minutes, facility, unresolved
+
+
+def buildODMatrix(graph, loc, node, path, cutoff, travDir="TO_FACILITIES", cells=None, facilities=None,
+                  batch_size=8, matrix=None, chunk=10000000):
+   '''
+   Build an on-disk origin-destination (OD) matrix of travel times from points (e.g. populated raster cells) to
+   facilities, for all pairs within the cutoff. The matrix is stored in compressed sparse row (CSR) format, with one
+   row per point and one column per facility, in a folder of NumPy files:
+      - indptr.npy, indices.npy, data.npy: CSR arrays (data = travel time in minutes)
+      - cells.npy: point (row) table, if given
+      - facilities.npy: facility (column) table (node, plus any attributes)
+      - meta.json: parameters
+   A point's travel time is through either end of the segment it is located on (as in segmentSamples). Pairs are
+   written to temporary files as facilities are solved, then sorted into rows in chunks, so memory use does not
+   depend on the size of the matrix.
+   :param graph: graph dictionary
+   :param loc: location dictionary for the points (see snapToEdges, with locate=False)
+   :param node: Source node for each facility, from snapToNodes or sourceMatrix (-1 = not located)
+   :param path: Output folder
+   :param cutoff: Travel time limit (minutes)
+   :param travDir: Travel direction ("TO_FACILITIES" or "FROM_FACILITIES")
+   :param cells: Structured array of point attributes (e.g. raster row, column, population)
+   :param facilities: Structured array of facility attributes (e.g. OBJECTID, acres)
+   :param batch_size: Number of facilities solved at once
+   :param matrix: Pre-built matrix from sourceMatrix (optional)
+   :param chunk: Number of pairs sorted at once
+   :return: path
+   '''
+   if matrix is None:
+      matrix = graphMatrix(graph, travDir)
+   if not os.path.exists(path):
+      os.makedirs(path)
+   n = len(graph['xy'])
+   node = numpy.asarray(node)
+   npt = len(loc['seg'])
+   # Points by segment end, with the time from the point to that end
+   pt = numpy.flatnonzero(loc['seg'] >= 0)
+   seg, frac = loc['seg'][pt], loc['frac'][pt]
+   if travDir == "TO_FACILITIES":
+      t_to_v, t_to_u = graph['seg_tf'][seg], graph['seg_tb'][seg]
+   else:
+      t_to_v, t_to_u = graph['seg_tb'][seg], graph['seg_tf'][seg]
+   end_node = numpy.concatenate([graph['seg_u'][seg], graph['seg_v'][seg]])
+   end_time = numpy.concatenate([frac * t_to_u, (1 - frac) * t_to_v])
+   end_pt = numpy.concatenate([pt, pt])
+   o = numpy.argsort(end_node, kind='stable')
+   end_node, end_time, end_pt = end_node[o], end_time[o], end_pt[o]
+   end_start = numpy.searchsorted(end_node, numpy.arange(n + 1))
+
+   # Solve facilities in batches, writing (point, facility, time) pairs
+   tmp = [os.path.join(path, 'tmp_' + a + '.bin') for a in ['pt', 'fac', 'time']]
+   files = [open(f, 'wb') for f in tmp]
+   nnz = 0
+   counts = numpy.zeros(npt, dtype='int64')
+   fid = numpy.flatnonzero(node >= 0)
+   for b in range(0, len(fid), batch_size):
+      ids = fid[b:b + batch_size]
+      d = csgraph.dijkstra(matrix, directed=True, indices=node[ids], limit=cutoff)[:, :n]
+      for f, df in zip(ids, d):
+         reached = numpy.flatnonzero(numpy.isfinite(df))
+         # Segment ends at reached nodes
+         cnt = end_start[reached + 1] - end_start[reached]
+         e = numpy.repeat(end_start[reached] - numpy.cumsum(cnt) + cnt, cnt) + numpy.arange(cnt.sum())
+         t = df[end_node[e]] + end_time[e]
+         p = end_pt[e]
+         # Fastest of the two ends of a point's segment
+         o = numpy.lexsort((t, p))
+         p, t = p[o], t[o]
+         first = numpy.ones(len(p), dtype=bool)
+         first[1:] = p[1:] != p[:-1]
+         keep = first & (t <= cutoff)
+         p, t = p[keep], t[keep]
+         files[0].write(p.astype('int64').tobytes())
+         files[1].write(numpy.full(len(p), f, dtype='int64').tobytes())
+         files[2].write(t.astype('float32').tobytes())
+         counts += numpy.bincount(p, minlength=npt)
+         nnz += len(p)
+   [f.close() for f in files]
+
+   # Sort pairs into rows (counting sort, in chunks)
+   idx_type = 'int32' if max(nnz, len(node)) < 2 ** 31 else 'int64'
+   indptr = numpy.zeros(npt + 1, dtype=idx_type)
+   indptr[1:] = numpy.cumsum(counts)
+   numpy.save(os.path.join(path, 'indptr.npy'), indptr)
+   indices = numpy.lib.format.open_memmap(os.path.join(path, 'indices.npy'), mode='w+', dtype=idx_type, shape=(nnz,))
+   data = numpy.lib.format.open_memmap(os.path.join(path, 'data.npy'), mode='w+', dtype='float32', shape=(nnz,))
+   p_all = numpy.memmap(tmp[0], dtype='int64', mode='r', shape=(nnz,)) if nnz > 0 else numpy.zeros(0, dtype='int64')
+   f_all = numpy.memmap(tmp[1], dtype='int64', mode='r', shape=(nnz,)) if nnz > 0 else numpy.zeros(0, dtype='int64')
+   t_all = numpy.memmap(tmp[2], dtype='float32', mode='r', shape=(nnz,)) if nnz > 0 else numpy.zeros(0, 'float32')
+   nxt = indptr[:-1].astype('int64')
+   for c in range(0, nnz, chunk):
+      p = numpy.asarray(p_all[c:c + chunk])
+      o = numpy.argsort(p, kind='stable')
+      p = p[o]
+      rows, start, cnt = numpy.unique(p, return_index=True, return_counts=True)
+      pos = nxt[p] + numpy.arange(len(p)) - numpy.repeat(start, cnt)
+      indices[pos] = numpy.asarray(f_all[c:c + chunk])[o]
+      data[pos] = numpy.asarray(t_all[c:c + chunk])[o]
+      nxt[rows] += cnt
+   indices.flush()
+   data.flush()
+   del p_all, f_all, t_all
+   [os.remove(f) for f in tmp]
+
+   if cells is not None:
+      numpy.save(os.path.join(path, 'cells.npy'), cells)
+   fac = numpy.zeros(len(node), dtype=[('node', 'int64')])
+   fac['node'] = node
+   if facilities is not None:
+      from numpy.lib import recfunctions
+      fac = recfunctions.merge_arrays([fac, facilities], flatten=True, usemask=False)
+   numpy.save(os.path.join(path, 'facilities.npy'), fac)
+   with open(os.path.join(path, 'meta.json'), 'w') as f:
+      json.dump({'cutoff': float(cutoff), 'travDir': travDir, 'shape': [npt, len(node)], 'nnz': int(nnz)}, f)
+   return path
+
+
+def loadODMatrix(path):
+   '''
+   Load an OD matrix (see buildODMatrix). The CSR arrays are memory-mapped, not read into memory.
+   :param path: OD matrix folder
+   :return: OD dictionary, with keys matrix (scipy.sparse.csr_matrix of travel times), cells (if stored),
+      facilities, and the parameters in meta.json
+   '''
+   with open(os.path.join(path, 'meta.json')) as f:
+      od = json.load(f)
+   arrs = [numpy.load(os.path.join(path, a + '.npy'), mmap_mode='r') for a in ['data', 'indices', 'indptr']]
+   od['matrix'] = sparse.csr_matrix(tuple(arrs), shape=tuple(od['shape']), copy=False)
+   if os.path.exists(os.path.join(path, 'cells.npy')):
+      od['cells'] = numpy.load(os.path.join(path, 'cells.npy'))
+   od['facilities'] = numpy.load(os.path.join(path, 'facilities.npy'))
+   return od
+
+
+def iterODRows(od, keep=None, chunk=1000000):
+   '''
+   Iterate over an OD matrix in chunks of rows, as (point, facility, minutes) arrays of the pairs in the chunk.
+   :param od: OD dictionary (see loadODMatrix)
+   :param keep: Boolean array (one per facility) for the facilities to include (default all)
+   :param chunk: Number of rows per chunk
+   :return: generator of (row0, row1, point, facility, minutes) tuples
+   '''
+   m = od['matrix']
+   for r0 in range(0, m.shape[0], chunk):
+      r1 = min(r0 + chunk, m.shape[0])
+      a, b = m.indptr[r0], m.indptr[r1]
+      pt = numpy.repeat(numpy.arange(r0, r1), numpy.diff(m.indptr[r0:r1 + 1]))
+      fac = numpy.asarray(m.indices[a:b])
+      tm = numpy.asarray(m.data[a:b])
+      if keep is not None:
+         ok = numpy.asarray(keep, dtype=bool)[fac]
+         pt, fac, tm = pt[ok], fac[ok], tm[ok]
+      yield r0, r1, pt, fac, tm
+
+
+def odNearest(od, keep=None, chunk=1000000):
+   '''
+   Travel time to the nearest facility for each point of an OD matrix (a row-wise minimum).
+   :param od: OD dictionary (see loadODMatrix)
+   :param keep: Boolean array (one per facility) for the facilities to include (default all)
+   :param chunk: Number of rows processed at once
+   :return: tuple of (minutes, facility) arrays. Points with no facility within the cutoff have minutes = inf,
+      facility = -1.
+   '''
+   n = od['matrix'].shape[0]
+   minutes = numpy.full(n, numpy.inf, dtype='float32')
+   facility = numpy.full(n, -1, dtype='int64')
+   for r0, r1, pt, fac, tm in iterODRows(od, keep, chunk):
+      o = numpy.lexsort((fac, tm, pt))
+      pt, fac, tm = pt[o], fac[o], tm[o]
+      first = numpy.ones(len(pt), dtype=bool)
+      first[1:] = pt[1:] != pt[:-1]
+      minutes[pt[first]] = tm[first]
+      facility[pt[first]] = fac[first]
+   return minutes, facility
+
+
+def odCount(od, minutes, keep=None, weights=None, chunk=1000000):
+   '''
+   Count the facilities within a travel time of each point of an OD matrix (or sum facility weights, e.g. acres).
+   :param od: OD dictionary (see loadODMatrix)
+   :param minutes: Travel time limit (minutes), no more than the matrix's cutoff
+   :param keep: Boolean array (one per facility) for the facilities to include (default all)
+   :param weights: Weight for each facility (default 1)
+   :param chunk: Number of rows processed at once
+   :return: count (or sum) array (one per point)
+   '''
+   if minutes > od['cutoff']:
+      raise ValueError('Minutes (' + str(minutes) + ') is greater than the OD matrix cutoff (' + str(od['cutoff']) +
+                       ').')
+   n = od['matrix'].shape[0]
+   out = numpy.zeros(n, dtype='float64' if weights is not None else 'int32')
+   for r0, r1, pt, fac, tm in iterODRows(od, keep, chunk):
+      ok = tm <= minutes
+      w = None if weights is None else numpy.asarray(weights)[fac[ok]]
+      out[r0:r1] += numpy.bincount(pt[ok] - r0, weights=w, minlength=r1 - r0).astype(out.dtype)
+   return out
+
+
+def odCatchment(od, group, keep=None, nodata=-1, chunk=1000000):
+   '''
+   Label each point of an OD matrix with the facility group of its nearest facility (catchments).
+   :param od: OD dictionary (see loadODMatrix)
+   :param group: Facility group for each facility
+   :param keep: Boolean array (one per facility) for the facilities to include (default all)
+   :param nodata: Label for points with no facility within the cutoff
+   :return: label array (one per point)
+   '''
+   minutes, facility = odNearest(od, keep, chunk)
+   group = numpy.asarray(group)
+   lab = numpy.full(len(facility), nodata, dtype=group.dtype)
+   lab[facility >= 0] = group[facility[facility >= 0]]
+   return lab
+
+
+def odGroups(od, group, keep=None, chunk=1000000):
+   '''
+   Combine the facility columns of an OD matrix by facility group, with the travel time to the nearest facility of
+   each group (e.g. the access points of a park).
+   :param od: OD dictionary (see loadODMatrix)
+   :param group: Facility group for each facility
+   :param keep: Boolean array (one per facility) for the facilities to include (default all)
+   :param chunk: Number of rows processed at once
+   :return: tuple of (groups, matrix), where matrix is a scipy.sparse.csr_matrix (points x groups) of travel times
+   '''
+   grp, gi = numpy.unique(numpy.asarray(group), return_inverse=True)
+   n = od['matrix'].shape[0]
+   pts, cols, tms = [], [], []
+   for r0, r1, pt, fac, tm in iterODRows(od, keep, chunk):
+      g = gi[fac]
+      o = numpy.lexsort((tm, g, pt))
+      pt, g, tm = pt[o], g[o], tm[o]
+      first = numpy.ones(len(pt), dtype=bool)
+      first[1:] = (pt[1:] != pt[:-1]) | (g[1:] != g[:-1])
+      pts.append(pt[first])
+      cols.append(g[first])
+      tms.append(tm[first])
+   pt, g, tm = [numpy.concatenate(a) for a in [pts, cols, tms]]
+   # Rows are in order, so the CSR arrays can be built directly
+   indptr = numpy.zeros(n + 1, dtype='int64')
+   indptr[1:] = numpy.cumsum(numpy.bincount(pt, minlength=n))
+   return grp, sparse.csr_matrix((tm, g, indptr), shape=(n, len(grp)))
+
+
+def decayWeights(minutes, decay=e2sfca_weights):
+   '''
+   Distance decay weights for travel times.
+   :param minutes: Travel times (minutes)
+   :param decay: List of [upper, weight] steps (times up to and including upper get weight; times beyond the last
+      step get 0), or a function of travel time (e.g. a Gaussian)
+   :return: weight array
+   '''
+   minutes = numpy.asarray(minutes)
+   if callable(decay):
+      return decay(minutes)
+   upper = numpy.array([d[0] for d in decay], dtype='float64')
+   weight = numpy.append(numpy.array([d[1] for d in decay], dtype='float64'), 0)
+   return weight[numpy.searchsorted(upper, minutes, side='left')]
+
+
+def floatingCatchment(times, supply, demand, decay=e2sfca_weights):
+   '''
+   Enhanced two-step floating catchment (E2SFCA) accessibility, as two sparse matrix-vector products over a travel time
+   matrix. Step 1 divides each facility's supply by the decay-weighted demand (population) reaching it, giving a
+   supply-to-demand ratio R_j = S_j / sum_k(W_kj * D_k). Step 2 sums these ratios, weighted by decay, over the
+   facilities reaching each point: A_i = sum_j(W_ij * R_j), the supply accessible per person at the point. With hard
+   catchments (weight 1 for the catchment's facility, 0 otherwise), 1 / A_i is the catchment's population per unit of
+   supply, as in Helper.servCatPressure.
+   :param times: Travel time matrix (scipy.sparse.csr_matrix, points x facilities), e.g. from loadODMatrix or odGroups
+   :param supply: Supply for each facility (e.g. acres, plus any adjustment). Must be > 0.
+   :param demand: Demand for each point (e.g. population)
+   :param decay: Distance decay (see decayWeights)
+   :return: tuple of (point accessibility A_i, facility ratio R_j) arrays. Points reaching no facility have
+      accessibility 0, and facilities reached by no demand have ratio 0.
+   '''
+   # Weights share the travel time matrix's structure (no copy of the indices)
+   w = decayWeights(times.data, decay).astype('float64')
+   wm = sparse.csr_matrix((w, times.indices, times.indptr), shape=times.shape, copy=False)
+   fac_demand = wm.T @ numpy.asarray(demand, dtype='float64')
+   supply = numpy.asarray(supply, dtype='float64')
+   fac_ratio = numpy.divide(supply, fac_demand, out=numpy.zeros(len(supply)), where=fac_demand > 0)
+   return wm @ fac_ratio, fac_ratio
+
+
+def nodeLabels(src, node, group, nodata=-1):
+   '''
+   Label nodes with the facility group of their nearest source (i.e. a network Voronoi partition).
+   :param src: Nearest source node for each graph node, from solveNearest (-1 = unreached)
+   :param node: Source node for each facility, from snapToNodes or sourceMatrix (-1 = not located)
+   :param group: Facility group for each facility. Where facilities from different groups share a node, the lowest
+      group value is used.
+   :param nodata: Label for unreached nodes
+   :return: label array (one per graph node)
+   '''
+   node = numpy.asarray(node)
+   group = numpy.asarray(group)
+   ok = node >= 0
+   o = numpy.lexsort((group[ok], node[ok]))
+   n, g = node[ok][o], group[ok][o]
+   first = numpy.ones(len(n), dtype=bool)
+   first[1:] = n[1:] != n[:-1]
+   n, g = n[first], g[first]
+   lab = numpy.full(len(src), nodata, dtype=g.dtype if len(g) > 0 else 'int64')
+   reached = src >= 0
+   lab[reached] = g[numpy.searchsorted(n, src[reached])]
+   return lab
+
+
+def segmentSamples(graph, values, spacing, cutoff=numpy.inf, travDir="TO_FACILITIES", labels=None):
+   '''
+   Sample points along segments at a fixed spacing, with node values interpolated along the segment. For travel
+   times, the value at a point is the fastest time through either end of the segment.
+   :param graph: graph dictionary
+   :param values: Node values (e.g. minutes from solveNearest; inf = unreached)
+   :param spacing: Maximum distance between sample points (map units)
+   :param cutoff: Samples with values above this are dropped
+   :param travDir: Travel direction used to solve values
+   :param labels: Node labels (e.g. facility group of the nearest source). If given, each sample gets the label of
+      the segment end it is fastest through.
+   :return: tuple of (xy, value) arrays for sample points, or (xy, value, label) if labels are given
+   '''
+   u, v = graph['seg_u'], graph['seg_v']
+   # Time to travel from a point on the segment to each end
+   if travDir == "TO_FACILITIES":
+      t_to_v, t_to_u = graph['seg_tf'], graph['seg_tb']
+   else:
+      t_to_v, t_to_u = graph['seg_tb'], graph['seg_tf']
+   reach = numpy.isfinite(values[u]) | numpy.isfinite(values[v])
+   u, v, t_to_v, t_to_u = u[reach], v[reach], t_to_v[reach], t_to_u[reach]
+   xy_u, xy_v = graph['xy'][u], graph['xy'][v]
+   n = numpy.maximum(numpy.ceil(numpy.hypot(*(xy_v - xy_u).T) / spacing).astype('int64'), 1) + 1
+   seg = numpy.repeat(numpy.arange(len(u)), n)
+   start = numpy.cumsum(n) - n
+   frac = (numpy.arange(n.sum()) - start[seg]) / (n[seg] - 1)
+   xy = xy_u[seg] + (xy_v[seg] - xy_u[seg]) * frac[:, None]
+   val_u = values[u[seg]] + frac * t_to_u[seg]
+   val_v = values[v[seg]] + (1 - frac) * t_to_v[seg]
+   val = numpy.minimum(val_u, val_v)
+   keep = val <= cutoff
+   if labels is None:
+      return xy[keep], val[keep]
+   lab = numpy.where(val_u <= val_v, labels[u[seg]], labels[v[seg]])
+   return xy[keep], val[keep], lab[keep]
+
+
+def graphToGrid(samples, grid, window, trim, nodata=numpy.nan, dtype='float32'):
+   '''
+   Transfer sample point values to raster cells. Each cell within `trim` distance of a sample point (i.e. a reached
+   road) gets the value of the nearest sample point (comparable to a service area polygon trim distance).
+   :param samples: tuple of (xy, value) arrays, e.g. from segmentSamples
+   :param grid: Grid dictionary (see rasterBlocks.gridInfo)
+   :param window: Window (row0, row1, col0, col1) of the grid to fill
+   :param trim: Trim distance (meters, or a linear unit string)
+   :param nodata: Value for cells beyond the trim distance
+   :param dtype: Output data type
+   :return: array of cell values for the window
+   '''
+   trim = linearUnit(trim)
+   xy, val = samples[:2]
+   r0, r1, c0, c1 = window
+   cx = grid['xmin'] + (numpy.arange(c0, c1) + 0.5) * grid['cell']
+   cy = grid['ymax'] - (numpy.arange(r0, r1) + 0.5) * grid['cell']
+   out = numpy.full((r1 - r0, c1 - c0), nodata, dtype=dtype)
+   inwin = (xy[:, 0] >= cx[0] - trim) & (xy[:, 0] <= cx[-1] + trim) & (xy[:, 1] <= cy[0] + trim) & \
+           (xy[:, 1] >= cy[-1] - trim)
+   if not inwin.any():
+      return out
+   gx, gy = numpy.meshgrid(cx, cy)
+   d, i = cKDTree(xy[inwin]).query(numpy.column_stack([gx.ravel(), gy.ravel()]), distance_upper_bound=trim)
+   found = numpy.isfinite(d)
+   out.ravel()[found] = val[inwin][i[found]]
+   return out
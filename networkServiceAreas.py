@@ -8,11 +8,29 @@ Network Analyst-based processes for all recreation model analyses. Includes func
    - networkServiceAreas, Service areas by facility group, counting overlaps
    - networkCatchments, Catchments (non-overlapping service areas) by facility group
       - adjustCatchments, which fills in values outside a road mask using Euclidean Distance, and creates a
-         raster-masked and aligned version of the catchments
+         raster-masked and aligned version of the catchments (a label raster with attributes). Polygons are created
+         only on demand (catchmentPolygons).
    - networkTravelToNearest, Travel time to nearest facility
+   - graphServiceAreas, Service area overlap counts by facil_group, solved on the road graph (no polygons)
+   - graphActivityAreas, Count of activity types (e.g. a_wct, a_fsh, a_swm) reachable within service areas, from a
+      single road graph solve with a per-group activity bitmask
+   - graphCatchments, Catchments by facil_group, solved as a network Voronoi partition on the road graph
+   - graphTravelToNearest, Travel time to nearest facility, solved on the NumPy/SciPy road graph (networkGraph.py)
+   - graphNearestIndex, a persistent index of the k nearest facility groups for every road graph node, and
+      indexTravelToNearest, travel time to nearest for any subset of the indexed facilities (no new solve)
+   - graphODMatrix, a persistent sparse matrix of travel times from populated cells to all facilities within a time
+      limit, from which travel time, facility count and catchment metrics are calculated without a new solve
+      (rasterized with odToRaster)
+   - graphFloatingPressure, recreation pressure by the enhanced two-step floating catchment (E2SFCA) method, from the
+      OD matrix
 Recreation Model workflow functions include:
+   - prepFacilities, catchmentAnalysis, floatingPressureAnalysis, travelTimeAnalysis, serviceAreaAnalysis, and
+      activityAnalysis, which are the workflow stages run by main. Stages are checkpointed (see stageCache.py), so
+      re-running main only re-runs stages whose inputs or parameters have changed. Independent stages run in
+      parallel, in isolated scratch workspaces.
    - finalizeLayer, which creates final 'value' layers, filling in values outside a road mask using Euclidean Distance
    - reclassLayer, which creates final 'score' layers, reclassifying 'value' layers into need classes (values 1-5)
+   - scoreLayers, which creates 'score' layers and the composite score layer in a single pass over the 'value' layers
 
 This script includes the full workflow for Recreation Model travel analyses, including creation of sub-component
 scores (by reclassification of original value rasters), and composite score (Recreation Need) layers.
@@ -25,7 +43,10 @@ in the facil_group, note that only one of the facilities' attributes can be join
 - In networkServiceAreas, processing time is greatly increased as minutes limit increases. Solving and counting
 overlaps can be very slow for these cases.
 - In networkTravelToNearest, increasing the number of breaks will greatly increase processing time, especially if the
-upper time limit is high.
+upper time limit is high. graphTravelToNearest solves all facilities at once and outputs continuous travel times, so
+breaks are not needed.
+- main runs either Network Analyst ('NA', the default) or the road graph ('graph') analyses, set with engine. The
+graph engine's results are not yet verified against Network Analyst on the full data, so it is not the default.
 - Tried out exclude_sources_from_polygon_generation=["Roads_Hwy"]. When using this and generating polygons with
 geometry_at_overlap="SPLIT", there are bad errors in some polygons. Because of this, abandoned use of this option.
 
@@ -33,6 +54,9 @@ To run in python command prompt: propy.bat D:\git\ConsVision_RecreationModel\net
 """
 
 from Helper import *
+import networkGraph
+import rasterBlocks
+import stageCache
 arcpy.CheckOutExtension("network")
 
 # Default search criteria for OSM roads.
@@ -40,9 +64,12 @@ arcpy.CheckOutExtension("network")
 # search_query defines the subset of road types where points can be located (default only driveable roads).
 search_att = {
    'search_criteria': [["Roads_Local", "SHAPE"], ["Roads_Hwy", "NONE"], ["Ramp_Points", "NONE"], ["RoadsNet_ND_Junctions", "NONE"]],
-   'search_query': [["Roads_Local", '"code" IN (5112, 5113, 5114, 5115, 5121, 5122, 5123, 5132, 5133, 5134, 5135, 5141, 5142, 5143, 5144, 5145, 5146, 5147)']]
+   'search_query': [["Roads_Local", '"code" IN (' + ', '.join(str(c) for c in networkGraph.locate_codes) + ')']]
 }
 
+# Road graphs loaded in this session, by path (see getGraph)
+_graphs = {}
+
 
 def networkServiceAreas(net, facil, facil_group, outSA, joinatt=['src_table', 'src_name', 'join_name', 'accgreen_acres'],
                         minutes=[30], poly_trim="0.3 Miles", dist_from_roads="1 Mile",
@@ -103,6 +130,186 @@ def networkServiceAreas(net, facil, facil_group, outSA, joinatt=['src_table', 's
    return outSA
 
 
+def getGraph(graph):
+   '''
+   Get a road graph dictionary. If graph is the path to a saved graph (see networkGraph.saveGraph), it is loaded once
+   per session.
+   '''
+   if isinstance(graph, str):
+      if graph not in _graphs:
+         _graphs[graph] = networkGraph.loadGraph(graph)
+      return _graphs[graph]
+   else:
+      return graph
+
+
+def graphLocate(graph, facil, fields=[], dist_from_roads="1 Mile", snap_cache=None, travDir="TO_FACILITIES",
+                facil_group=None, coalesce_dist=None, null_value=None):
+   '''
+   Locate facilities on the road graph (nearest segment where facilities can be located; see search_att), and add
+   them to the graph's travel time matrix as source nodes.
+   :param graph: Road graph
+   :param facil: Facilities (points)
+   :param fields: Facility attributes to read
+   :param dist_from_roads: Search distance limit for starting point from facilities to roads
+   :param snap_cache: Cache file (.npz) for facility locations, shared by all analyses
+   :param facil_group: Facility grouping field name, used for coalescing. If None, all facilities are one group.
+   :param coalesce_dist: If given, facilities in the same group located on the same node, or on the same segment
+      within this distance, are coalesced into one source (see networkGraph.coalesceLocations).
+   :param null_value: Value to use for null attributes
+   :return: tuple of (attributes, matrix, source node for each facility). Coalesced facilities share a source node.
+   '''
+   print('Locating facilities at ' + Hms() + '...')
+   xy, att = networkGraph.readPoints(facil, graph, fields, null_value)
+   loc = networkGraph.locateFacilities(graph, xy, dist_from_roads, snap_cache)
+   if coalesce_dist is None:
+      return (att,) + networkGraph.sourceMatrix(graph, loc, travDir)
+   group = None if facil_group is None else att[facil_group]
+   rep = networkGraph.coalesceLocations(graph, loc, group, coalesce_dist)
+   located = rep >= 0
+   print('Coalesced ' + str(located.sum()) + ' located facilities to ' + str(len(numpy.unique(rep[located]))) +
+         ' sources.')
+   # Only representatives become source nodes; other facilities use their representative's node
+   loc = dict(loc, seg=numpy.where(rep == numpy.arange(len(rep)), loc['seg'], -1))
+   matrix, node = networkGraph.sourceMatrix(graph, loc, travDir)
+   node = numpy.where(located, node[rep], -1)
+   return att, matrix, node
+
+
+def graphToRaster(graph, times, out, rastTemplate, poly_trim="0.3 Miles", minutes=numpy.inf, travDir="TO_FACILITIES",
+                  labels=None, nodata=None):
+   '''
+   Rasterize node travel times (or labels) from the road graph to the raster template grid. Cells within poly_trim of
+   a road reached within the minutes limit get the value of the nearest point along the road.
+   :param graph: Road graph
+   :param times: Node travel times (minutes)
+   :param out: Output raster
+   :param rastTemplate: Raster template
+   :param poly_trim: Trim distance (equivalent to a buffer around roads)
+   :param minutes: Travel time limit (minutes)
+   :param labels: Integer node labels to rasterize instead of travel times (e.g. catchment group, counts)
+   :param nodata: Value for cells outside of poly_trim (default NoData)
+   :return: out
+   '''
+   grid = rasterBlocks.gridInfo(rastTemplate)
+   if labels is None:
+      samples = networkGraph.segmentSamples(graph, times, grid['cell'], minutes, travDir)
+      dtype = 'float32'
+      if nodata is None:
+         nodata = numpy.nan
+   else:
+      samples = networkGraph.segmentSamples(graph, times, grid['cell'], minutes, travDir, labels=labels)
+      samples = (samples[0], samples[2])
+      dtype = 'int32'
+      if nodata is None:
+         nodata = numpy.iinfo('int32').min
+   blocks = ((w, networkGraph.graphToGrid(samples, grid, w, poly_trim, nodata=nodata, dtype=dtype))
+             for w in rasterBlocks.iterWindows(grid))
+   rasterBlocks.writeBlocks(blocks, grid, out, nodata=nodata)
+   return out
+
+
+def graphServiceAreas(graph, facil, facil_group, outSA, minutes=30, poly_trim="0.3 Miles", dist_from_roads="1 Mile",
+                      rastTemplate=None, travDir="TO_FACILITIES", batch_size=8, snap_cache=None,
+                      coalesce_dist="50 Meters", workers=None):
+   '''
+   Count overlapping service areas by facil_group, using the road graph instead of Network Analyst. Each group's
+   reachable nodes are found with a bounded search (in batches of groups) and counted per node, so service area
+   polygons are never created. Outputs the overlap count raster outSA + '_ct'. Cells take the count of the fastest
+   road end within poly_trim, so counts can differ from polygon overlaps near service area edges.
+   :param graph: Road graph (see networkGraph.roadsToGraph), or path to a saved road graph
+   :param facil: Facilities (points)
+   :param facil_group: Facility grouping field name
+   :param outSA: Output base name
+   :param minutes: Minute limit for service areas. If a list is given, the maximum is used.
+   :param poly_trim: Trim distance for rasterizing service areas (equivalent to a buffer around roads)
+   :param dist_from_roads: Search distance limit for starting point from facilities to roads
+   :param snap_cache: Cache file (.npz) for facility locations (see networkGraph.locateFacilities)
+   :param coalesce_dist: Facilities in the same facil_group within this network distance are solved as one source
+   :param workers: If given, solve in spatial tiles with this many parallel processes (see networkGraph.solveTiled)
+   :param rastTemplate: Raster template for overlap raster
+   :param batch_size: Maximum number of sources solved at once
+   :return: outSA + '_ct'
+   '''
+   graph = getGraph(graph)
+   if isinstance(minutes, list):
+      minutes = max(minutes)
+   att, matrix, node = graphLocate(graph, facil, [facil_group], dist_from_roads, snap_cache, travDir, facil_group,
+                                   coalesce_dist)
+   print('Solving service areas at ' + Hms() + '...')
+   if workers:
+      tt, src, counts = networkGraph.solveTiled(graph, matrix, node, minutes, att[facil_group], workers=workers,
+                                                batch_size=batch_size)
+   else:
+      counts = networkGraph.solveGroupCounts(graph, node, att[facil_group], minutes, travDir, batch_size, matrix)
+      tt, src = networkGraph.solveNearest(graph, node, minutes, travDir, matrix)
+   print('Rasterizing overlap counts at ' + Hms() + '...')
+   graphToRaster(graph, tt, 'tmp_rast', rastTemplate, poly_trim, minutes, travDir, labels=counts, nodata=0)
+   with arcpy.EnvManager(snapRaster=rastTemplate, cellSize=rastTemplate, extent=rastTemplate):
+      arcpy.sa.ExtractByMask('tmp_rast', rastTemplate).save(outSA + '_ct')
+   arcpy.BuildPyramids_management(outSA + '_ct')
+   arcpy.Delete_management('tmp_rast')
+
+   return outSA + '_ct'
+
+
+def graphActivityAreas(graph, facil, facil_group, outSA, activities, minutes=30, poly_trim="0.3 Miles",
+                       dist_from_roads="1 Mile", rastTemplate=None, travDir="TO_FACILITIES", batch_size=8,
+                       snap_cache=None, coalesce_dist="50 Meters", workers=None, activity_rasters=False):
+   '''
+   Count the activity types available within service areas, using the road graph. Each facility group gets a bitmask
+   of the activities offered by any of its facilities (activity field = 1), and the bitmasks of all groups reaching a
+   node are combined in a single solve. The bitmask is rasterized once, and the activity count (number of bits set)
+   is output to outSA, with 0 for cells not served (within rastTemplate).
+   :param graph: Road graph (see networkGraph.roadsToGraph), or path to a saved road graph
+   :param facil: Facilities (points)
+   :param facil_group: Facility grouping field name
+   :param outSA: Output activity count raster
+   :param activities: List of activity fields (1 = activity offered at the facility). Maximum of 31.
+   :param minutes: Minute limit for service areas
+   :param poly_trim: Trim distance for rasterizing service areas (equivalent to a buffer around roads)
+   :param dist_from_roads: Search distance limit for starting point from facilities to roads
+   :param rastTemplate: Raster template for output rasters
+   :param batch_size: Maximum number of sources solved at once
+   :param snap_cache: Cache file (.npz) for facility locations (see networkGraph.locateFacilities)
+   :param coalesce_dist: Facilities in the same facil_group within this network distance are solved as one source
+   :param workers: If given, solve in spatial tiles with this many parallel processes (see networkGraph.solveTiled)
+   :param activity_rasters: If True, also output a served (1) / not served (0) raster for each activity, named
+      outSA + '_' + activity
+   :return: outSA
+   '''
+   graph = getGraph(graph)
+   att, matrix, node = graphLocate(graph, facil, [facil_group] + activities, dist_from_roads, snap_cache, travDir,
+                                   facil_group, coalesce_dist, null_value=0)
+   masks = numpy.zeros(len(att), dtype='int32')
+   for i, a in enumerate(activities):
+      masks |= numpy.where(att[a] == 1, 1 << i, 0).astype('int32')
+   # Facilities offering none of the activities are not solved
+   node = numpy.where(masks > 0, node, -1)
+   print('Solving service areas for ' + str(len(activities)) + ' activities at ' + Hms() + '...')
+   if workers:
+      tt, src, bits = networkGraph.solveTiled(graph, matrix, node, minutes, att[facil_group], workers=workers,
+                                              batch_size=batch_size, masks=masks)
+   else:
+      bits = networkGraph.solveGroupMasks(graph, node, att[facil_group], masks, minutes, travDir, batch_size, matrix)
+      tt, src = networkGraph.solveNearest(graph, node, minutes, travDir, matrix)
+   print('Rasterizing activity bitmask at ' + Hms() + '...')
+   graphToRaster(graph, tt, 'tmp_bits', rastTemplate, poly_trim, minutes, travDir, labels=bits, nodata=0)
+   with arcpy.EnvManager(outputCoordinateSystem=rastTemplate, snapRaster=rastTemplate, cellSize=rastTemplate,
+                         extent=rastTemplate, mask=rastTemplate):
+      arcpy.sa.Con(arcpy.sa.IsNull('tmp_bits'), 0, 'tmp_bits').save('tmp_bits0')
+      vals = range(2 ** len(activities))
+      rmv = arcpy.sa.RemapValue([[v, bin(v).count('1')] for v in vals])
+      arcpy.sa.Reclassify('tmp_bits0', 'Value', rmv, "NODATA").save(outSA)
+      if activity_rasters:
+         for i, a in enumerate(activities):
+            arcpy.sa.Con(arcpy.sa.BitwiseAnd('tmp_bits0', 1 << i) > 0, 1, 0).save(outSA + '_' + a)
+   arcpy.BuildPyramids_management(outSA)
+   arcpy.Delete_management(['tmp_bits', 'tmp_bits0'])
+
+   return outSA
+
+
 def networkCatchments(net, facil, facil_group, outSA, boundary, joinatt=['src_table', 'src_name', 'join_name', 'accgreen_acres'],
                       minutes=30, poly_trim="0.3 Miles", dist_from_roads="1 Mile",
                       search_criteria=search_att["search_criteria"], search_query=search_att["search_query"],
@@ -177,6 +384,25 @@ def networkCatchments(net, facil, facil_group, outSA, boundary, joinatt=['src_ta
    else:
       arcpy.CopyFeatures_management(outSA + '_orig', outSA)
 
+   catchmentFields(outSA, facil, facil_group, joinatt)
+
+   # Clean up (all) service area datasets in current GDB
+   ls = arcpy.ListDatasets('ServiceArea*')
+   arcpy.Delete_management(ls)
+   arcpy.Delete_management(['gaps0'])
+
+   return outSA
+
+
+def catchmentFields(outSA, facil, facil_group, joinatt):
+   '''
+   Add the `access` field and focal facility attributes to catchments with a `servCat_<facil_group>` field.
+   :param outSA: Catchments
+   :param facil: Facilities (points)
+   :param facil_group: Facility grouping field name
+   :param joinatt: Attributes from input facilities (facil) to join to catchments, with a 'focal_' prefix
+   :return: outSA
+   '''
    # Add binary access field indicating if a catchment (1) or gap (0)
    arcpy.CalculateField_management(outSA, 'access', "min(max(!servCat_" + facil_group + "!, 0), 1)", field_type="SHORT")
 
@@ -190,11 +416,69 @@ def networkCatchments(net, facil, facil_group, outSA, boundary, joinatt=['src_ta
          arcpy.AlterField_management(outSA, i[0], i[1], clear_field_alias=True)
          if i[1].endswith('_acres'):
             nullToZero(outSA, i[1])
+   return outSA
 
-   # Clean up (all) service area datasets in current GDB
-   ls = arcpy.ListDatasets('ServiceArea*')
-   arcpy.Delete_management(ls)
-   arcpy.Delete_management(['gaps0'])
+
+def graphCatchments(graph, facil, facil_group, outSA, boundary, joinatt=['src_table', 'src_name', 'join_name', 'accgreen_acres'],
+                    minutes=30, poly_trim="0.3 Miles", dist_from_roads="1 Mile", rastTemplate=None,
+                    travDir="TO_FACILITIES", min_gap=100000, snap_cache=None, coalesce_dist="50 Meters",
+                    workers=None, polygons=True):
+   '''
+   Generate non-overlapping service catchments by facil_group, using the road graph instead of Network Analyst. Every
+   node is labelled with its nearest facil_group in a single multi-source solve (a network Voronoi partition), so
+   overlaps never need to be cleaned up. Outputs a catchment label raster (outSA + '_rast') and polygons (outSA).
+   If polygons=False, catchment attributes are added to the label raster's attribute table instead of polygons.
+   :param graph: Road graph (see networkGraph.roadsToGraph), or path to a saved road graph
+   :param facil: Facilities (points)
+   :param facil_group: Facility grouping field name
+   :param outSA: Output catchments base name
+   :param boundary: Feature class boundary (used for filling in gaps in catchments)
+   :param joinatt: Attributes from input facilities (facil) to join to output catchments (outSA)
+   :param minutes: Minute limit for catchments
+   :param poly_trim: Trim distance for rasterizing catchments (equivalent to a buffer around roads)
+   :param dist_from_roads: Search distance limit for starting point from facilities to roads
+   :param snap_cache: Cache file (.npz) for facility locations (see networkGraph.locateFacilities)
+   :param coalesce_dist: Facilities in the same facil_group within this network distance are solved as one source
+   :param workers: If given, solve in spatial tiles with this many parallel processes (see networkGraph.solveTiled)
+   :param rastTemplate: Raster template for the label raster
+   :param min_gap: Gaps smaller than this (square meters) are eliminated (merged with the nearest catchment)
+   :param polygons: Whether to output catchment polygons
+   :return: outSA (or outSA + '_rast', if polygons=False)
+   '''
+   graph = getGraph(graph)
+   att, matrix, node = graphLocate(graph, facil, [facil_group], dist_from_roads, snap_cache, travDir, facil_group,
+                                   coalesce_dist)
+   print('Solving service catchments at ' + Hms() + '...')
+   if workers:
+      tt, src = networkGraph.solveTiled(graph, matrix, node, minutes, workers=workers)[:2]
+   else:
+      tt, src = networkGraph.solveNearest(graph, node, minutes, travDir, matrix)
+   lab = networkGraph.nodeLabels(src, node, att[facil_group].astype('int32'))
+   print('Rasterizing service catchments at ' + Hms() + '...')
+   graphToRaster(graph, tt, 'tmp_lab', rastTemplate, poly_trim, minutes, travDir, labels=lab)
+
+   print('Adding gaps at ' + Hms() + '...')
+   with arcpy.EnvManager(snapRaster=rastTemplate, cellSize=rastTemplate, extent=boundary, mask=boundary):
+      # Gaps are numbered with negative values, by contiguous region
+      gaps = arcpy.sa.RegionGroup(arcpy.sa.Con(arcpy.sa.IsNull('tmp_lab'), 1), "FOUR", "WITHIN", "NO_LINK")
+      cat = arcpy.sa.Con(arcpy.sa.IsNull('tmp_lab'), -gaps, 'tmp_lab')
+      # Eliminate small gaps, by allocating them to the nearest catchment or gap
+      small = arcpy.sa.Lookup(gaps, 'Count') * arcpy.Raster(rastTemplate).meanCellWidth ** 2 < min_gap
+      keep = arcpy.sa.Con(arcpy.sa.IsNull(small), 1, arcpy.sa.SetNull(small, 1))
+      arcpy.sa.Nibble(cat, keep, "DATA_ONLY").save(outSA + '_rast')
+   arcpy.BuildRasterAttributeTable_management(outSA + '_rast', 'OVERWRITE')
+   arcpy.BuildPyramids_management(outSA + '_rast')
+   arcpy.Delete_management(['tmp_lab'])
+
+   if not polygons:
+      arcpy.CalculateField_management(outSA + '_rast', 'servCat_' + facil_group, '!Value!', field_type="LONG")
+      catchmentFields(outSA + '_rast', facil, facil_group, joinatt)
+      return outSA + '_rast'
+
+   print('Converting catchments to polygons at ' + Hms() + '...')
+   arcpy.RasterToPolygon_conversion(outSA + '_rast', outSA, "NO_SIMPLIFY", 'Value', 'MULTIPLE_OUTER_PART')
+   arcpy.AlterField_management(outSA, 'gridcode', 'servCat_' + facil_group, 'Service Catchment ID')
+   catchmentFields(outSA, facil, facil_group, joinatt)
 
    return outSA
 
@@ -250,33 +534,274 @@ def networkTravelToNearest(net, facil, outSA, minutes=list(range(5, 121, 5)),
    return outSA
 
 
-def adjustCatchments(inLayer, rasterize_id, outLayer, roadMask, finalMask):
+def graphTravelToNearest(graph, facil, outSA, minutes=105, poly_trim="0.3 Miles", dist_from_roads="1 Mile",
+                         rastTemplate=None, travDir="TO_FACILITIES", snap_cache=None, coalesce_dist="50 Meters",
+                         workers=None):
+   '''
+   Calculate travel time to nearest facility, using the road graph instead of Network Analyst. All facilities are
+   solved at once, and the output is a continuous travel time (minutes) raster, named outSA + '_rast'.
+   :param graph: Road graph (see networkGraph.roadsToGraph), or path to a saved road graph
+   :param facil: Facilities (points)
+   :param outSA: Output base name
+   :param minutes: Travel time limit (minutes). If a list of breaks is given, the maximum is used.
+   :param poly_trim: Trim distance for rasterizing travel times (equivalent to a buffer around roads)
+   :param dist_from_roads: Search distance limit for starting point from facilities to roads
+   :param snap_cache: Cache file (.npz) for facility locations (see networkGraph.locateFacilities)
+   :param coalesce_dist: Facilities within this network distance are solved as one source
+   :param workers: If given, solve in spatial tiles with this many parallel processes (see networkGraph.solveTiled)
+   :param rastTemplate: Raster template for travel time raster
+   :return: outSA + '_rast'
+   '''
+   graph = getGraph(graph)
+   if isinstance(minutes, list):
+      minutes = max(minutes)
+   att, matrix, node = graphLocate(graph, facil, [], dist_from_roads, snap_cache, travDir, None, coalesce_dist)
+   print('Solving travel time to nearest at ' + Hms() + '...')
+   if workers:
+      tt, src = networkGraph.solveTiled(graph, matrix, node, minutes, workers=workers)[:2]
+   else:
+      tt, src = networkGraph.solveNearest(graph, node, minutes, travDir, matrix)
+   print('Rasterizing travel time at ' + Hms() + '...')
+   graphToRaster(graph, tt, 'tmp_rast', rastTemplate, poly_trim, minutes, travDir)
+   with arcpy.EnvManager(snapRaster=rastTemplate, cellSize=rastTemplate, extent=rastTemplate):
+      arcpy.sa.ExtractByMask('tmp_rast', rastTemplate).save(outSA + '_rast')
+   arcpy.BuildPyramids_management(outSA + '_rast')
+   arcpy.Delete_management('tmp_rast')
+
+   return outSA + '_rast'
+
+
+def graphNearestIndex(graph, facil, path, fields=['accgreen_acres'], k=8, minutes=105, dist_from_roads="1 Mile",
+                      travDir="TO_FACILITIES", snap_cache=None, facil_group=None):
+   '''
+   Build a persistent index of the k nearest facility groups (and travel times) for every road graph node, from one
+   k-label search. Subsets of the facilities (e.g. by acreage thresholds) can then be solved with
+   indexTravelToNearest, without re-solving.
+   :param graph: Road graph (see networkGraph.roadsToGraph), or path to a saved road graph
+   :param facil: Facilities (points), including all facilities of any subset to be queried
+   :param path: Output folder for the index
+   :param fields: Facility attributes to store in the index
+   :param k: Number of nearest facility groups stored per node
+   :param minutes: Travel time limit (minutes)
+   :param dist_from_roads: Search distance limit for starting point from facilities to roads
+   :param snap_cache: Cache file (.npz) for facility locations (see networkGraph.locateFacilities)
+   :param facil_group: Facility grouping field name (e.g. park ID), so that the k nearest are distinct groups rather
+      than access points of the same group. If None, each facility is its own group.
+   :return: path
+   '''
+   graph = getGraph(graph)
+   print('Locating facilities at ' + Hms() + '...')
+   flds = ['OID@'] + fields + ([facil_group] if facil_group and facil_group not in fields else [])
+   xy, att = networkGraph.readPoints(facil, graph, flds)
+   loc = networkGraph.locateFacilities(graph, xy, dist_from_roads, snap_cache)
+   matrix, node = networkGraph.sourceMatrix(graph, loc, travDir)
+   group = None if facil_group is None else numpy.unique(att[facil_group], return_inverse=True)[1]
+   print('Building nearest facility index at ' + Hms() + '...')
+   networkGraph.buildNearestIndex(graph, node, path, k, minutes, travDir, att[['OID@'] + fields], group, loc, matrix)
+   return path
+
+
+def indexTravelToNearest(graph, index, facil, outSA, where_clause=None, poly_trim="0.3 Miles", rastTemplate=None):
+   '''
+   Calculate travel time to nearest facility for a subset of facilities, from a nearest facility index (see
+   graphNearestIndex). Nodes the index cannot answer are re-solved exactly with the selected facilities. Outputs a
+   continuous travel time (minutes) raster, named outSA + '_rast'.
+   :param graph: Road graph used to build the index, or path to the saved road graph
+   :param index: Index folder
+   :param facil: Facilities (points) used to build the index
+   :param outSA: Output base name
+   :param where_clause: Query selecting the subset of facil to use (e.g. "accgreen_acres >= 5")
+   :param poly_trim: Trim distance for rasterizing travel times (equivalent to a buffer around roads)
+   :param rastTemplate: Raster template for travel time raster
+   :return: outSA + '_rast'
+   '''
+   graph = getGraph(graph)
+   index = networkGraph.loadNearestIndex(index)
+   oid = [a[0] for a in arcpy.da.SearchCursor(facil, 'OID@', where_clause)]
+   keep = numpy.isin(index['facilities']['OID@'], oid)
+   print('Querying index for ' + str(keep.sum()) + ' facilities at ' + Hms() + '...')
+   tt, fac, unresolved = networkGraph.queryNearestIndex(index, keep, graph=graph)
+   print('Rasterizing travel time at ' + Hms() + '...')
+   graphToRaster(graph, tt, 'tmp_rast', rastTemplate, poly_trim, index['cutoff'], index['travDir'])
+   with arcpy.EnvManager(snapRaster=rastTemplate, cellSize=rastTemplate, extent=rastTemplate):
+      arcpy.sa.ExtractByMask('tmp_rast', rastTemplate).save(outSA + '_rast')
+   arcpy.BuildPyramids_management(outSA + '_rast')
+   arcpy.Delete_management('tmp_rast')
+
+   return outSA + '_rast'
+
+
+def graphODMatrix(graph, facil, popRast, path, fields=['accgreen_acres'], minutes=60, poly_trim="0.3 Miles",
+                  dist_from_roads="1 Mile", travDir="TO_FACILITIES", snap_cache=None):
+   '''
+   Build an origin-destination (OD) matrix of travel times from populated cells to all facilities within a time limit,
+   stored as a memory-mapped sparse matrix (see networkGraph.buildODMatrix). Metrics such as travel time to nearest,
+   facilities within a time, or catchments can then be calculated from the matrix (see networkGraph.odNearest,
+   odCount, odCatchment) and rasterized with odToRaster, instead of solving again.
+   :param graph: Road graph (see networkGraph.roadsToGraph), or path to a saved road graph
+   :param facil: Facilities (points)
+   :param popRast: Population raster. Cells with population > 0 are the rows of the matrix.
+   :param path: Output folder for the OD matrix
+   :param fields: Facility attributes to store with the matrix
+   :param minutes: Travel time limit (minutes)
+   :param poly_trim: Distance limit from cells to roads (as in graphToRaster)
+   :param dist_from_roads: Search distance limit for starting point from facilities to roads
+   :param snap_cache: Cache file (.npz) for facility locations (see networkGraph.locateFacilities)
+   :return: path
+   '''
+   graph = getGraph(graph)
+   att, matrix, node = graphLocate(graph, facil, ['OID@'] + fields, dist_from_roads, snap_cache, travDir)
+   print('Reading populated cells at ' + Hms() + '...')
+   grid = rasterBlocks.gridInfo(popRast)
+   cells = []
+   for w in rasterBlocks.iterWindows(grid):
+      pop = rasterBlocks.readWindow(popRast, grid, w, nodata=numpy.nan)
+      r, c = numpy.nonzero(pop > 0)
+      a = numpy.zeros(len(r), dtype=[('row', 'int32'), ('col', 'int32'), ('pop', 'float32')])
+      a['row'], a['col'], a['pop'] = r + w[0], c + w[2], pop[r, c]
+      cells.append(a)
+   cells = numpy.concatenate(cells)
+   xy = numpy.column_stack([grid['xmin'] + (cells['col'] + 0.5) * grid['cell'],
+                            grid['ymax'] - (cells['row'] + 0.5) * grid['cell']])
+   loc = networkGraph.snapToEdges(graph, xy, poly_trim, locate=False)
+   print('Located ' + str((loc['seg'] >= 0).sum()) + ' of ' + str(len(cells)) + ' populated cells on roads.')
+   print('Building OD matrix at ' + Hms() + '...')
+   networkGraph.buildODMatrix(graph, loc, node, path, minutes, travDir, cells, att[['OID@'] + fields], matrix=matrix)
+   return path
+
+
+def graphFloatingPressure(od, facil, facil_group, outSA, popRast, where_clause=None, fldScore="accgreen_acres",
+                          per=100, minutes=30, decay=networkGraph.e2sfca_weights):
+   '''
+   Calculate recreation pressure with the enhanced two-step floating catchment (E2SFCA) method, from an OD matrix of
+   travel times from populated cells to facilities (see graphODMatrix). Unlike catchment pressure (servCatPressure),
+   population reaching several facility groups is shared among them, with distance decay. Pressure is the inverse of
+   E2SFCA accessibility A (supply per person, see networkGraph.floatingCatchment): 1 / A is the population per unit of
+   accessible supply, which with hard catchments is exactly the catchment's population per unit of supply. It is
+   scaled with Helper.pressureValues, as catchment pressure (`per` persons per unit of supply is 50, capped at 100), so
+   the two methods share one 0-100 scale and score breaks. Outputs a pressure raster for populated cells, named
+   outSA + '_rast'. Cells reaching no facility are NoData.
+   :param od: OD matrix folder (see graphODMatrix). Must include fldScore and facil_group in its facility table.
+   :param facil: Facilities (points) used to build the OD matrix
+   :param facil_group: Facility grouping field name. Groups are the supply locations (e.g. parks).
+   :param outSA: Output base name
+   :param popRast: Population raster used to build the OD matrix
+   :param where_clause: Query selecting the subset of facil to use
+   :param fldScore: Field with facility scores (supply)
+   :param per: Number of persons per unit of fldScore, which denotes the middle of the scoring range (50)
+   :param minutes: Travel time limit (minutes); no more than the OD matrix cutoff
+   :param decay: Distance decay (see networkGraph.decayWeights)
+   :return: outSA + '_rast'
+   '''
+   od = networkGraph.loadODMatrix(od)
+   if minutes > od['cutoff']:
+      raise ValueError('Minutes (' + str(minutes) + ') is greater than the OD matrix cutoff (' + str(od['cutoff']) +
+                       ').')
+   fac = od['facilities']
+   oid = [a[0] for a in arcpy.da.SearchCursor(facil, 'OID@', where_clause)]
+   keep = numpy.isin(fac['OID@'], oid)
+   print('Calculating E2SFCA pressure for ' + str(keep.sum()) + ' facilities at ' + Hms() + '...')
+   grp, times = networkGraph.odGroups(od, fac[facil_group], keep)
+   times.data[times.data > minutes] = numpy.inf
+   # Group supply (scores are the same for all facilities in a group), with the PPA adjustment (see servCatPressure)
+   o = numpy.lexsort((-fac[fldScore], fac[facil_group]))
+   first = numpy.searchsorted(fac[facil_group][o], grp)
+   adj = 0.01 if fldScore == 'access' else 1
+   supply = adj + fac[fldScore][o][first]
+   access, grp_ratio = networkGraph.floatingCatchment(times, supply, od['cells']['pop'], decay)
+   # Population per unit of accessible supply, on the catchment pressure scale (the adjustment is already in supply)
+   pres = numpy.where(access > 0, pressureValues(1.0, access, per, adj=0), numpy.nan).astype('float32')
+   print('Rasterizing pressure at ' + Hms() + '...')
+   odToRaster(od, pres, outSA + '_rast', popRast)
+   arcpy.BuildPyramids_management(outSA + '_rast')
+
+   return outSA + '_rast'
+
+
+def odToRaster(od, values, out, template, nodata=numpy.nan):
+   '''
+   Rasterize values for the cells of an OD matrix (see graphODMatrix), e.g. from networkGraph.odNearest.
+   :param od: OD dictionary (see networkGraph.loadODMatrix)
+   :param values: Value for each cell (row) of the matrix
+   :param out: Output raster
+   :param template: Raster the OD matrix cells were read from (the population raster)
+   :param nodata: Value for cells not in the matrix, and for non-finite values
+   :return: out
+   '''
+   grid = rasterBlocks.gridInfo(template)
+   values = numpy.asarray(values)
+   row, col = od['cells']['row'], od['cells']['col']
+
+   def blocks():
+      for w in rasterBlocks.iterWindows(grid):
+         r0, r1, c0, c1 = w
+         arr = numpy.full((r1 - r0, c1 - c0), nodata, dtype=values.dtype)
+         i = numpy.flatnonzero((row >= r0) & (row < r1) & (col >= c0) & (col < c1))
+         arr[row[i] - r0, col[i] - c0] = values[i]
+         if arr.dtype.kind == 'f':
+            arr[~numpy.isfinite(arr)] = nodata
+         yield w, arr
+
+   rasterBlocks.writeBlocks(blocks(), grid, out, nodata=nodata)
+   return out
+
+
+def adjustCatchments(inLayer, rasterize_id, outLayer, roadMask, finalMask, polygons=False, workers=None):
+   # Catchments (polygons, or a label raster with attributes) are output as a label raster, with attributes in the
+   # raster attribute table. Polygons (outLayer + '_poly') are only created if requested. workers is the number of
+   # parallel processes for Euclidean allocation.
 
    print("Adjusting catchments using road mask...")
-   arcpy.PolygonToRaster_conversion(inLayer, rasterize_id, 'tmp_rasterize', cellsize=roadMask)
+   if isRaster(inLayer):
+      labels = inLayer
+   else:
+      arcpy.PolygonToRaster_conversion(inLayer, rasterize_id, 'tmp_rasterize', cellsize=roadMask)
+      labels = 'tmp_rasterize'
    print('Masking to roadMask...')
-   arcpy.sa.ExtractByMask('tmp_rasterize', roadMask).save('tmp_mask')
+   arcpy.sa.ExtractByMask(labels, roadMask).save('tmp_mask')
 
+   print("Allocating by euclidean distance...")
+   rasterBlocks.eucAllocation('tmp_mask', roadMask, 'tmp_alloc0', workers=workers)
    with arcpy.EnvManager(mask=finalMask, extent=finalMask):
-      print("Allocating by euclidean distance to final mask...")
-      arcpy.sa.EucAllocation('tmp_mask').save('tmp_alloc')
-      print('Converting raster to polygon feature class `' + outLayer + '`...')
-      arcpy.RasterToPolygon_conversion('tmp_alloc', outLayer, "NO_SIMPLIFY", 'Value', 'MULTIPLE_OUTER_PART')
-      arcpy.AlterField_management(outLayer, 'gridcode', rasterize_id, clear_field_alias=True)
+      print("Masking to final mask...")
+      arcpy.sa.ExtractByMask('tmp_alloc0', finalMask).save(outLayer)
+   arcpy.BuildRasterAttributeTable_management(outLayer, 'OVERWRITE')
+   arcpy.CalculateField_management(outLayer, rasterize_id, '!Value!', field_type="LONG")
 
    print('Joining fields...')
    jf1 = ['access', 'focal_src_table', 'focal_src_name', 'focal_join_name', 'focal_accgreen_acres']
    jf = [a.name for a in arcpy.ListFields(inLayer) if a.name in jf1]
    arcpy.JoinField_management(outLayer, rasterize_id, inLayer, rasterize_id, jf)
+   arcpy.BuildPyramids_management(outLayer)
+
+   if polygons:
+      catchmentPolygons(outLayer, rasterize_id, outLayer + '_poly')
+   return outLayer
+
 
+def catchmentPolygons(inLayer, rasterize_id, outLayer):
+   # Convert catchments (label raster) to polygons, with all attributes
+   print('Converting raster to polygon feature class `' + outLayer + '`...')
+   arcpy.RasterToPolygon_conversion(inLayer, outLayer, "NO_SIMPLIFY", 'Value', 'MULTIPLE_OUTER_PART')
+   arcpy.AlterField_management(outLayer, 'gridcode', rasterize_id, clear_field_alias=True)
+   jf = [a.name for a in arcpy.ListFields(inLayer) if a.type not in ['OID'] and
+         a.name.lower() not in ['value', 'count', rasterize_id.lower()]]
+   arcpy.JoinField_management(outLayer, rasterize_id, inLayer, rasterize_id, jf)
+   fldAlias(outLayer)
    return outLayer
 
 
-def finalizeLayer(inLayer, outLayer, finalMask, roadMask=None, rasterize_value=None):
+def finalizeLayer(inLayer, outLayer, finalMask, roadMask=None, rasterize_value=None, workers=None):
+   # workers is the number of parallel processes for Euclidean allocation (default is one per processor)
 
    print('Finalizing layer ' + inLayer + '...')
 
-   if rasterize_value is not None:
+   if rasterize_value is not None and isRaster(inLayer):
+      # catchments (label raster): already have been processed. Just look up the value, and then apply final mask
+      print('Looking up field ' + rasterize_value + '...')
+      with arcpy.EnvManager(mask=finalMask, extent=finalMask):
+         arcpy.sa.ExtractByMask(arcpy.sa.Lookup(inLayer, rasterize_value), finalMask).save(outLayer + '_final')
+   elif rasterize_value is not None:
       # catchments: already have been processed. Just rasterize, and then apply final mask
       print('Rasterizing field ' + rasterize_value + '...')
       arcpy.PolygonToRaster_conversion(inLayer, rasterize_value, 'tmp_rasterize', cellsize=finalMask)
@@ -287,9 +812,8 @@ def finalizeLayer(inLayer, outLayer, finalMask, roadMask=None, rasterize_value=N
       print('Masking to roadMask...')
       arcpy.sa.ExtractByMask(inLayer, roadMask).save(outLayer)
       arcpy.BuildPyramids_management(outLayer)
-      with arcpy.EnvManager(mask=finalMask, extent=finalMask):
-         print("Allocating by euclidean distance to final mask...")
-         arcpy.sa.EucAllocation(outLayer).save(outLayer + '_final')
+      print("Allocating by euclidean distance to final mask...")
+      rasterBlocks.eucAllocation(outLayer, finalMask, outLayer + '_final', mask=finalMask, workers=workers)
 
    arcpy.BuildPyramids_management(outLayer + '_final')
    return outLayer + '_final'
@@ -300,6 +824,14 @@ def reclassLayer(inLayer, outLayer,
 
    print('Reclassifying ' + inLayer + '...')
    arcpy.sa.Reclassify(inLayer, 'Value', remap).save(outLayer)
+   needLabels(outLayer)
+   arcpy.BuildPyramids_management(outLayer)
+
+
+def needLabels(outLayer):
+   '''
+   Add need class labels to the attribute table of a score layer (values 1-5).
+   '''
    arcpy.BuildRasterAttributeTable_management(outLayer, 'OVERWRITE')
    arcpy.AddField_management(outLayer, 'label', field_type="TEXT")
    need_rng = [[1, "Very Low Need"], [2, "Low Need"], [3, "Moderate Need"], [4, "High Need"], [5, "Very High Need"]]
@@ -308,9 +840,237 @@ def reclassLayer(inLayer, outLayer,
          val = [n[1] for n in need_rng if n[0] == i[0]][0]
          i[1] = val
          curs.updateRow(i)
-   arcpy.BuildPyramids_management(outLayer)
 
 
+def compositeScore(cls, weights):
+   '''
+   Composite score of need classes: the weighted sum of the classes, rounded (half up) to an integer. Cells which are
+   NoData (0) in any class array are NoData (0).
+   :param cls: list of class arrays (see rasterBlocks.remapRange)
+   :param weights: Weight (percent) of each class array
+   :return: composite array (uint8)
+   '''
+   total = sum(c.astype('int64') * int(wt) for c, wt in zip(cls, weights))
+   # Integer arithmetic, so that x.5 always rounds up
+   return numpy.where(numpy.all([c > 0 for c in cls], axis=0), (2 * total + 100) // 200, 0).astype('uint8')
+
+
+def scoreLayers(layers, out, rastTemplate, rcl=True):
+   '''
+   Create sub-component score layers and the composite score layer in one block-by-block pass over the value layers.
+   Value layers are reclassified into need classes (see rasterBlocks.remapRange), and the composite is the weighted
+   sum of the classes, rounded (half up) to an integer, as in WeightedOverlay with an evaluation scale of [1, 9, 1].
+   Cells which are NoData in any value layer are NoData in the composite.
+   :param layers: list of [value layer, remap ranges ([lower, upper, class]), weight (percent)]. Weights should sum
+      to 100.
+   :param out: Output composite score layer
+   :param rastTemplate: Raster template. Value layers must be aligned to it.
+   :param rcl: If True, sub-component score layers are also output (value layer name + '_rcl', in the workspace of
+      out)
+   :return: out
+   '''
+   print('Scoring layers for ' + out + ' at ' + Hms() + '...')
+   grid = rasterBlocks.gridInfo(rastTemplate)
+   nodata = [rasterBlocks.nodataValue(a[0]) for a in layers]
+   weights = numpy.array([a[2] for a in layers], dtype='int64')
+
+   def blocks():
+      for w in rasterBlocks.iterWindows(grid):
+         cls = [rasterBlocks.remapRange(rasterBlocks.readWindow(a[0], grid, w, nd), a[1], nd)
+                for a, nd in zip(layers, nodata)]
+         comp = compositeScore(cls, weights)
+         if rcl:
+            yield w, cls + [comp]
+         else:
+            yield w, comp
+
+   if rcl:
+      outs = [os.path.join(os.path.dirname(out), os.path.basename(a[0]) + '_rcl') for a in layers]
+      rasterBlocks.writeBlocks(blocks(), grid, outs + [out], nodata=0)
+      for o in outs:
+         needLabels(o)
+         arcpy.BuildPyramids_management(o)
+   else:
+      rasterBlocks.writeBlocks(blocks(), grid, out, nodata=0)
+   arcpy.BuildPyramids_management(out)
+
+   return out
+
+
+def prepFacilities(facil0, out, facil_group, where_clause=None):
+   '''
+   Copy facilities, with 'identicals' (same location and facil_group) removed, to reduce the number of service areas.
+   :param facil0: Facilities (points)
+   :param out: Output facilities
+   :param facil_group: Facility grouping field name
+   :param where_clause: Selection of facilities to copy
+   :return: out
+   '''
+   arcpy.Select_analysis(facil0, out, where_clause)
+   arcpy.DeleteIdentical_management(out, ["Shape", facil_group], "5 Meters")
+   return out
+
+
+def prepSecondaryPPA(ppa, out, where_clause="accgreen_acres > 0 AND accgreen_acres < 25"):
+   '''
+   Select secondary PPAs (used in catchment statistics), renaming field `access` to `ppa_access` to avoid conflict
+   with the same field in catchments.
+   :return: out
+   '''
+   arcpy.Select_analysis(ppa, out, where_clause)
+   arcpy.AlterField_management(out, 'access', 'ppa_access', clear_field_alias=True)
+   return out
+
+
+def catchmentAnalysis(opts, facil, facil_group, outSA, boundary, final, minutes=30, where_clause=None, popRast=None,
+                      secPPA=None, impRast=None, fldScore="access", per=10000, calc_agapt=False, polygons=False):
+   '''
+   Workflow stage for catchments: catchments by facil_group, adjusted to the road mask, with population statistics
+   and recreation pressure, finalized as value layer `final`. Adjusted catchments (outSA + '_adjust') are a label
+   raster with attributes in its raster attribute table.
+   :param opts: Workflow options dictionary (see main)
+   :param facil: Facilities (points)
+   :param facil_group: Facility grouping field name
+   :param outSA: Output catchments
+   :param boundary: Boundary used for filling in gaps in catchments
+   :param final: Value layer base name (see finalizeLayer)
+   :param minutes: Minute limit for catchments
+   :param where_clause: Selection of facilities to use (copied to outSA + '_facil')
+   :param popRast: Population raster (see servCatStats)
+   :param secPPA: Secondary PPAs (see servCatStats)
+   :param impRast: Impervious raster (see servCatStats)
+   :param fldScore: Field with facility scores (see servCatPressure)
+   :param per: Number of persons per unit of fldScore (see servCatPressure)
+   :param calc_agapt: Whether to calculate acres of greenspace per thousand persons (see agapt)
+   :param polygons: Whether to also output adjusted catchments as polygons (outSA + '_adjust_poly')
+   :return: value layer
+   '''
+   if where_clause is not None:
+      facil = arcpy.Select_analysis(facil, outSA + '_facil', where_clause)[0]
+   if opts['engine'] == 'graph':
+      cat = graphCatchments(opts['graph'], facil, facil_group, outSA, boundary=boundary, minutes=minutes,
+                            rastTemplate=opts['rastTemplate'], snap_cache=opts['snap_cache'],
+                            workers=opts['workers'], polygons=False)
+   else:
+      cat = networkCatchments(opts['net'], facil, facil_group, outSA, boundary=boundary, minutes=minutes)
+   # update: adjust here (clip to roads + euclidean allocation)
+   adjustCatchments(cat, 'servCat_' + facil_group, outSA + '_adjust', opts['roadMask'], opts['bnd'],
+                    workers=opts['workers'])
+   servCatStats(outSA + '_adjust', 'servCat_' + facil_group, popRast, secPPA, impRast)
+   catchmentMetrics(outSA + '_adjust', fldPop="pop_total", fldScore=fldScore, per=per, calc_agapt=calc_agapt)
+   if polygons:
+      catchmentPolygons(outSA + '_adjust', 'servCat_' + facil_group, outSA + '_adjust_poly')
+   return finalizeLayer(outSA + '_adjust', final, opts['VAMask'], rasterize_value='rec_pressure',
+                        workers=opts['workers'])
+
+
+def floatingPressureAnalysis(opts, od, facil, facil_group, outSA, final, popRast, where_clause=None,
+                             fldScore="accgreen_acres", per=100, minutes=30):
+   '''
+   Workflow stage for recreation pressure by the E2SFCA method (see graphFloatingPressure), finalized as value layer
+   `final`. An alternative to catchmentAnalysis, for the graph engine.
+   :param opts: Workflow options dictionary (see main)
+   :param od: OD matrix folder (see graphODMatrix)
+   :param facil: Facilities (points) used to build the OD matrix
+   :param facil_group: Facility grouping field name
+   :param outSA: Output base name
+   :param final: Value layer base name (see finalizeLayer)
+   :param popRast: Population raster used to build the OD matrix
+   :param where_clause: Selection of facilities to use
+   :param fldScore: Field with facility scores (see graphFloatingPressure)
+   :param per: Number of persons per unit of fldScore (see graphFloatingPressure)
+   :param minutes: Travel time limit (minutes)
+   :return: value layer
+   '''
+   graphFloatingPressure(od, facil, facil_group, outSA, popRast, where_clause, fldScore, per, minutes)
+   return finalizeLayer(outSA + '_rast', final, opts['VAMask'], opts['roadMask'], workers=opts['workers'])
+
+
+def travelTimeAnalysis(opts, facil, outSA, final, minutes=105, where_clause=None, index=None):
+   '''
+   Workflow stage for travel time to nearest facility, finalized as value layer `final`.
+   :param opts: Workflow options dictionary (see main)
+   :param facil: Facilities (points)
+   :param outSA: Output base name
+   :param final: Value layer base name (see finalizeLayer)
+   :param minutes: Minute limit for travel time
+   :param where_clause: Selection of facilities to use
+   :param index: Nearest facility index for facil (see graphNearestIndex). If given, travel times are queried from
+      the index (graph engine only).
+   :return: value layer
+   '''
+   if opts['engine'] == 'graph' and index is not None:
+      indexTravelToNearest(opts['graph'], index, facil, outSA, where_clause, rastTemplate=opts['rastTemplate'])
+   else:
+      if where_clause is not None:
+         facil = arcpy.Select_analysis(facil, outSA + '_facil', where_clause)[0]
+      if opts['engine'] == 'graph':
+         graphTravelToNearest(opts['graph'], facil, outSA, minutes=minutes, rastTemplate=opts['rastTemplate'],
+                              snap_cache=opts['snap_cache'], workers=opts['workers'])
+      else:
+         networkTravelToNearest(opts['net'], facil, outSA, minutes=list(range(5, minutes + 1, 5)),
+                                rastTemplate=opts['rastTemplate'])
+   return finalizeLayer(outSA + '_rast', final, opts['VAMask'], opts['roadMask'], workers=opts['workers'])
+
+
+def serviceAreaAnalysis(opts, facil, facil_group, outSA, final, minutes=30, where_clause=None):
+   '''
+   Workflow stage for service area overlap counts by facil_group, finalized as value layer `final`.
+   :param opts: Workflow options dictionary (see main)
+   :param facil: Facilities (points)
+   :param facil_group: Facility grouping field name
+   :param outSA: Output base name
+   :param final: Value layer base name (see finalizeLayer)
+   :param minutes: Minute limit for service areas
+   :param where_clause: Selection of facilities to use (copied to outSA + '_facil')
+   :return: value layer
+   '''
+   if where_clause is not None:
+      facil = arcpy.Select_analysis(facil, outSA + '_facil', where_clause)[0]
+   if opts['engine'] == 'graph':
+      graphServiceAreas(opts['graph'], facil, facil_group, outSA, minutes=minutes, rastTemplate=opts['rastTemplate'],
+                        snap_cache=opts['snap_cache'], workers=opts['workers'])
+   else:
+      networkServiceAreas(opts['net'], facil, facil_group, outSA, minutes=[minutes],
+                          rastTemplate=opts['rastTemplate'])
+   return finalizeLayer(outSA + '_ct', final, opts['VAMask'], opts['roadMask'], workers=opts['workers'])
+
+
+def activityAnalysis(opts, facil, facil_group, outSA, final, activities, minutes=30, sas=None):
+   '''
+   Workflow stage for the number of activity types available within service areas, finalized as value layer `final`.
+   :param opts: Workflow options dictionary (see main)
+   :param facil: Facilities (points), with activity fields
+   :param facil_group: Facility grouping field name
+   :param outSA: Output activity count raster
+   :param final: Value layer base name (see finalizeLayer)
+   :param activities: List of activity fields (1 = activity offered at the facility)
+   :param minutes: Minute limit for service areas
+   :param sas: Service areas (polygons) by facil_group, for minutes (Network Analyst engine only)
+   :return: value layer
+   '''
+   if opts['engine'] == 'graph':
+      # One solve with an activity bitmask by group. Uses all facilities (activity types are set by point, and
+      # points at the same location are coalesced when solving).
+      graphActivityAreas(opts['graph'], facil, facil_group, outSA, activities, minutes=minutes,
+                         rastTemplate=opts['rastTemplate'], snap_cache=opts['snap_cache'], workers=opts['workers'])
+   else:
+      rastTemplate = opts['rastTemplate']
+      # Loop over facility types
+      for t in activities:
+         print(t)
+         group_ids = list(set([str(a[0]) for a in arcpy.da.SearchCursor(facil, [facil_group, t]) if a[1] == 1]))
+         arcpy.Select_analysis(sas, 'tmp_sa', facil_group + " IN (" + ",".join(group_ids) + ")")
+         arcpy.CalculateField_management('tmp_sa', 'rast', 1, field_type="SHORT")
+         with arcpy.EnvManager(outputCoordinateSystem=rastTemplate, snapRaster=rastTemplate, cellSize=rastTemplate, extent=rastTemplate):
+            arcpy.PolygonToRaster_conversion('tmp_sa', 'rast', 'tmp_' + t, "CELL_CENTER", cellsize=rastTemplate)
+      # Sum rasters
+      rls = ['tmp_' + a for a in activities]
+      with arcpy.EnvManager(outputCoordinateSystem=rastTemplate, snapRaster=rastTemplate, cellSize=rastTemplate, extent=rastTemplate, mask=rastTemplate):
+         arcpy.sa.CellStatistics(rls, 'SUM').save('tmp_rast')
+         arcpy.sa.Con(arcpy.sa.IsNull('tmp_rast'), 0, 'tmp_rast').save(outSA)
+   return finalizeLayer(outSA, final, opts['VAMask'], opts['roadMask'], workers=opts['workers'])
+
 
 def main():
 
@@ -318,8 +1078,10 @@ def main():
 
    # GDBs are created within analyses, in this folder
    basedir = r'D:\projects\rec_model\rec_model_processing\serviceAnalyses_NA'
-   # projdir = os.path.join(basedir, 'recAnalyses_20210506')
-   projdir = os.path.join(basedir, 'recAnalyses_' + Ymd())
+   # projdir = os.path.join(basedir, 'recAnalyses_' + Ymd())
+   # Outputs are checkpointed (see stageCache.py), so the same folder is used for all runs. Stages are re-run when
+   # their inputs or parameters change.
+   projdir = os.path.join(basedir, 'recAnalyses')
 
    if not os.path.exists(projdir):
       print('Creating directory ' + projdir + '.')
@@ -351,6 +1113,28 @@ def main():
    net = r'D:\projects\OSM\network\OSM_RoadsNet_Albers.gdb\RoadsNet\RoadsNet_ND'
    arcpy.env.outputCoordinateSystem = net
 
+   # Travel analysis engine: 'NA' (Network Analyst) or 'graph' (NumPy/SciPy road graph, see networkGraph.py). Network
+   # Analyst stays the default for production scores until the two engines' catchments, travel times and counts have
+   # been compared on the full data. Set 'graph' to run the comparison or to use the graph engine.
+   engine = 'NA'
+   roads = [os.path.join(os.path.dirname(net), a) for a in ['Roads_Local', 'Roads_Hwy']]
+   graph_file = os.path.join(basedir, 'RoadsNet_graph.npz')
+   graph_hash = None
+   if engine == 'graph':
+      # Cached graph is rebuilt automatically if the roads change. Analyses load the graph from graph_file.
+      graph = networkGraph.loadRoadGraph(roads, graph_file)
+      _graphs[graph_file] = graph
+      graph_hash = graph['hash']
+   # Recreation pressure method: 'catchment' (population per unit of supply in hard catchments) or 'e2sfca' (enhanced
+   # two-step floating catchment, from an OD matrix of travel times; graph engine only)
+   pressure = 'catchment'
+   # Facility locations on the graph are cached (by point geometry) and shared by all analyses
+   snap_cache = os.path.join(basedir, 'RoadsNet_locations.npz')
+   # Number of stages (analyses) run in parallel, and number of parallel processes within each stage, for tiled graph
+   # solves and Euclidean allocation, so that stages together use one process per processor
+   stage_workers = 4
+   workers = max(1, os.cpu_count() // stage_workers)
+
    # Master access point layers
    ppa_pt0 = r'D:\projects\rec_model\rec_model_processing\access_pts.gdb\access_points_t_lnd_20210428'
    # Add field accgreen_acres to access points (used in catchments)
@@ -361,140 +1145,183 @@ def main():
 
    # END HEADER
 
+   # Options shared by all analyses. These are part of stage keys (graph_hash identifies the road graph version).
+   opts = {'engine': engine, 'net': net, 'graph': graph_file, 'graph_hash': graph_hash, 'snap_cache': snap_cache,
+           'workers': workers, 'rastTemplate': rastTemplate, 'roadMask': roadMask, 'VAMask': VAMask, 'bnd': bnd}
+   stages = []
+
+   # Each stage writes to its own geodatabase, since stages run in parallel and concurrent writes to one file
+   # geodatabase fail on schema locks. Stage outputs are copied to the shared output geodatabase (outGDB) by the parent
+   # process, one stage at a time.
+   stagedir = os.path.join(projdir, 'stages')
+   if not os.path.exists(stagedir):
+      os.mkdir(stagedir)
+
+   def stageGDB(name):
+      gdb = os.path.join(stagedir, name + '.gdb')
+      make_gdb(gdb)
+      return gdb
+
+   def stage(name, func, args=(), kwargs={}, **kw):
+      # Stage with its outputs copied to outGDB (stages with folder outputs use stageCache.stage)
+      return stageCache.stage(name, func, args, kwargs, publish=outGDB, **kw)
 
    ### Water access
    outGDB = os.path.join(projdir, 'recAnalyses_waterAccess.gdb')
    make_gdb(outGDB)
-   arcpy.env.workspace = outGDB
    facil_group = 'group_id'
+   # Value layers, with score breaks and composite weights
+   aqua = []
 
    # Copy access points with 'identicals' removed
-   facil = arcpy.Select_analysis(aqua_pt0, os.path.basename(aqua_pt0))[0]
-   arcpy.DeleteIdentical_management(facil, ["Shape", facil_group], "5 Meters")  # To reduce number of SAs
+   facil = os.path.join(stageGDB('aqua_facil'), os.path.basename(aqua_pt0))
+   stages.append(stage('aqua_facil', prepFacilities, (aqua_pt0, facil, facil_group), inputs=[aqua_pt0],
+                       outputs=[facil]))
 
    ## Catchments
-   outSA = 'servCat_waterAccess_30min'
-   if not arcpy.Exists(outSA):
-      networkCatchments(net, facil, facil_group, outSA, boundary=bnd, minutes=30)
-      # update: adjust here (clip to roads + euclidean allocation, convert back to polygon)
-      adjustCatchments(outSA, 'servCat_' + facil_group, outSA + '_adjust', roadMask, bnd)
-      servCatStats(outSA + '_adjust', 'servCat_' + facil_group, popRast)
-      servCatPressure(outSA + '_adjust', fldPop="pop_total", fldScore="access", per=10000)
-   final = finalizeLayer(outSA + '_adjust', 'aqRecPres', VAMask, rasterize_value='rec_pressure')
-   reclassLayer(final, final + '_rcl', arcpy.sa.RemapRange([[0, 20, 1], [20, 40, 2], [40, 60, 3], [60, 80, 4], [80, 100, 5]]))
+   gdb = stageGDB('aqRecPres')
+   outSA = os.path.join(gdb, 'servCat_waterAccess_30min')
+   final = os.path.join(gdb, 'aqRecPres')
+   stages.append(stage('aqRecPres', catchmentAnalysis, (opts, facil, facil_group, outSA, bnd, final),
+                       dict(minutes=30, popRast=popRast, fldScore="access", per=10000),
+                       inputs=[bnd, roadMask, VAMask, popRast], outputs=[outSA + '_adjust', final + '_final'],
+                       deps=['aqua_facil']))
+   aqua.append([final + '_final', [[0, 20, 1], [20, 40, 2], [40, 60, 3], [60, 80, 4], [80, 100, 5]], 70])
 
    ## Travel time 
    # 105 minutes is enough to cover entire study area
    # Grouping is not used for Travel time to nearest.
-   outSA = 'travelTime_waterAccess'
-   if not arcpy.Exists(outSA):
-      networkTravelToNearest(net, facil, outSA, minutes=list(range(5, 106, 5)), rastTemplate=rastTemplate)
-   final = finalizeLayer(outSA + '_rast', 'aqProx', VAMask, roadMask)
-   reclassLayer(final, final + '_rcl', arcpy.sa.RemapRange([[0, 15, 1], [15, 25, 2], [25, 40, 3], [40, 60, 4], [60, 100000, 5]]))
+   gdb = stageGDB('aqProx')
+   outSA = os.path.join(gdb, 'travelTime_waterAccess')
+   final = os.path.join(gdb, 'aqProx')
+   stages.append(stage('aqProx', travelTimeAnalysis, (opts, facil, outSA, final), dict(minutes=105),
+                       inputs=[roadMask, VAMask], outputs=[outSA + '_rast', final + '_final'], deps=['aqua_facil']))
+   aqua.append([final + '_final', [[0, 15, 1], [15, 25, 2], [25, 40, 3], [40, 60, 4], [60, 100000, 5]], 5])
 
    ## Service areas
-   outSA = 'servArea_waterAccess_30min'
-   if not arcpy.Exists(outSA):
-      networkServiceAreas(net, facil, facil_group, outSA, minutes=[30], rastTemplate=rastTemplate)
-   final = finalizeLayer(outSA + '_ct', 'aqAccOpts', VAMask, roadMask)
-   reclassLayer(final, final + '_rcl', arcpy.sa.RemapRange([[0, 0.5, 5], [0.5, 5, 4], [5, 10, 3], [10, 20, 2], [20, 100000, 1]]))
-
+   gdb = stageGDB('aqAccOpts')
+   outSA = os.path.join(gdb, 'servArea_waterAccess_30min')
+   final = os.path.join(gdb, 'aqAccOpts')
+   stages.append(stage('aqAccOpts', serviceAreaAnalysis, (opts, facil, facil_group, outSA, final),
+                       dict(minutes=30), inputs=[roadMask, VAMask], outputs=[outSA + '_ct', final + '_final'],
+                       deps=['aqua_facil']))
+   aqua.append([final + '_final', [[0, 0.5, 5], [0.5, 5, 4], [5, 10, 3], [10, 20, 2], [20, 100000, 1]], 20])
 
    # Overlap by-activity, aquatics. 30 minute limit.
-   outSA = 'servedArea_waterAccess_activities_30min_ct'
-   if not arcpy.Exists(outSA):
-      # Get service areas layer
-      sas = 'servArea_waterAccess_30min'
-
-      # Loop over facility types
-      typs = ['a_wct', 'a_fsh', 'a_swm']
-      for t in typs:
-         print(t)
-         group_ids = list(set([str(a[0]) for a in arcpy.da.SearchCursor(aqua_pt0, ['group_id', t]) if a[1] == 1]))
-         arcpy.Select_analysis(sas, 'tmp_sa', "group_id IN (" + ",".join(group_ids) + ")")
-         arcpy.CalculateField_management('tmp_sa', 'rast', 1, field_type="SHORT")
-         with arcpy.EnvManager(outputCoordinateSystem=rastTemplate, snapRaster=rastTemplate, cellSize=rastTemplate, extent=rastTemplate):
-            arcpy.PolygonToRaster_conversion('tmp_sa', 'rast', 'tmp_' + t, "CELL_CENTER", cellsize=rastTemplate)
-      # Sum rasters
-      rls = ['tmp_' + a for a in typs]
-      with arcpy.EnvManager(outputCoordinateSystem=rastTemplate, snapRaster=rastTemplate, cellSize=rastTemplate, extent=rastTemplate, mask=rastTemplate):
-         arcpy.sa.CellStatistics(rls, 'SUM').save('tmp_rast')
-         arcpy.sa.Con(arcpy.sa.IsNull('tmp_rast'), 0, 'tmp_rast').save(outSA)
-   final = finalizeLayer(outSA, 'aqActOpts', VAMask, roadMask)
-   reclassLayer(final, final + '_rcl', arcpy.sa.RemapRange([[0, 0.5, 5], [0.5, 1, 4], [1, 2, 3], [2, 3, 2]]))  # note: no Very Low class for this.
-
-   # Clean up
-   arcpy.Delete_management(arcpy.ListFeatureClasses("tmp_*") + arcpy.ListRasters("tmp_*") + arcpy.ListTables("tmp_*"))
-
-   # COMPOSITE SCORE LAYER
-   rmv = RemapValue([[1, 1], [2, 2], [3, 3], [4, 4], [5, 5]])
-   wo = arcpy.sa.WOTable([["aqProx_final_rcl", 5, 'Value', rmv],  ["aqAccOpts_final_rcl", 20, 'Value', rmv],
-                 ["aqActOpts_final_rcl", 5, 'Value', rmv], ["aqRecPres_final_rcl", 70, 'Value', rmv]], [1, 9, 1])
-   arcpy.sa.WeightedOverlay(wo).save('AquaScore')
+   # Uses all access points, and (Network Analyst engine only) the service areas layer.
+   sas = outSA
+   gdb = stageGDB('aqActOpts')
+   outSA = os.path.join(gdb, 'servedArea_waterAccess_activities_30min_ct')
+   final = os.path.join(gdb, 'aqActOpts')
+   stages.append(stage('aqActOpts', activityAnalysis, (opts, aqua_pt0, facil_group, outSA, final,
+                                                       ['a_wct', 'a_fsh', 'a_swm']),
+                       dict(minutes=30, sas=sas),
+                       inputs=[aqua_pt0, roadMask, VAMask], outputs=[outSA, final + '_final'],
+                       deps=['aqAccOpts'] if engine == 'NA' else []))
+   aqua.append([final + '_final', [[0, 0.5, 5], [0.5, 1, 4], [1, 2, 3], [2, 3, 2]], 5])  # note: no Very Low class for this.
+
+   # SCORE LAYERS (final_rcl) AND COMPOSITE SCORE LAYER
+   score = os.path.join(stageGDB('AquaScore'), 'AquaScore')
+   stages.append(stage('AquaScore', scoreLayers, (aqua, score, VAMask), inputs=[VAMask],
+                       outputs=[score] + [os.path.join(os.path.dirname(score), os.path.basename(a[0]) + '_rcl')
+                                          for a in aqua],
+                       deps=['aqRecPres', 'aqProx', 'aqAccOpts', 'aqActOpts']))
 
 
    ### PPAs
    outGDB = os.path.join(projdir, 'recAnalyses_PPA.gdb')
    make_gdb(outGDB)
-   arcpy.env.workspace = outGDB
    facil_group = 'ppa_group_id'
+   # Value layers, with score breaks and composite weights
+   terr = []
 
    # Copy access points with 'identicals' removed
-   ppa_pt = arcpy.Select_analysis(ppa_pt0, os.path.basename(ppa_pt0))[0]
-   arcpy.DeleteIdentical_management(ppa_pt, ["Shape", facil_group], "5 Meters")  # To reduce number of SA
+   ppa_pt = os.path.join(stageGDB('ppa_facil'), os.path.basename(ppa_pt0))
+   stages.append(stage('ppa_facil', prepFacilities, (ppa_pt0, ppa_pt, facil_group), inputs=[ppa_pt0],
+                       outputs=[ppa_pt]))
+
+   od = None
+   if engine == 'graph':
+      # Travel times from populated cells to all PPA access points within 60 minutes
+      od = os.path.join(projdir, 'odMatrix_PPA')
+      stages.append(stageCache.stage('ppa_od', graphODMatrix, (graph_file, ppa_pt, popRast, od),
+                                     dict(fields=[facil_group, 'accgreen_acres'], minutes=60, snap_cache=snap_cache),
+                                     inputs=[graph_file, popRast], outputs=[od], deps=['ppa_facil']))
 
    ## Catchments
    # PPA (25 acres)
-   outSA = 'servCat_PPA_25ac_30min'
-   if not arcpy.Exists(outSA):
-      # Select secondary PPA
-      ppa = r'D:\projects\rec_model\rec_datasets\rec_datasets_working_2021.gdb\public_lands_final_accessAreas'
-      sec_ppa = arcpy.Select_analysis(ppa, 'secPPA', where_clause="accgreen_acres > 0 AND accgreen_acres < 25")[0]
-      arcpy.AlterField_management(sec_ppa, 'access', 'ppa_access', clear_field_alias=True)  # change field name to avoid conflict w/same field in catchments.
-      # run catchments
-      facil = arcpy.Select_analysis(ppa_pt, os.path.basename(ppa_pt) + '_25ac', where_clause="accgreen_acres >= 25")[0]
-      networkCatchments(net, facil, facil_group, outSA, boundary=roadClip, minutes=30)
-      # update: adjust catchments here
-      adjustCatchments(outSA, 'servCat_' + facil_group, outSA + '_adjust', roadMask, bnd)
-      servCatStats(outSA + '_adjust', 'servCat_' + facil_group, popRast, sec_ppa, impRast)
-      agapt(outSA + '_adjust')
-      servCatPressure(outSA + '_adjust', fldPop="pop_total", fldScore="accgreen_acres", per=100)
-   final = finalizeLayer(outSA + '_adjust', 'teRecPres', VAMask, rasterize_value='rec_pressure')
-   reclassLayer(final, final + '_rcl', arcpy.sa.RemapRange([[0, 20, 1], [20, 40, 2], [40, 60, 3], [60, 80, 4], [80, 100, 5]]))
+   gdb = stageGDB('teRecPres')
+   outSA = os.path.join(gdb, 'servCat_PPA_25ac_30min')
+   final = os.path.join(gdb, 'teRecPres')
+   # Select secondary PPA
+   secPPA = os.path.join(stageGDB('secPPA'), 'secPPA')
+   ppa = r'D:\projects\rec_model\rec_datasets\rec_datasets_working_2021.gdb\public_lands_final_accessAreas'
+   stages.append(stage('secPPA', prepSecondaryPPA, (ppa, secPPA), inputs=[ppa], outputs=[secPPA]))
+   if pressure == 'e2sfca' and od is not None:
+      # Secondary PPAs are not used in E2SFCA pressure
+      stages.append(stage('teRecPres', floatingPressureAnalysis, (opts, od, ppa_pt, facil_group, outSA, final, popRast),
+                          dict(where_clause="accgreen_acres >= 25", fldScore="accgreen_acres", per=100, minutes=30),
+                          inputs=[roadMask, VAMask, popRast], outputs=[outSA + '_rast', final + '_final'],
+                          deps=['ppa_facil', 'ppa_od']))
+   else:
+      stages.append(stage('teRecPres', catchmentAnalysis, (opts, ppa_pt, facil_group, outSA, roadClip, final),
+                          dict(minutes=30, where_clause="accgreen_acres >= 25", popRast=popRast, secPPA=secPPA,
+                               impRast=impRast, fldScore="accgreen_acres", per=100, calc_agapt=True),
+                          inputs=[roadClip, bnd, roadMask, VAMask, popRast, impRast],
+                          outputs=[outSA + '_adjust', final + '_final'], deps=['ppa_facil', 'secPPA']))
+   terr.append([final + '_final', [[0, 20, 1], [20, 40, 2], [40, 60, 3], [60, 80, 4], [80, 100, 5]], 70])
 
    # Travel time to nearest (5 acres)
-   outSA = 'travelTime_PPA_5ac'
-   if not arcpy.Exists(outSA):
-      facil = arcpy.Select_analysis(ppa_pt, os.path.basename(ppa_pt) + '_5ac', where_clause="accgreen_acres >= 5")[0]
-      networkTravelToNearest(net, facil, outSA, minutes=list(range(5, 106, 5)), rastTemplate=rastTemplate)
-   final = finalizeLayer(outSA + '_rast', 'teProx', VAMask, roadMask)
-   reclassLayer(final, final + '_rcl', arcpy.sa.RemapRange([[0, 15, 1], [15, 25, 2], [25, 40, 3], [40, 60, 4], [60, 100000, 5]]))
+   gdb = stageGDB('teProx')
+   outSA = os.path.join(gdb, 'travelTime_PPA_5ac')
+   final = os.path.join(gdb, 'teProx')
+   index = None
+   if engine == 'graph':
+      # The index covers all PPA access points, so other acreage thresholds can be queried without re-solving.
+      index = os.path.join(projdir, 'nearestIndex_PPA')
+      stages.append(stageCache.stage('ppa_index', graphNearestIndex, (graph_file, ppa_pt, index),
+                                     dict(fields=['accgreen_acres'], minutes=105, snap_cache=snap_cache,
+                                          facil_group=facil_group),
+                                     inputs=[graph_file], outputs=[index], deps=['ppa_facil']))
+   stages.append(stage('teProx', travelTimeAnalysis, (opts, ppa_pt, outSA, final),
+                       dict(minutes=105, where_clause="accgreen_acres >= 5", index=index), inputs=[roadMask, VAMask],
+                       outputs=[outSA + '_rast', final + '_final'],
+                       deps=['ppa_facil'] + (['ppa_index'] if index else [])))
+   terr.append([final + '_final', [[0, 15, 1], [15, 25, 2], [25, 40, 3], [40, 60, 4], [60, 100000, 5]], 5])
 
    # Service Areas
    # PPA (100 acres)
-   outSA = 'servArea_PPA_100ac_30min'
-   if not arcpy.Exists(outSA):
-      facil = arcpy.Select_analysis(ppa_pt, os.path.basename(ppa_pt) + '_100ac', where_clause="accgreen_acres >= 100")[0]
-      networkServiceAreas(net, facil, facil_group, outSA, minutes=[30], rastTemplate=rastTemplate)
-   final = finalizeLayer(outSA + '_ct', 'teLocOpts', VAMask, roadMask)
-   reclassLayer(final, final + '_rcl', arcpy.sa.RemapRange([[0, 0.5, 5], [0.5, 5, 4], [5, 10, 3], [10, 20, 2], [20, 100000, 1]]))
+   gdb = stageGDB('teLocOpts')
+   outSA = os.path.join(gdb, 'servArea_PPA_100ac_30min')
+   final = os.path.join(gdb, 'teLocOpts')
+   stages.append(stage('teLocOpts', serviceAreaAnalysis, (opts, ppa_pt, facil_group, outSA, final),
+                       dict(minutes=30, where_clause="accgreen_acres >= 100"), inputs=[roadMask, VAMask],
+                       outputs=[outSA + '_ct', final + '_final'], deps=['ppa_facil']))
+   terr.append([final + '_final', [[0, 0.5, 5], [0.5, 5, 4], [5, 10, 3], [10, 20, 2], [20, 100000, 1]], 20])
 
    # PPA (600 acres)
-   outSA = 'servArea_PPA_600ac_60min'
-   if not arcpy.Exists(outSA):
-      facil = arcpy.Select_analysis(ppa_pt, os.path.basename(ppa_pt) + '_600ac', where_clause="accgreen_acres >= 600")[0]
-      networkServiceAreas(net, facil, facil_group, outSA, minutes=[60], rastTemplate=rastTemplate)
-   final = finalizeLayer(outSA + '_ct', 'teRegOpts', VAMask, roadMask)
-   reclassLayer(final, final + '_rcl', arcpy.sa.RemapRange([[0, 0.5, 5], [0.5, 5, 4], [5, 10, 3], [10, 20, 2], [20, 100000, 1]]))
-
-   # Clean up
-   arcpy.Delete_management(arcpy.ListFeatureClasses("tmp_*") + arcpy.ListRasters("tmp_*") + arcpy.ListTables("tmp_*"))
-
-   # COMPOSITE SCORE LAYER
-   rmv = RemapValue([[1, 1], [2, 2], [3, 3], [4, 4], [5, 5]])
-   wo = arcpy.sa.WOTable([["teProx_final_rcl", 5, 'Value', rmv],  ["teLocOpts_final_rcl", 20, 'Value', rmv],
-                 ["teRegOpts_final_rcl", 5, 'Value', rmv], ["teRecPres_final_rcl", 70, 'Value', rmv]], [1, 9, 1])
-   arcpy.sa.WeightedOverlay(wo).save('TerrScore')
+   gdb = stageGDB('teRegOpts')
+   outSA = os.path.join(gdb, 'servArea_PPA_600ac_60min')
+   final = os.path.join(gdb, 'teRegOpts')
+   stages.append(stage('teRegOpts', serviceAreaAnalysis, (opts, ppa_pt, facil_group, outSA, final),
+                       dict(minutes=60, where_clause="accgreen_acres >= 600"), inputs=[roadMask, VAMask],
+                       outputs=[outSA + '_ct', final + '_final'], deps=['ppa_facil']))
+   terr.append([final + '_final', [[0, 0.5, 5], [0.5, 5, 4], [5, 10, 3], [10, 20, 2], [20, 100000, 1]], 5])
+
+   # SCORE LAYERS (final_rcl) AND COMPOSITE SCORE LAYER
+   score = os.path.join(stageGDB('TerrScore'), 'TerrScore')
+   stages.append(stage('TerrScore', scoreLayers, (terr, score, VAMask), inputs=[VAMask],
+                       outputs=[score] + [os.path.join(os.path.dirname(score), os.path.basename(a[0]) + '_rcl')
+                                          for a in terr],
+                       deps=['teRecPres', 'teProx', 'teLocOpts', 'teRegOpts']))
+
+   # Run stages. Stages are skipped if their inputs, parameters, and the stages they depend on are unchanged.
+   # Independent stages run in parallel, each in its own scratch workspace (removed when the stage finishes) and
+   # output geodatabase.
+   env = {'outputCoordinateSystem': net, 'snapRaster': rastTemplate, 'cellSize': rastTemplate,
+          'extent': rastTemplate, 'overwriteOutput': True}
+   stageCache.runStages(stages, os.path.join(projdir, 'stageCache.json'), workers=stage_workers,
+                        scratch=os.path.join(projdir, 'scratch'), env=env)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,744 @@
+"""
+rasterBlocks
+Created on: 2026-10-17
+Version:  ArcGIS Pro / Python 3.x
+
+Block (window) based raster input/output, for processing statewide rasters as NumPy arrays without holding a full
+raster in memory. Includes functions for:
+   - gridInfo, which describes the grid (origin, cell size, dimensions, coordinate system) of a template raster
+   - iterWindows, which iterates over aligned windows of a grid
+   - readWindow, which reads a window of a raster aligned to the grid into an array
+   - iterBlocks, which reads windows (optionally with overlap halos) of several rasters at once, with NoData masks
+   - memoryTileSize, which gives the largest window size that keeps arrays for a window within a memory budget
+   - rasterSum, the sum (and count) of a raster's values, without reading the full raster
+   - subGrid, the part of a grid covering an extent
+   - wkbRings, which reads the rings of a polygon from WKB as coordinate arrays
+   - polygonCells, the number of sub-cells covered by a polygon (given as rings) in each cell
+   - readPolygons, which reads polygons (as WKB, with bounding boxes) for rasterizing by window
+   - windowGrid, the part of a grid covered by a window
+   - windowCoverage, the fraction of each cell of a window covered by each polygon (by supersampling), stored sparsely
+   - sparseWindow, which sums values of sparse cell entries into an array for a window
+   - writeBlocks, which writes arrays for windows to tiles, and mosaics them to the final output raster(s)
+   - remapRange, which reclassifies an array by value ranges (equivalent to Reclassify with a RemapRange)
+   - zonalStats, zonal statistics (sum, mean, count) of any number of value rasters in one pass, using bincount
+   - crossTab, cell counts (and value sums) for each combination of zones in two zone rasters
+   - eucAllocation, Euclidean allocation (replacement for arcpy.sa.EucAllocation), using an exact distance transform
+      in overlapping windows, processed in parallel
+
+General usage notes:
+- All rasters read with readWindow must share the cell size and snap (alignment) of the grid.
+- Windows are tuples of (row0, row1, col0, col1), in grid cell indices (row 0 at the top of the grid).
+- Peak memory is set by the window size. Set tile_size (e.g. rasterBlocks.tile_size = memoryTileSize(2048)) to bound
+memory for all functions using the default window size.
+- windowCoverage uses the even-odd rule, so polygon parts should not overlap (holes are excluded).
+- In eucAllocation, cells equally distant from two or more source cells are allocated to the first of them in row-major
+order, so results are deterministic and do not depend on the window size. arcpy.sa.EucAllocation may choose another of
+the equidistant sources (the tests compare both on a grid with ties, where Spatial Analyst is available). All other
+cells get the same value.
+- eucAllocation fails (ValueError) where cells are farther than max_halo from any source, instead of reading larger
+windows.
+"""
+
+import arcpy
+import os
+import concurrent.futures
+import numpy
+from scipy import ndimage
+
+# Default window size (rows and columns)
+tile_size = 4096
+
+# Default window size, halo and maximum halo (cells) for Euclidean allocation. The distance transform needs about 20
+# bytes per cell of the expanded window.
+alloc_size = 2048
+alloc_halo = 512
+alloc_max_halo = 4096
+
+# ArcGIS pixel types for NumPy data types
+pixel_types = {'uint8': '8_BIT_UNSIGNED', 'int8': '8_BIT_SIGNED', 'uint16': '16_BIT_UNSIGNED',
+               'int16': '16_BIT_SIGNED', 'uint32': '32_BIT_UNSIGNED', 'int32': '32_BIT_SIGNED',
+               'float32': '32_BIT_FLOAT', 'float64': '64_BIT'}
+
+
+def gridInfo(template):
+   '''
+   Get grid properties of a template raster.
+   :param template: Template raster
+   :return: grid dictionary
+   '''
+   r = arcpy.Raster(template)
+   grid = {'xmin': r.extent.XMin, 'ymax': r.extent.YMax, 'cell': r.meanCellWidth, 'nrows': r.height,
+           'ncols': r.width, 'sr': r.spatialReference}
+   return grid
+
+
+def iterWindows(grid, size=None):
+   '''
+   Iterate over windows covering a grid.
+   :param grid: grid dictionary
+   :param size: Window size (rows and columns). Default is tile_size.
+   :return: generator of windows (row0, row1, col0, col1)
+   '''
+   if size is None:
+      size = tile_size
+   for r0 in range(0, grid['nrows'], size):
+      for c0 in range(0, grid['ncols'], size):
+         yield r0, min(r0 + size, grid['nrows']), c0, min(c0 + size, grid['ncols'])
+
+
+def expandWindow(grid, window, halo):
+   '''
+   Expand a window by a halo (cells) on all sides, limited to the grid.
+   '''
+   r0, r1, c0, c1 = window
+   return max(r0 - halo, 0), min(r1 + halo, grid['nrows']), max(c0 - halo, 0), min(c1 + halo, grid['ncols'])
+
+
+def lowerLeft(grid, window):
+   '''
+   Lower-left corner of a window, as an arcpy Point.
+   '''
+   r0, r1, c0, c1 = window
+   return arcpy.Point(grid['xmin'] + c0 * grid['cell'], grid['ymax'] - r1 * grid['cell'])
+
+
+def readWindow(raster, grid, window, nodata=numpy.nan):
+   '''
+   Read a window of a raster. Cells outside the raster's extent are returned as nodata.
+   :param raster: Raster aligned to the grid
+   :param grid: grid dictionary
+   :param window: Window (row0, row1, col0, col1)
+   :param nodata: Value for NoData cells (use an integer for integer rasters)
+   :return: array
+   '''
+   r0, r1, c0, c1 = window
+   return arcpy.RasterToNumPyArray(raster, lowerLeft(grid, window), c1 - c0, r1 - r0, nodata)
+
+
+def nodataValue(raster):
+   '''
+   Array value to use for NoData cells when reading a raster: nan for floating point rasters, and the raster's NoData
+   value for integer rasters (so that it fits the raster's data type).
+   '''
+   r = arcpy.Raster(raster)
+   if r.isInteger and r.noDataValue is not None:
+      return int(r.noDataValue)
+   elif r.isInteger:
+      return numpy.iinfo('int32').min
+   else:
+      return numpy.nan
+
+
+def isNodata(arr, nodata):
+   '''
+   Boolean array of NoData cells.
+   '''
+   if isinstance(nodata, float) and numpy.isnan(nodata):
+      return numpy.isnan(arr)
+   else:
+      return arr == nodata
+
+
+def iterBlocks(rasters, grid, size=None, halo=0):
+   '''
+   Iterate over windows covering a grid, reading each window of a list of rasters. With a halo, arrays are read for the
+   window expanded by the halo (limited to the grid), for neighborhood operations; the core window is then
+   arr[core].
+   :param rasters: List of rasters aligned to the grid
+   :param grid: grid dictionary
+   :param size: Window size (rows and columns). Default is tile_size.
+   :param halo: Overlap (cells) on all sides of each window
+   :return: generator of (window, core, arrays, valid) tuples: the core window, a tuple of (row, column) slices of the
+      arrays for the core window, a list of arrays (read with nodataValue for each raster), and a list of boolean
+      arrays of cells with data
+   '''
+   nodata = [nodataValue(r) for r in rasters]
+   for w in iterWindows(grid, size):
+      ew = expandWindow(grid, w, halo)
+      core = (slice(w[0] - ew[0], w[1] - ew[0]), slice(w[2] - ew[2], w[3] - ew[2]))
+      arrs = [readWindow(r, grid, ew, nd) for r, nd in zip(rasters, nodata)]
+      yield w, core, arrs, [~isNodata(a, nd) for a, nd in zip(arrs, nodata)]
+
+
+def memoryTileSize(memory, bytes_per_cell=64, halo=0):
+   '''
+   Largest window size (a multiple of 256 cells) for which the arrays of one window fit within a memory budget.
+   :param memory: Memory budget (MB)
+   :param bytes_per_cell: Bytes used per cell of a window, for all arrays held at once (e.g. 4 float64 arrays and
+      their temporaries is about 64)
+   :param halo: Overlap (cells) on all sides of each window
+   :return: window size (rows and columns)
+   '''
+   side = int((memory * 2 ** 20 / bytes_per_cell) ** 0.5) - 2 * halo
+   return max(256, side // 256 * 256)
+
+
+def rasterSum(raster, grid=None, size=None, mask=None):
+   '''
+   Sum of a raster's values, reading one window at a time.
+   :param raster: Raster
+   :param grid: grid dictionary. Default is the grid of the raster.
+   :param size: Window size (cells). Default is tile_size.
+   :param mask: Mask raster, aligned to the grid. Cells which are NoData in the mask are not counted.
+   :return: tuple of (sum, number of cells with data)
+   '''
+   if grid is None:
+      grid = gridInfo(raster)
+   rasters = [raster] if mask is None else [raster, mask]
+   total, count = 0.0, 0
+   for w, core, arrs, valid in iterBlocks(rasters, grid, size):
+      ok = valid[0] if mask is None else valid[0] & valid[1]
+      total += arrs[0][ok].sum(dtype='float64')
+      count += int(ok.sum())
+   return total, count
+
+
+def subGrid(grid, extent):
+   '''
+   The part of a grid covering an extent, expanded to whole cells and limited to the grid.
+   :param grid: grid dictionary
+   :param extent: arcpy Extent, in the grid's coordinate system
+   :return: grid dictionary
+   '''
+   cell = grid['cell']
+   c0 = max(int(numpy.floor((extent.XMin - grid['xmin']) / cell)), 0)
+   c1 = min(int(numpy.ceil((extent.XMax - grid['xmin']) / cell)), grid['ncols'])
+   r0 = max(int(numpy.floor((grid['ymax'] - extent.YMax) / cell)), 0)
+   r1 = min(int(numpy.ceil((grid['ymax'] - extent.YMin) / cell)), grid['nrows'])
+   return {'xmin': grid['xmin'] + c0 * cell, 'ymax': grid['ymax'] - r0 * cell, 'cell': cell,
+           'nrows': max(r1 - r0, 0), 'ncols': max(c1 - c0, 0), 'sr': grid['sr']}
+
+
+def wkbRings(wkb):
+   '''
+   Rings of a polygon or multipolygon from WKB (Z and M values are dropped).
+   :return: list of (n, 2) coordinate arrays
+   '''
+   buf = bytes(wkb)
+   rings = []
+
+   def readGeom(pos):
+      bo = '<' if buf[pos] == 1 else '>'
+      t = int(numpy.frombuffer(buf, bo + 'u4', 1, pos + 1)[0])
+      dims = 2 + ((t & 0x80000000) > 0) + ((t & 0x40000000) > 0)
+      t &= 0xFFFF
+      dims += {1: 1, 2: 1, 3: 2}.get(t // 1000, 0)
+      t %= 1000
+      n = int(numpy.frombuffer(buf, bo + 'u4', 1, pos + 5)[0])
+      pos += 9
+      for i in range(n):
+         if t == 6:
+            pos = readGeom(pos)
+         else:
+            m = int(numpy.frombuffer(buf, bo + 'u4', 1, pos)[0])
+            rings.append(numpy.frombuffer(buf, bo + 'f8', m * dims, pos + 4).reshape(m, dims)[:, :2])
+            pos += 4 + 8 * m * dims
+      return pos
+
+   readGeom(0)
+   return rings
+
+
+def polygonCells(rings, grid, k):
+   '''
+   Number of covered sub-cells (k x k per cell) in each cell of a polygon, by scanlines through the sub-cell centers.
+   :param rings: List of (n, 2) coordinate arrays (closed rings, e.g. from wkbRings)
+   :param grid: grid dictionary
+   :param k: Sub-cells per cell, in each direction
+   :return: tuple of (row, col, count) arrays, for cells with a count > 0
+   '''
+   empty = (numpy.zeros(0, 'int32'), numpy.zeros(0, 'int32'), numpy.zeros(0, 'int16'))
+   # Edges, in sub-cell coordinates (column, row) from the grid origin
+   uv = [numpy.column_stack([(r[:, 0] - grid['xmin']) / grid['cell'] * k, (grid['ymax'] - r[:, 1]) / grid['cell'] * k])
+         for r in rings if len(r) > 1]
+   if len(uv) == 0:
+      return empty
+   u0, v0 = numpy.concatenate([a[:-1, 0] for a in uv]), numpy.concatenate([a[:-1, 1] for a in uv])
+   u1, v1 = numpy.concatenate([a[1:, 0] for a in uv]), numpy.concatenate([a[1:, 1] for a in uv])
+   # Cell-aligned bounding box, limited to the grid
+   r0 = max(int(numpy.floor(min(v0.min(), v1.min()) / k)), 0)
+   r1 = min(int(numpy.ceil(max(v0.max(), v1.max()) / k)), grid['nrows'])
+   c0 = max(int(numpy.floor(min(u0.min(), u1.min()) / k)), 0)
+   c1 = min(int(numpy.ceil(max(u0.max(), u1.max()) / k)), grid['ncols'])
+   if r0 >= r1 or c0 >= c1:
+      return empty
+   # Only edges spanning the scanned rows can cross a scanline
+   e = (numpy.maximum(v0, v1) > r0 * k) & (numpy.minimum(v0, v1) < r1 * k)
+   u0, v0, u1, v1 = u0[e], v0[e], u1[e], v1[e]
+   if len(u0) == 0:
+      return empty
+   ys = numpy.arange(r0 * k, r1 * k) + 0.5
+   width = (c1 - c0) * k
+   diff = numpy.zeros((len(ys), width + 1), dtype='int8')
+   # Scanlines in batches, limiting the (rows x edges) crossing arrays
+   step = max(1, 2 ** 22 // len(u0))
+   for i in range(0, len(ys), step):
+      y = ys[i:i + step, None]
+      ri, ei = numpy.nonzero((v0 <= y) != (v1 <= y))
+      x = u0[ei] + (y[ri, 0] - v0[ei]) * (u1[ei] - u0[ei]) / (v1[ei] - v0[ei])
+      o = numpy.lexsort((x, ri))
+      ri, x = ri[o], x[o]
+      # Crossings pair up along each scanline (even-odd rule). Sub-cells with centers in [start, end) are covered.
+      j0 = numpy.clip(numpy.ceil(x[0::2] - 0.5) - c0 * k, 0, width).astype('int64')
+      j1 = numpy.clip(numpy.ceil(x[1::2] - 0.5) - c0 * k, 0, width).astype('int64')
+      numpy.add.at(diff, (ri[0::2] + i, j0), 1)
+      numpy.add.at(diff, (ri[1::2] + i, j1), -1)
+   cov = numpy.cumsum(diff[:, :width], axis=1, dtype='int8')
+   counts = cov.reshape(r1 - r0, k, c1 - c0, k).sum(axis=(1, 3), dtype='int16')
+   rr, cc = numpy.nonzero(counts)
+   return (rr + r0).astype('int32'), (cc + c0).astype('int32'), counts[rr, cc]
+
+
+def readPolygons(feats, grid, where_clause=None):
+   '''
+   Read polygons for rasterizing by window (see windowCoverage): geometry as WKB, and bounding boxes and label points
+   in grid cell coordinates. Only the geometry is held, so memory is set by the size of the polygons, not the number of
+   cells they cover.
+   :param feats: Polygon feature class
+   :param grid: grid dictionary. Polygons are projected to the grid's coordinate system.
+   :param where_clause: Where clause to select polygons
+   :return: dictionary of `id` (polygon OID), `wkb` (list), `box` (row0, row1, col0, col1, as fractional cell
+      coordinates), `cell` (row and col of the cell holding the centroid) and `area` (polygon area in cells)
+   '''
+   cell = grid['cell']
+   ids, wkbs, boxes, xys, areas = [], [], [], [], []
+   with arcpy.da.SearchCursor(feats, ['OID@', 'SHAPE@WKB', 'SHAPE@XY', 'SHAPE@AREA'], where_clause,
+                              spatial_reference=grid['sr']) as curs:
+      for oid, wkb, xy, area in curs:
+         rings = None if wkb is None else wkbRings(wkb)
+         if not rings:
+            continue
+         xy_all = numpy.concatenate(rings)
+         ids.append(oid)
+         wkbs.append(bytes(wkb))
+         boxes.append((xy_all[:, 1].max(), xy_all[:, 1].min(), xy_all[:, 0].min(), xy_all[:, 0].max()))
+         xys.append(xy)
+         areas.append(area)
+   boxes = numpy.array(boxes, dtype='float64').reshape(-1, 4)
+   xys = numpy.array(xys, dtype='float64').reshape(-1, 2)
+   box = numpy.column_stack([(grid['ymax'] - boxes[:, 0]) / cell, (grid['ymax'] - boxes[:, 1]) / cell,
+                             (boxes[:, 2] - grid['xmin']) / cell, (boxes[:, 3] - grid['xmin']) / cell])
+   rc = numpy.column_stack([numpy.floor((grid['ymax'] - xys[:, 1]) / cell),
+                            numpy.floor((xys[:, 0] - grid['xmin']) / cell)]).astype('int64')
+   print('Read ' + str(len(ids)) + ' polygons.')
+   return {'id': numpy.array(ids, dtype='int32'), 'wkb': wkbs, 'box': box, 'cell': rc,
+           'area': numpy.array(areas, dtype='float64') / cell ** 2}
+
+
+def windowGrid(grid, window):
+   '''
+   The part of a grid covered by a window, as a grid dictionary.
+   '''
+   r0, r1, c0, c1 = window
+   return {'xmin': grid['xmin'] + c0 * grid['cell'], 'ymax': grid['ymax'] - r0 * grid['cell'], 'cell': grid['cell'],
+           'nrows': r1 - r0, 'ncols': c1 - c0, 'sr': grid['sr']}
+
+
+def windowCoverage(polys, grid, window, supersample=4):
+   '''
+   Fraction of each cell of a window covered by each polygon. Cells are divided into supersample x supersample
+   sub-cells, and a polygon covers the sub-cells whose centers are inside it. Only polygons whose bounding box
+   intersects the window are rasterized, and only within the window, so memory is set by the window size. Polygons
+   containing no sub-cell center anywhere in the grid (smaller than a sub-cell, or very thin) are assigned to the cell
+   holding their centroid, with their area as the fraction, so no polygon is lost.
+   :param polys: Polygons, from readPolygons
+   :param grid: grid dictionary (the grid given to readPolygons)
+   :param window: Window (row0, row1, col0, col1)
+   :param supersample: Sub-cells per cell, in each direction
+   :return: dictionary of arrays `id` (polygon OID), `row` and `col` (cell, in grid coordinates), and `frac` (fraction
+      of the cell covered by the polygon), with one entry for each cell of the window covered by each polygon
+   '''
+   k = supersample
+   r0, r1, c0, c1 = window
+   box, rc = polys['box'], polys['cell']
+   sel = numpy.nonzero((box[:, 0] <= r1) & (box[:, 1] >= r0) & (box[:, 2] <= c1) & (box[:, 3] >= c0))[0]
+   wgrid = windowGrid(grid, window)
+   parts = []
+   for i in sel:
+      rings = wkbRings(polys['wkb'][i])
+      r, c, n = polygonCells(rings, wgrid, k)
+      if len(r) > 0:
+         parts.append((numpy.full(len(r), polys['id'][i], dtype='int32'), r + r0, c + c0, n / k ** 2))
+      elif r0 <= rc[i, 0] < r1 and c0 <= rc[i, 1] < c1 and not _coversAny(rings, grid, box[i], window, k):
+         parts.append((polys['id'][i:i + 1], rc[i, :1].astype('int32'), rc[i, 1:].astype('int32'),
+                       numpy.array([min(polys['area'][i], 1.0)])))
+   if len(parts) == 0:
+      return {'id': numpy.zeros(0, 'int32'), 'row': numpy.zeros(0, 'int32'), 'col': numpy.zeros(0, 'int32'),
+              'frac': numpy.zeros(0, 'float32')}
+   cover = {f: numpy.concatenate([p[j] for p in parts]) for j, f in enumerate(['id', 'row', 'col', 'frac'])}
+   cover['frac'] = cover['frac'].astype('float32')
+   return cover
+
+
+def _coversAny(rings, grid, box, window, k):
+   '''
+   Whether a polygon covers any sub-cell center of the grid, given that it covers none in a window. The polygon's
+   bounding box is scanned in windows of the same size, so memory stays bounded for large polygons.
+   '''
+   r0, r1, c0, c1 = window
+   if box[0] >= r0 and box[1] <= r1 and box[2] >= c0 and box[3] <= c1:
+      return False
+   br0, bc0 = max(int(numpy.floor(box[0])), 0), max(int(numpy.floor(box[2])), 0)
+   bgrid = windowGrid(grid, (br0, min(int(numpy.ceil(box[1])), grid['nrows']), bc0,
+                             min(int(numpy.ceil(box[3])), grid['ncols'])))
+   for w in iterWindows(bgrid, max(r1 - r0, c1 - c0)):
+      w = (w[0] + br0, w[1] + br0, w[2] + bc0, w[3] + bc0)
+      if len(polygonCells(rings, windowGrid(grid, w), k)[0]) > 0:
+         return True
+   return False
+
+
+def sparseWindow(cover, window, values=None):
+   '''
+   Sum values of sparse cell entries into an array for a window.
+   :param cover: dictionary of arrays, including `row` and `col` (cell) in the window, e.g. from windowCoverage
+   :param window: Window (row0, row1, col0, col1)
+   :param values: Values of the entries. Default is `frac` of cover.
+   :return: array (float64) for the window, 0 where there are no entries
+   '''
+   r0, r1, c0, c1 = window
+   if values is None:
+      values = cover['frac']
+   cells = (cover['row'] - r0).astype('int64') * (c1 - c0) + cover['col'] - c0
+   return numpy.bincount(cells, weights=values, minlength=(r1 - r0) * (c1 - c0)).reshape(r1 - r0, c1 - c0)
+
+
+def writeBlocks(blocks, grid, out, nodata=None):
+   '''
+   Write arrays for windows to a new raster. Windows should not overlap.
+   :param blocks: iterable of (window, array) tuples. If out is a list, arrays is a list with one array per output.
+   :param grid: grid dictionary
+   :param out: Output raster, or list of output rasters (written in one pass over blocks)
+   :param nodata: Array value to write as NoData
+   :return: out
+   '''
+   outs = out if isinstance(out, list) else [out]
+   tmpDir = arcpy.env.scratchFolder
+   tiles = [[] for o in outs]
+   pixel_type = [None for o in outs]
+   for window, arrs in blocks:
+      if not isinstance(out, list):
+         arrs = [arrs]
+      for j, arr in enumerate(arrs):
+         if pixel_type[j] is None:
+            pixel_type[j] = pixel_types[arr.dtype.name]
+         if arr.dtype.kind == 'f' and nodata is not None and numpy.isnan(nodata):
+            # NumPyArrayToRaster does not accept nan as the NoData value
+            arr = numpy.where(numpy.isnan(arr), numpy.finfo(arr.dtype).min, arr)
+            tile_nodata = numpy.finfo(arr.dtype).min
+         else:
+            tile_nodata = nodata
+         tile = os.path.join(tmpDir, 'tmp_blk' + str(j) + '_' + str(len(tiles[j])) + '.tif')
+         arcpy.NumPyArrayToRaster(arr, lowerLeft(grid, window), grid['cell'], grid['cell'], tile_nodata).save(tile)
+         tiles[j].append(tile)
+   for o, t, p in zip(outs, tiles, pixel_type):
+      outDir = os.path.dirname(o)
+      if outDir == '':
+         outDir = arcpy.env.workspace
+      arcpy.MosaicToNewRaster_management(t, outDir, os.path.basename(o), grid['sr'], p, grid['cell'], 1)
+      arcpy.Delete_management(t)
+   return out
+
+
+def remapRange(arr, remap, nodata=numpy.nan, out_nodata=0, dtype='uint8', missing="DATA"):
+   '''
+   Reclassify an array by value ranges, like arcpy.sa.Reclassify with a RemapRange: upper bounds are inclusive, and
+   lower bounds are exclusive except for the lowest range.
+   :param arr: array
+   :param remap: list of [lower, upper, new value] ranges (not overlapping)
+   :param nodata: Array value for NoData cells in arr
+   :param out_nodata: Output value for NoData cells
+   :param dtype: Output data type
+   :param missing: Handling of values outside of all ranges, as Reclassify's missing_values: "DATA" keeps the value
+      (converted to dtype, limited to its range for integer types), "NODATA" makes it NoData.
+   :return: array
+   '''
+   if missing not in ["DATA", "NODATA"]:
+      raise ValueError('missing must be "DATA" or "NODATA".')
+   remap = sorted(remap, key=lambda a: a[1])
+   lower = numpy.array([a[0] for a in remap])
+   upper = numpy.array([a[1] for a in remap])
+   val = numpy.array([a[2] for a in remap], dtype=dtype)
+   i = numpy.searchsorted(upper, arr, side='left')
+   ic = numpy.minimum(i, len(remap) - 1)
+   first = ic == 0
+   nd = isNodata(arr, nodata)
+   inside = (i < len(remap)) & numpy.where(first, arr >= lower[ic], arr > lower[ic]) & ~nd
+   if missing == "NODATA":
+      return numpy.where(inside, val[ic], out_nodata).astype(dtype)
+   keep = numpy.where(nd, 0, arr)
+   if numpy.issubdtype(numpy.dtype(dtype), numpy.integer):
+      keep = numpy.clip(numpy.trunc(keep), numpy.iinfo(dtype).min, numpy.iinfo(dtype).max)
+   return numpy.where(inside, val[ic], numpy.where(nd, out_nodata, keep)).astype(dtype)
+
+
+def allocateArray(arr, nodata, core=None, max_dist=None):
+   '''
+   Euclidean allocation of an array. NoData cells take the value of the nearest (by cell center) cell with a value.
+   Where several cells with a value are equally near, the first in row-major order is used (see _firstEquidistant).
+   :param arr: array
+   :param nodata: Array value for NoData cells
+   :param core: tuple of (row, column) slices of arr to return. Default is all of arr.
+   :param max_dist: Cells farther than this (in cells) from the nearest cell with a value are marked unresolved
+   :return: tuple of (allocated array, resolved boolean array)
+   '''
+   if core is None:
+      core = (slice(None), slice(None))
+   empty = isNodata(arr, nodata)
+   if empty.all():
+      return arr[core].copy(), numpy.zeros(arr[core].shape, dtype=bool)
+   ir, ic = ndimage.distance_transform_edt(empty, return_distances=False, return_indices=True)
+   # A cell can only be equidistant to two sources if a 4-neighbor has another nearest source: moving toward the
+   # other source makes it strictly nearer. Cells on the edge of the array are always checked.
+   key = ir.astype('int64') * arr.shape[1] + ic
+   check = numpy.ones(arr.shape, dtype=bool)
+   check[1:-1, 1:-1] = ((key[1:-1, 1:-1] != key[:-2, 1:-1]) | (key[1:-1, 1:-1] != key[2:, 1:-1]) |
+                        (key[1:-1, 1:-1] != key[1:-1, :-2]) | (key[1:-1, 1:-1] != key[1:-1, 2:]))
+   del key
+   ir, ic = ir[core], ic[core]
+   r, c = numpy.arange(arr.shape[0])[core[0]][:, None], numpy.arange(arr.shape[1])[core[1]][None, :]
+   d2 = (ir - r).astype('int64') ** 2 + (ic - c).astype('int64') ** 2
+   _firstEquidistant(~empty, r, c, numpy.where(check[core], d2, 0), ir, ic)
+   out = arr[ir, ic]
+   if max_dist is None:
+      resolved = numpy.ones(out.shape, dtype=bool)
+   else:
+      resolved = d2 <= max_dist ** 2
+   return out, resolved
+
+
+def _firstEquidistant(src, r, c, d2, ir, ic, chunk=2 ** 20):
+   '''
+   Re-assign each cell's nearest source cell (ir, ic, updated in place) to the first source cell in row-major order at
+   the same distance. The distance transform's choice among equidistant cells depends on the array's extent, which
+   would make allocation depend on window size. Squared distances are integers, so the sources at the nearest distance
+   are at the lattice offsets (dr, dc) with dr ** 2 + dc ** 2 = d2, which are few for any d2. Offsets are tabulated by
+   d2 in row-major order, and the first offset holding a source is taken (only offsets before the current nearest
+   source are checked).
+   :param src: Boolean array of source cells
+   :param r: Rows (in src) of the cells, as a column vector
+   :param c: Columns (in src) of the cells, as a row vector
+   :param d2: Squared distance of each cell to its nearest source (0 for cells not to check)
+   :param ir: Row of each cell's nearest source
+   :param ic: Column of each cell's nearest source
+   :param chunk: Number of cells checked at once
+   '''
+   cells = numpy.flatnonzero(d2 > 0)
+   if len(cells) == 0:
+      return
+   # Lattice offsets with dr ** 2 + dc ** 2 <= max(d2), sorted by (d2, dr, dc)
+   R = int(numpy.sqrt(d2.max())) + 1
+   dr, dc = [a.ravel() for a in numpy.meshgrid(numpy.arange(-R, R + 1), numpy.arange(-R, R + 1), indexing='ij')]
+   n = dr * dr + dc * dc
+   o = numpy.lexsort((dc, dr, n))
+   dr, dc, n = dr[o], dc[o], n[o]
+   start = numpy.searchsorted(n, numpy.arange(d2.max() + 2))
+   key = (n * (2 * R + 1) + dr) * (2 * R + 1) + dc
+   # Sources padded by R cells, so offsets are flat index differences with no bounds checks
+   width = src.shape[1] + 2 * R
+   pad = numpy.zeros((src.shape[0] + 2 * R, width), dtype=bool)
+   pad[R:-R, R:-R] = src
+   pad = pad.ravel()
+   off = dr * width + dc
+   for i in range(0, len(cells), chunk):
+      rr, cc = numpy.unravel_index(cells[i:i + chunk], d2.shape)
+      k = d2[rr, cc]
+      # Only offsets before the current nearest source can replace it
+      cur = numpy.searchsorted(key, (k * (2 * R + 1) + ir[rr, cc] - r[rr, 0]) * (2 * R + 1) + ic[rr, cc] - c[0, cc])
+      s0, cnt = start[k], cur - start[k]
+      sel = cnt > 0
+      rr, cc, s0, cnt = rr[sel], cc[sel], s0[sel], cnt[sel]
+      cell = numpy.repeat(numpy.arange(len(rr)), cnt)
+      j = numpy.repeat(s0 - numpy.cumsum(cnt) + cnt, cnt) + numpy.arange(cnt.sum())
+      hit = numpy.flatnonzero(pad[((r[rr, 0] + R) * width + c[0, cc] + R)[cell] + off[j]])
+      # First offset with a source, for the cells with one (cell is sorted)
+      first = hit[numpy.r_[True, cell[hit][1:] != cell[hit][:-1]]] if len(hit) > 0 else hit
+      u = cell[first]
+      ir[rr[u], cc[u]], ic[rr[u], cc[u]] = r[rr[u], 0] + dr[j[first]], c[0, cc[u]] + dc[j[first]]
+
+
+def _allocateTile(args):
+   '''
+   Allocate one window (see eucAllocation). Run in a worker process.
+   '''
+   arr, nodata, core, halo, keep = args
+   out, resolved = allocateArray(arr, nodata, core, halo)
+   if keep is not None:
+      out[~keep] = nodata
+      resolved |= ~keep
+   return out, resolved
+
+
+def eucAllocation(source, template, out, mask=None, size=None, halo=None, workers=None, max_halo=None):
+   '''
+   Euclidean allocation of a raster to the grid of a template raster: NoData cells take the value of the nearest cell
+   with a value. Each window is allocated from the window expanded by a halo. A cell is final if its nearest source
+   is within the halo distance, since any closer source must then be inside the expanded window. Windows with cells
+   farther from a source than the halo are solved again (in parallel) with doubled halos, so the output does not
+   depend on window size. Halos are limited to max_halo, so memory stays bounded: a window with cells farther than
+   max_halo from any source raises a ValueError.
+   :param source: Source raster, aligned to template
+   :param template: Template raster, defining the output grid (extent, cell size, and alignment)
+   :param out: Output raster
+   :param mask: Mask raster, aligned to template. Cells which are NoData in the mask are NoData in the output.
+   :param size: Window size (cells). Default is alloc_size.
+   :param halo: Initial halo size (cells). Default is alloc_halo.
+   :param workers: Number of parallel processes. Default is one per processor.
+   :param max_halo: Maximum halo size (cells). Default is alloc_max_halo.
+   :return: out
+   '''
+   grid = gridInfo(template)
+   if size is None:
+      size = alloc_size
+   if halo is None:
+      halo = alloc_halo
+   if max_halo is None:
+      max_halo = alloc_max_halo
+   nodata = nodataValue(source)
+   mask_nodata = None if mask is None else nodataValue(mask)
+
+   def readTask(window, h):
+      ew = expandWindow(grid, window, h)
+      core = (slice(window[0] - ew[0], window[1] - ew[0]), slice(window[2] - ew[2], window[3] - ew[2]))
+      arr = readWindow(source, grid, ew, nodata)
+      keep = None if mask is None else ~isNodata(readWindow(mask, grid, window, mask_nodata), mask_nodata)
+      # Once the window covers the grid, all cells are final
+      if ew == (0, grid['nrows'], 0, grid['ncols']):
+         h = None
+      return arr, nodata, core, h, keep
+
+   def blocks():
+      windows = list(iterWindows(grid, size))
+      with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+         nw = workers or os.cpu_count()
+         for i in range(0, len(windows), nw):
+            batch = windows[i:i + nw]
+            halos = [halo] * len(batch)
+            done = [None] * len(batch)
+            todo = list(range(len(batch)))
+            # Unresolved windows of the batch are submitted again together, with doubled halos
+            while len(todo) > 0:
+               tasks = [readTask(batch[j], halos[j]) for j in todo]
+               again = []
+               for j, task, (arr, resolved) in zip(todo, tasks, pool.map(_allocateTile, tasks)):
+                  if task[3] is None or resolved.all():
+                     done[j] = arr
+                  elif halos[j] * 2 > max_halo:
+                     raise ValueError('Window ' + str(batch[j]) + ' has cells farther than ' + str(halos[j]) +
+                                      ' cells from any source cell. Increase max_halo, or check the source raster.')
+                  else:
+                     halos[j] *= 2
+                     again.append(j)
+               todo = again
+            for w, arr in zip(batch, done):
+               yield w, arr
+
+   print('Allocating ' + str(len(list(iterWindows(grid, size)))) + ' windows...')
+   writeBlocks(blocks(), grid, out, nodata=nodata)
+   return out
+
+
+def zonalStats(zones, values, size=None, mask=None):
+   '''
+   Zonal statistics of value rasters, by zone. Windows of the zone raster and each value raster are read once, and
+   statistics are accumulated by zone with bincount (zone values are offset by the lowest zone value, so negative
+   zones are allowed).
+   :param zones: Zone raster (integer). Defines the grid.
+   :param values: Dictionary of value rasters (aligned to zones), by name
+   :param size: Window size (cells). Default is tile_size.
+   :param mask: Mask raster, aligned to zones. Cells which are NoData in the mask are not counted.
+   :return: structured array with fields `zone`, `count` (number of cells in zone), and `<name>_sum`, `<name>_mean`,
+      and `<name>_count` (number of cells with data) for each value raster. Only zones with cells are included.
+   '''
+   grid = gridInfo(zones)
+   znd = nodataValue(zones)
+   vnd = {n: nodataValue(v) for n, v in values.items()}
+   mnd = None if mask is None else nodataValue(mask)
+   flds = ['count'] + [n + s for n in values for s in ['_sum', '_count']]
+   acc = None
+   for w in iterWindows(grid, size):
+      z = readWindow(zones, grid, w, znd)
+      ok = ~isNodata(z, znd)
+      if mask is not None:
+         ok &= ~isNodata(readWindow(mask, grid, w, mnd), mnd)
+      if not ok.any():
+         continue
+      z = z[ok].astype('int64')
+      zmin, zmax = z.min(), z.max()
+      if acc is None:
+         lo, hi = zmin, zmax
+         acc = {f: numpy.zeros(hi - lo + 1) for f in flds}
+      elif zmin < lo or zmax > hi:
+         # Expand accumulators to the new zone range
+         pad = (lo - min(lo, zmin), max(hi, zmax) - hi)
+         acc = {f: numpy.pad(a, pad) for f, a in acc.items()}
+         lo, hi = min(lo, zmin), max(hi, zmax)
+      idx = z - lo
+      n = hi - lo + 1
+      acc['count'] += numpy.bincount(idx, minlength=n)
+      for name, v in values.items():
+         a = readWindow(v, grid, w, vnd[name])[ok]
+         has = ~isNodata(a, vnd[name])
+         acc[name + '_sum'] += numpy.bincount(idx[has], weights=a[has].astype('float64'), minlength=n)
+         acc[name + '_count'] += numpy.bincount(idx[has], minlength=n)
+   dt = [('zone', 'int32'), ('count', 'int64')] + \
+        [(n + s, 'float64') for n in values for s in ['_sum', '_mean']] + [(n + '_count', 'int64') for n in values]
+   if acc is None:
+      return numpy.zeros(0, dtype=dt)
+   keep = acc['count'] > 0
+   out = numpy.zeros(keep.sum(), dtype=dt)
+   out['zone'] = numpy.arange(lo, hi + 1)[keep]
+   out['count'] = acc['count'][keep]
+   for n in values:
+      out[n + '_sum'] = acc[n + '_sum'][keep]
+      out[n + '_count'] = acc[n + '_count'][keep]
+      with numpy.errstate(invalid='ignore', divide='ignore'):
+         out[n + '_mean'] = numpy.where(out[n + '_count'] > 0, out[n + '_sum'] / out[n + '_count'], numpy.nan)
+   return out
+
+
+def crossTab(zonesA, zonesB, values={}, size=None):
+   '''
+   Cross-tabulate two zone rasters: the number of cells (and sums of value rasters) for each combination of zones, in
+   one pass over windows. Cells which are NoData in either zone raster are not counted.
+   :param zonesA: Zone raster (integer). Defines the grid.
+   :param zonesB: Zone raster (integer), aligned to zonesA
+   :param values: Dictionary of value rasters (aligned to zonesA), by name
+   :param size: Window size (cells). Default is tile_size.
+   :return: structured array with fields `a`, `b`, `count`, and `<name>_sum` and `<name>_count` (number of cells with
+      data) for each value raster
+   '''
+   grid = gridInfo(zonesA)
+   and_ = nodataValue(zonesA)
+   bnd = nodataValue(zonesB)
+   vnd = {n: nodataValue(v) for n, v in values.items()}
+   flds = ['count'] + [n + s for n in values for s in ['_sum', '_count']]
+   parts = []
+   for w in iterWindows(grid, size):
+      a = readWindow(zonesA, grid, w, and_)
+      b = readWindow(zonesB, grid, w, bnd)
+      ok = ~isNodata(a, and_) & ~isNodata(b, bnd)
+      if not ok.any():
+         continue
+      # Combination key: zone A in the high 32 bits, zone B in the low 32 bits
+      key = (a[ok].astype('int64') << 32) | (b[ok].astype('int64') & 0xFFFFFFFF)
+      u, inv = numpy.unique(key, return_inverse=True)
+      part = {'key': u, 'count': numpy.bincount(inv, minlength=len(u))}
+      for name, v in values.items():
+         x = readWindow(v, grid, w, vnd[name])[ok]
+         has = ~isNodata(x, vnd[name])
+         part[name + '_sum'] = numpy.bincount(inv[has], weights=x[has].astype('float64'), minlength=len(u))
+         part[name + '_count'] = numpy.bincount(inv[has], minlength=len(u))
+      parts.append(part)
+   dt = [('a', 'int32'), ('b', 'int32'), ('count', 'int64')] + \
+        [(n + '_sum', 'float64') for n in values] + [(n + '_count', 'int64') for n in values]
+   if len(parts) == 0:
+      return numpy.zeros(0, dtype=dt)
+   # Combine windows
+   u, inv = numpy.unique(numpy.concatenate([p['key'] for p in parts]), return_inverse=True)
+   out = numpy.zeros(len(u), dtype=dt)
+   out['a'] = u >> 32
+   out['b'] = (u & 0xFFFFFFFF).astype('uint32').view('int32')
+   for f in flds:
+      out[f] = numpy.bincount(inv, weights=numpy.concatenate([p[f] for p in parts]), minlength=len(u))
+   return out
@@ -0,0 +1,399 @@
+"""
+scenarios
+Created on: 2026-10-17
+Version:  ArcGIS Pro / Python 3.x
+
+What-if scenarios for the Recreation Model, e.g. "what if this parcel becomes a public park". A scenario adds and/or
+removes facilities, and recomputes only the area where results can change (nodes whose nearest facility changes,
+which are within the cutoff of the added or removed facilities). Includes functions for:
+   - scenarioLayer, which declares a value layer which scenarios update (travel time to nearest, or catchment
+      pressure), matching a workflow stage (see networkServiceAreas.main)
+   - scenarioBase, which solves and stores the road graph (node) results of the baseline for scenario layers
+   - runScenario, which updates node results for added/removed facilities (see networkGraph.updateNearest), outputs
+      patches of the value (and catchment) layers for the affected window, and the change in the composite score
+   - applyPatch, which mosaics a patch onto a layer
+
+General usage notes:
+- Scenarios use the graph engine. The baseline layers should be created with the graph engine, with the same
+facilities, graph and parameters as the scenario base, so that patches match the baseline outside of changes.
+- Patches are computed for a window covering the affected nodes, expanded by the trim distance and the Euclidean
+allocation halo (rasterBlocks.alloc_halo). Baseline and scenario node results are rasterized the same way within the
+window, and only cells where they differ are patched, so the rest of the window keeps baseline values.
+- Catchment pressure is updated from the baseline catchment table (population, score and pressure by catchment):
+population of cells which change catchment is moved between catchments, and pressure is recalculated for those
+catchments (see Helper.pressureValues). Scores of catchments are not recalculated (e.g. secondary PPA acres).
+- Catchment gaps (unreached areas, see graphCatchments) are not re-created in patches; cells beyond reach of any
+facility after a scenario take the nearest catchment.
+"""
+
+from Helper import *
+import json
+import numpy
+import networkGraph
+import networkServiceAreas
+import rasterBlocks
+
+
+def scenarioLayer(name, kind, value, where_clause=None, minutes=30, catchments=None, facil_group=None,
+                  fldScore="access", per=10000, popRast=None):
+   '''
+   Declare a value layer updated by scenarios.
+   :param name: Layer name (unique), used for output patch names
+   :param kind: 'travel' (travel time to nearest, see travelTimeAnalysis) or 'pressure' (catchment pressure, see
+      catchmentAnalysis)
+   :param value: Baseline value layer (final value raster, as used in the composite)
+   :param where_clause: Selection of facilities used for the layer (applied to both base and added facilities)
+   :param minutes: Travel time limit (minutes)
+   :param catchments: Baseline catchments (label raster with attributes; pressure layers)
+   :param facil_group: Facility grouping field name (pressure layers)
+   :param fldScore: Field with facility scores (pressure layers; see servCatPressure)
+   :param per: Number of persons per unit of fldScore (pressure layers; see servCatPressure)
+   :param popRast: Population raster (pressure layers)
+   :return: layer dictionary
+   '''
+   if kind not in ['travel', 'pressure']:
+      raise ValueError('Unknown scenario layer kind `' + kind + '`.')
+   return {'name': name, 'kind': kind, 'value': value, 'where_clause': where_clause, 'minutes': minutes,
+           'catchments': catchments, 'facil_group': facil_group, 'fldScore': fldScore, 'per': per,
+           'popRast': popRast}
+
+
+def _layerFields(layers):
+   '''
+   Facility fields used by scenario layers.
+   '''
+   flds = [f for a in layers if a['kind'] == 'pressure' for f in [a['facil_group'], a['fldScore']]]
+   return list(dict.fromkeys(flds))
+
+
+def _selectOIDs(facil, where_clause):
+   return [a[0] for a in arcpy.da.SearchCursor(facil, 'OID@', where_clause)]
+
+
+def scenarioBase(graph, facil, layers, path, poly_trim="0.3 Miles", dist_from_roads="1 Mile",
+                 travDir="TO_FACILITIES", snap_cache=None):
+   '''
+   Solve and store the baseline node results (travel time and nearest facility) of scenario layers.
+   :param graph: Road graph (see networkGraph.roadsToGraph), or path to a saved road graph
+   :param facil: Facilities (points), including the facilities of all layers
+   :param layers: list of layer dictionaries (see scenarioLayer)
+   :param path: Output file (.npz)
+   :param poly_trim: Trim distance used for rasterizing the layers (equivalent to a buffer around roads)
+   :param dist_from_roads: Search distance limit for starting point from facilities to roads
+   :param snap_cache: Cache file (.npz) for facility locations (see networkGraph.locateFacilities)
+   :return: path
+   '''
+   graph = networkServiceAreas.getGraph(graph)
+   xy, att = networkGraph.readPoints(facil, graph, ['OID@'] + _layerFields(layers), null_value=0)
+   loc = networkGraph.locateFacilities(graph, xy, dist_from_roads, snap_cache)
+   matrix, node = networkGraph.sourceMatrix(graph, loc, travDir)
+   arrs = {'xy': xy, 'seg': loc['seg'], 'frac': loc['frac'], 'att': att}
+   for a in layers:
+      print('Solving baseline for scenario layer `' + a['name'] + '` at ' + Hms() + '...')
+      sel = numpy.isin(att['OID@'], _selectOIDs(facil, a['where_clause']))
+      tt, src = networkGraph.solveNearest(graph, node[sel], a['minutes'], travDir, matrix)
+      arrs.update({a['name'] + '_sel': sel, a['name'] + '_tt': tt.astype('float32'), a['name'] + '_src': src})
+   meta = {'facil': facil, 'layers': layers, 'graph': graph.get('hash') or networkGraph.graphHash(graph),
+           'poly_trim': poly_trim, 'dist_from_roads': dist_from_roads, 'travDir': travDir, 'snap_cache': snap_cache}
+   numpy.savez(path, meta=json.dumps(meta), **arrs)
+   return path
+
+
+def nodesWindow(graph, grid, nodes, trim):
+   '''
+   Grid window covering the road segments with an end at any of the given nodes, expanded by the trim distance.
+   :param graph: graph dictionary
+   :param grid: grid dictionary (see rasterBlocks.gridInfo)
+   :param nodes: Boolean array of nodes
+   :param trim: Trim distance (meters)
+   :return: window (row0, row1, col0, col1), or None if there are no nodes
+   '''
+   seg = nodes[graph['seg_u']] | nodes[graph['seg_v']]
+   if not seg.any():
+      return None
+   xy = numpy.concatenate([graph['xy'][graph['seg_u'][seg]], graph['xy'][graph['seg_v'][seg]]])
+   (x0, y0), (x1, y1) = xy.min(axis=0) - trim, xy.max(axis=0) + trim
+   c0 = int(numpy.floor((x0 - grid['xmin']) / grid['cell']))
+   c1 = int(numpy.ceil((x1 - grid['xmin']) / grid['cell']))
+   r0 = int(numpy.floor((grid['ymax'] - y1) / grid['cell']))
+   r1 = int(numpy.ceil((grid['ymax'] - y0) / grid['cell']))
+   return max(r0, 0), min(r1, grid['nrows']), max(c0, 0), min(c1, grid['ncols'])
+
+
+def nodeGrid(graph, grid, window, values, trim, cutoff, travDir="TO_FACILITIES", labels=None):
+   '''
+   Rasterize node travel times (or labels) for a window, as in networkServiceAreas.graphToRaster. Only road segments
+   near the window are sampled.
+   :return: array for the window (nan, or int32 minimum for labels, beyond the trim distance)
+   '''
+   r0, r1, c0, c1 = window
+   x0, x1 = grid['xmin'] + c0 * grid['cell'] - trim, grid['xmin'] + c1 * grid['cell'] + trim
+   y0, y1 = grid['ymax'] - r1 * grid['cell'] - trim, grid['ymax'] - r0 * grid['cell'] + trim
+   a, b = graph['xy'][graph['seg_u']], graph['xy'][graph['seg_v']]
+   near = (numpy.maximum(a[:, 0], b[:, 0]) >= x0) & (numpy.minimum(a[:, 0], b[:, 0]) <= x1) & \
+          (numpy.maximum(a[:, 1], b[:, 1]) >= y0) & (numpy.minimum(a[:, 1], b[:, 1]) <= y1)
+   sub = dict(graph, **{k: graph[k][near] for k in ['seg_u', 'seg_v', 'seg_tf', 'seg_tb']})
+   if labels is None:
+      samples = networkGraph.segmentSamples(sub, values, grid['cell'], cutoff, travDir)
+      return networkGraph.graphToGrid(samples, grid, window, trim)
+   xy, val, lab = networkGraph.segmentSamples(sub, values, grid['cell'], cutoff, travDir, labels=labels)
+   nodata = numpy.iinfo('int32').min
+   return networkGraph.graphToGrid((xy, lab), grid, window, trim, nodata=nodata, dtype='int32')
+
+
+def _allocate(arr, nodata, roads, core, halo=None):
+   '''
+   Mask an (expanded) window array to roads, and allocate NoData cells by Euclidean distance (as in finalizeLayer and
+   adjustCatchments). Returns the core window, and whether each cell's nearest value is within the halo (see
+   rasterBlocks.allocateArray).
+   '''
+   arr = arr.copy()
+   arr[roads] = nodata
+   return rasterBlocks.allocateArray(arr, nodata, core, halo)
+
+
+def _onBorder(grid, window, arr):
+   '''
+   Check if any cell on the border of a window is True, excluding borders at the edge of the grid.
+   '''
+   r0, r1, c0, c1 = window
+   return (r0 > 0 and arr[0, :].any()) or (r1 < grid['nrows'] and arr[-1, :].any()) or \
+      (c0 > 0 and arr[:, 0].any()) or (c1 < grid['ncols'] and arr[:, -1].any())
+
+
+def runScenario(opts, base, out, add=None, remove_where=None, composite=None):
+   '''
+   Run a what-if scenario: add and/or remove facilities, and update the scenario layers and composite score within
+   the affected window. Outputs (rasters covering the window):
+      - out + '_' + layer name: patched value layer
+      - out + '_' + layer name + '_cat': patched catchments (label raster; pressure layers)
+      - out + '_comp': composite score, and out + '_diff': change in composite score (if composite is given)
+   :param opts: Workflow options dictionary (see networkServiceAreas.main). Uses graph, rastTemplate, roadMask and
+      VAMask.
+   :param base: Scenario base file (see scenarioBase)
+   :param out: Output base name
+   :param add: Facilities (points) to add, with the fields used by the layers (where clauses, groups, scores)
+   :param remove_where: Query selecting base facilities to remove (e.g. "OBJECTID IN (12, 34)")
+   :param composite: Composite layers, as for scoreLayers ([value layer, remap ranges, weight]). Scenario layers
+      replace the composite layers with the same value layer.
+   :return: dictionary with the window and outputs (None if nothing changes)
+   '''
+   print('Running scenario `' + out + '` at ' + Hms() + '...')
+   with numpy.load(base, allow_pickle=False) as f:
+      b = {k: f[k] for k in f.files}
+   meta = json.loads(str(b['meta']))
+   graph = networkServiceAreas.getGraph(opts['graph'])
+   if meta['graph'] != (graph.get('hash') or networkGraph.graphHash(graph)):
+      raise ValueError('The road graph has changed since the scenario base was created; run scenarioBase again.')
+   layers, travDir = meta['layers'], meta['travDir']
+   trim = networkGraph.linearUnit(meta['poly_trim'])
+   att = b['att']
+   nb = len(att)
+   rm = numpy.zeros(nb, dtype=bool)
+   if remove_where is not None:
+      rm = numpy.isin(att['OID@'], _selectOIDs(meta['facil'], remove_where))
+
+   # Facility locations and source nodes (added facilities after the base facilities)
+   loc = {'seg': b['seg'], 'frac': b['frac']}
+   add_att = att[:0]
+   if add is not None:
+      xy, add_att = networkGraph.readPoints(add, graph, ['OID@'] + _layerFields(layers), null_value=0)
+      new = networkGraph.locateFacilities(graph, xy, meta['dist_from_roads'], meta['snap_cache'])
+      loc = {a: numpy.concatenate([loc[a], new[a]]) for a in ['seg', 'frac']}
+   print('Removing ' + str(rm.sum()) + ' and adding ' + str(len(add_att)) + ' facilities.')
+   matrix, node = networkGraph.sourceMatrix(graph, loc, travDir)
+
+   # Update node results
+   grid = rasterBlocks.gridInfo(opts['rastTemplate'])
+   res = {}
+   region = numpy.zeros(len(graph['xy']), dtype=bool)
+   for a in layers:
+      n = a['name']
+      add_sel = numpy.isin(add_att['OID@'], _selectOIDs(add, a['where_clause'])) if add is not None else \
+         numpy.zeros(0, dtype=bool)
+      tt, src, changed = networkGraph.updateNearest(graph, matrix, b[n + '_tt'], b[n + '_src'],
+                                                    node[:nb][b[n + '_sel'] & rm], node[nb:][add_sel], a['minutes'],
+                                                    node[:nb][b[n + '_sel']])
+      res[n] = {'tt': tt, 'src': src, 'changed': changed}
+      region |= changed
+      if a['kind'] == 'pressure':
+         # Catchment pressure changes for all cells of catchments which gain or lose cells
+         group = numpy.concatenate([att[a['facil_group']], add_att[a['facil_group']]]).astype('int32')
+         lab0 = networkGraph.nodeLabels(b[n + '_src'], node, group)
+         lab1 = networkGraph.nodeLabels(src, node, group)
+         grp = numpy.setdiff1d(numpy.union1d(lab0[changed], lab1[changed]), [-1])
+         res[n].update({'group': group, 'lab0': lab0, 'lab1': lab1, 'grp': grp})
+         region |= numpy.isin(lab0, grp) | numpy.isin(lab1, grp)
+      print('Layer `' + n + '`: ' + str(changed.sum()) + ' nodes changed.')
+   window = nodesWindow(graph, grid, region, trim)
+   if window is None:
+      print('Scenario does not change any results.')
+      return None
+   # Rasterize baseline and scenario node results the same way. The window grows until it contains all cells which
+   # change (allocation can carry changes beyond the affected roads), and the halo grows until all cells are allocated
+   # from within the expanded window (as in rasterBlocks.eucAllocation).
+   road_nd = rasterBlocks.nodataValue(opts['roadMask'])
+   lab_nd = numpy.iinfo('int32').min
+   halo = rasterBlocks.alloc_halo
+   while True:
+      ew = rasterBlocks.expandWindow(grid, window, halo)
+      core = (slice(window[0] - ew[0], window[1] - ew[0]), slice(window[2] - ew[2], window[3] - ew[2]))
+      h = None if ew == (0, grid['nrows'], 0, grid['ncols']) else halo
+      print('Rasterizing window of ' + str(window[1] - window[0]) + ' x ' + str(window[3] - window[2]) +
+            ' cells (halo ' + str(halo) + ') at ' + Hms() + '...')
+      roads = rasterBlocks.isNodata(rasterBlocks.readWindow(opts['roadMask'], grid, ew, road_nd), road_nd)
+      resolved = True
+      grow = False
+      for a in layers:
+         n = a['name']
+         r = res[n]
+         if a['kind'] == 'travel':
+            new = [_allocate(nodeGrid(graph, grid, ew, t, trim, a['minutes'], travDir), numpy.nan, roads, core, h)
+                   for t in [b[n + '_tt'], r['tt']]]
+            diff = ~((new[0][0] == new[1][0]) | (numpy.isnan(new[0][0]) & numpy.isnan(new[1][0])))
+         else:
+            new = [_allocate(nodeGrid(graph, grid, ew, t, trim, a['minutes'], travDir, labels=lab), lab_nd, roads,
+                             core, h) for t, lab in [(b[n + '_tt'], r['lab0']), (r['tt'], r['lab1'])]]
+            diff = new[0][0] != new[1][0]
+            # Catchments which change extend beyond the window
+            cat_nd = rasterBlocks.nodataValue(a['catchments'])
+            cat0 = rasterBlocks.readWindow(a['catchments'], grid, window, cat_nd)
+            grp = numpy.union1d(r['grp'], numpy.union1d(new[0][0][diff], new[1][0][diff]))
+            diff = diff | numpy.isin(cat0, grp)
+         r['new'] = [x[0] for x in new]
+         resolved = resolved and new[0][1].all() and new[1][1].all()
+         grow = grow or _onBorder(grid, window, diff)
+      if not resolved:
+         halo *= 2
+      elif grow:
+         window = rasterBlocks.expandWindow(grid, window, halo)
+      else:
+         break
+   print('Patching window at ' + Hms() + '...')
+   va_nd = rasterBlocks.nodataValue(opts['VAMask'])
+   outside = rasterBlocks.isNodata(rasterBlocks.readWindow(opts['VAMask'], grid, window, va_nd), va_nd)
+
+   # Patch layers
+   patched = {}
+   outputs = {}
+   for a in layers:
+      n = a['name']
+      r = res[n]
+      val_nd = rasterBlocks.nodataValue(a['value'])
+      val = rasterBlocks.readWindow(a['value'], grid, window, val_nd)
+      new = r['new']
+      if a['kind'] == 'travel':
+         diff = ~((new[0] == new[1]) | (numpy.isnan(new[0]) & numpy.isnan(new[1]))) & ~outside
+         val = numpy.where(diff, new[1], val).astype(val.dtype)
+      else:
+         cat_nd = rasterBlocks.nodataValue(a['catchments'])
+         cat0 = rasterBlocks.readWindow(a['catchments'], grid, window, cat_nd)
+         moved = (new[0] != new[1]) & (new[1] != lab_nd) & ~outside
+         cat = numpy.where(moved, new[1], cat0).astype('int32')
+         # Catchment table, with added catchments
+         tab = readColumns(a['catchments'], ['Value', 'pop_total', a['fldScore'], 'rec_pressure'])
+         gnew = numpy.setdiff1d(r['group'][nb:], tab['Value'])
+         score_new = numpy.array([add_att[a['fldScore']][r['group'][nb:] == g].max() for g in gnew])
+         ids = numpy.concatenate([tab['Value'], gnew]).astype('int64')
+         o = numpy.argsort(ids)
+         ids = ids[o]
+         pop0 = numpy.concatenate([tab['pop_total'], numpy.zeros(len(gnew))])[o]
+         score = numpy.concatenate([tab[a['fldScore']], score_new])[o]
+         pres0 = numpy.concatenate([tab['rec_pressure'], numpy.full(len(gnew), numpy.nan)])[o]
+         # Move population of cells which change catchment
+         pop = rasterBlocks.readWindow(a['popRast'], grid, window, numpy.nan)
+         pop = numpy.where(numpy.isnan(pop), 0, pop)
+         gained = moved & numpy.isin(cat, ids)
+         lost = moved & numpy.isin(cat0, ids)
+         delta = numpy.bincount(numpy.searchsorted(ids, cat[gained]), weights=pop[gained], minlength=len(ids))
+         delta -= numpy.bincount(numpy.searchsorted(ids, cat0[lost]), weights=pop[lost], minlength=len(ids))
+         aff = numpy.isin(ids, numpy.unique(numpy.concatenate([cat[gained], cat0[lost]])))
+         pop1 = pop0 + delta
+         adj = 0.01 if a['fldScore'] == 'access' else 1
+         pres1 = numpy.where(aff, pressureValues(pop1, score, a['per'], adj), pres0)
+         print('Layer `' + n + '`: ' + str(moved.sum()) + ' cells and ' + str(round(numpy.abs(delta).sum() / 2)) +
+               ' persons changed catchment; pressure recalculated for ' + str(aff.sum()) + ' catchments.')
+         # Patch pressure for cells in affected catchments
+         known = numpy.isin(cat, ids)
+         pos = numpy.searchsorted(ids, numpy.where(known, cat, ids[0]))
+         upd = known & aff[pos] & ~outside
+         val = numpy.where(upd, pres1[pos], val).astype(val.dtype)
+         cat = numpy.where(outside, cat_nd, cat).astype(cat0.dtype)
+         rasterBlocks.writeBlocks([(window, cat)], grid, out + '_' + n + '_cat', nodata=cat_nd)
+         outputs[n + '_cat'] = out + '_' + n + '_cat'
+      rasterBlocks.writeBlocks([(window, val)], grid, out + '_' + n, nodata=val_nd)
+      outputs[n] = out + '_' + n
+      patched[a['value']] = val
+
+   result = {'window': window, 'outputs': outputs}
+   if composite is not None:
+      weights = [c[2] for c in composite]
+      cls0, cls1 = [], []
+      for c in composite:
+         nd = rasterBlocks.nodataValue(c[0])
+         v0 = rasterBlocks.readWindow(c[0], grid, window, nd)
+         cls0.append(rasterBlocks.remapRange(v0, c[1], nd))
+         cls1.append(rasterBlocks.remapRange(patched.get(c[0], v0), c[1], nd))
+      comp0 = networkServiceAreas.compositeScore(cls0, weights)
+      comp1 = networkServiceAreas.compositeScore(cls1, weights)
+      diff = numpy.where((comp0 > 0) & (comp1 > 0), comp1.astype('int8') - comp0.astype('int8'), -128).astype('int8')
+      rasterBlocks.writeBlocks([(window, comp1)], grid, out + '_comp', nodata=0)
+      rasterBlocks.writeBlocks([(window, diff)], grid, out + '_diff', nodata=-128)
+      outputs.update({'comp': out + '_comp', 'diff': out + '_diff'})
+      chg = diff[diff != -128]
+      result['composite'] = {v: int((chg == v).sum()) for v in numpy.unique(chg) if v != 0}
+      print('Composite score changed for ' + str((chg != 0).sum()) + ' cells: ' +
+            ', '.join([('+' if v > 0 else '') + str(v) + ': ' + str(c) for v, c in result['composite'].items()]))
+   print('Finished scenario at ' + Hms() + '.')
+   return result
+
+
+def applyPatch(patch, target):
+   '''
+   Apply a scenario patch to a layer (in place), by mosaicking the patch onto it. Use on a copy of the baseline layer.
+   :param patch: Patch raster (see runScenario)
+   :param target: Layer to patch
+   :return: target
+   '''
+   arcpy.Mosaic_management(patch, target, "LAST")
+   return target
+
+
+##################################################################################################################
+# Use the main function below to run a scenario directly from Python IDE or command line with hard-coded variables
+
+def main():
+   # Outputs and options of the PPA workflow (see networkServiceAreas.main)
+   basedir = r'D:\projects\rec_model\rec_model_processing\serviceAnalyses_NA'
+   projdir = os.path.join(basedir, 'recAnalyses')
+   outGDB = os.path.join(projdir, 'recAnalyses_PPA.gdb')
+   ppa_pt = os.path.join(outGDB, 'access_points_t_lnd_20210428')
+   popRast = r'D:\projects\rec_model\rec_model_processing\input_recmodel.gdb\distribPop_kdens_2019'
+   opts = {'graph': os.path.join(basedir, 'RoadsNet_graph.npz'),
+           'rastTemplate': r'D:\projects\RCL\RCL_processing\RCL_processing.gdb\SnapRaster_albers_wgs84',
+           'roadMask': r'D:\projects\OSM\OSM_RoadsProc.gdb\OSM_Roads_20210422_qtrMileBuff_rast',
+           'VAMask': r'D:\projects\rec_model\rec_model_processing\input_recmodel.gdb\jurisbnd_mask'}
+   layers = [scenarioLayer('teRecPres', 'pressure', os.path.join(outGDB, 'teRecPres_final'),
+                           "accgreen_acres >= 25", 30, os.path.join(outGDB, 'servCat_PPA_25ac_30min_adjust'),
+                           'ppa_group_id', 'accgreen_acres', 100, popRast),
+             scenarioLayer('teProx', 'travel', os.path.join(outGDB, 'teProx_final'), "accgreen_acres >= 5", 105)]
+   composite = [[os.path.join(outGDB, 'teRecPres_final'), [[0, 20, 1], [20, 40, 2], [40, 60, 3], [60, 80, 4],
+                                                            [80, 100, 5]], 70],
+                [os.path.join(outGDB, 'teProx_final'), [[0, 15, 1], [15, 25, 2], [25, 40, 3], [40, 60, 4],
+                                                        [60, 100000, 5]], 5],
+                [os.path.join(outGDB, 'teLocOpts_final'), [[0, 0.5, 5], [0.5, 5, 4], [5, 10, 3], [10, 20, 2],
+                                                           [20, 100000, 1]], 20],
+                [os.path.join(outGDB, 'teRegOpts_final'), [[0, 0.5, 5], [0.5, 5, 4], [5, 10, 3], [10, 20, 2],
+                                                           [20, 100000, 1]], 5]]
+   base = os.path.join(projdir, 'scenarioBase_PPA.npz')
+   if not os.path.exists(base):
+      scenarioBase(opts['graph'], ppa_pt, layers, base, snap_cache=os.path.join(basedir, 'RoadsNet_locations.npz'))
+
+   # New park access points (same fields as ppa_pt)
+   add = r'D:\projects\rec_model\scenarios\scenarios.gdb\newPark_accessPoints'
+   arcpy.env.workspace = r'D:\projects\rec_model\scenarios\scenarios.gdb'
+   runScenario(opts, base, 'newPark', add=add, composite=composite)
+
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,377 @@
+"""
+stageCache
+Created on: 2026-10-17
+Version:  ArcGIS Pro / Python 3.x
+
+Content-hash checkpointing for workflow stages. Re-running a workflow only re-runs the stages whose function,
+parameters, or input datasets have changed, and the stages which depend on them. Includes functions for:
+   - datasetHash, which hashes a dataset
+   - stage, which declares a workflow stage
+   - stageKey, which computes the key (hash) of a stage, from its function's source code (and version), the source
+      code of the project modules (see codeVersion), parameters, input dataset hashes, and the run ids of the stages
+      it depends on
+   - codeVersion, which hashes the source code of the project modules used by stages (code_modules)
+   - runStages, which runs stages (in parallel, if requested), skipping stages which are current
+   - publishOutputs, which copies a stage's outputs to a shared workspace, from the parent process
+   - criticalPath, which finds the chain of dependent stages which limits the workflow's wall time
+
+General usage notes:
+- Feature classes and tables are hashed by content (geometry and all attributes). Rasters and files are hashed by
+their properties (path, dimensions, extent) and modification time, since hashing the content of statewide rasters
+would take longer than most stages.
+- Stage outputs are names relative to the stage's workspace. A stage is re-run if any of its outputs do not exist.
+- The cache file is updated after each stage, so an interrupted workflow resumes at the interrupted stage.
+- Stages running in parallel must be run with isolated scratch workspaces, since functions in this repository use
+fixed temporary dataset names (tmp_*). Stage functions and arguments must be importable/picklable (module-level
+functions, no arcpy objects), since they are sent to worker processes.
+- Stages running in parallel should also write their outputs to their own geodatabase, since concurrent writes to one
+file geodatabase fail on schema locks. Give stages a publish workspace to have their outputs copied to a shared
+geodatabase: copies are made by the parent process, one stage at a time.
+- Parameters listed in ignore_params (e.g. number of parallel processes) do not change results, and are not part of
+stage keys.
+- Functions are keyed by their source code, so editing a stage function re-runs the stage, whether the workflow is run
+as a script or imported. Functions it calls are covered by code_modules: editing any of these modules re-runs all
+stages. Changes to code elsewhere (e.g. helper_arcpy, arcpy) are not detected: give stages a new version for those.
+- Each time a stage is run, it gets a new run id, which is part of the keys of the stages depending on it. So when a
+stage is re-run for any reason (including force, or missing outputs), the stages depending on it are re-run too.
+"""
+
+import arcpy
+import os
+import json
+import hashlib
+import inspect
+import importlib.util
+import uuid
+import shutil
+import time
+import concurrent.futures
+from Helper import Hms
+
+# Parameters which are not part of stage keys
+ignore_params = ['workers']
+
+# Project modules called by stage functions. Their source code is part of all stage keys (see codeVersion).
+code_modules = ['Helper', 'networkGraph', 'rasterBlocks', 'networkServiceAreas', 'stageCache']
+
+# Dataset hashes, by path (datasets are hashed once per session)
+_hashes = {}
+
+# Hash of the source code of code_modules (computed once per session)
+_code = {}
+
+
+def datasetHash(data):
+   '''
+   Hash a dataset. Feature classes and tables are hashed by content, other datasets by properties and modification
+   time (see usage notes).
+   :param data: Dataset or file
+   :return: hash (hexadecimal string)
+   '''
+   if data in _hashes:
+      return _hashes[data]
+   h = hashlib.sha1()
+   if os.path.isfile(data):
+      h.update(json.dumps([os.path.abspath(data), os.path.getsize(data), os.path.getmtime(data)]).encode())
+      _hashes[data] = h.hexdigest()
+      return _hashes[data]
+   d = arcpy.Describe(data)
+   if d.dataType in ['FeatureClass', 'ShapeFile', 'Table']:
+      flds = [f.name for f in arcpy.ListFields(data) if f.type not in ['OID', 'Geometry', 'Raster', 'Blob']]
+      if hasattr(d, 'shapeType'):
+         flds = ['SHAPE@WKB'] + flds
+      h.update(json.dumps(flds).encode())
+      with arcpy.da.SearchCursor(data, flds) as curs:
+         for row in curs:
+            h.update(repr(row).encode())
+   else:
+      path = d.catalogPath
+      gdb = path
+      while gdb and not gdb.lower().endswith('.gdb') and os.path.dirname(gdb) != gdb:
+         gdb = os.path.dirname(gdb)
+      if gdb.lower().endswith('.gdb'):
+         files = [os.path.join(gdb, f) for f in os.listdir(gdb)]
+      elif os.path.isdir(path):
+         files = [os.path.join(path, f) for f in os.listdir(path)] + [path]
+      else:
+         files = [path]
+      ext = d.extent
+      props = [path, d.dataType, [ext.XMin, ext.YMin, ext.XMax, ext.YMax], max([os.path.getmtime(f) for f in files])]
+      if d.dataType in ['RasterDataset', 'RasterBand']:
+         props += [d.meanCellWidth, d.height, d.width]
+      h.update(json.dumps(props).encode())
+   _hashes[data] = h.hexdigest()
+   return _hashes[data]
+
+
+def codeVersion(modules=None):
+   '''
+   Hash the source code of the project modules used by stages, so that editing a function called by a stage function
+   re-runs the stage. Modules are found on the import path, so the hash is the same whether they are run as scripts
+   or imported.
+   :param modules: Module names. Default is code_modules.
+   :return: hash (hexadecimal string)
+   '''
+   if modules is None:
+      modules = code_modules
+   name = ','.join(modules)
+   if name not in _code:
+      h = hashlib.sha1()
+      for m in modules:
+         spec = importlib.util.find_spec(m)
+         if spec is None or spec.origin is None:
+            raise ValueError('Module `' + m + '` (in stageCache.code_modules) not found.')
+         h.update(m.encode())
+         with open(spec.origin, 'rb') as f:
+            h.update(f.read())
+      _code[name] = h.hexdigest()
+   return _code[name]
+
+
+def stage(name, func, args=(), kwargs={}, inputs=[], outputs=[], deps=[], workspace=None, version=None,
+          publish=None):
+   '''
+   Declare a workflow stage.
+   :param name: Stage name (unique)
+   :param func: Function to run. It is called as func(*args, **kwargs).
+   :param args: Positional arguments
+   :param kwargs: Keyword arguments
+   :param inputs: Input datasets (outside of the workflow) used by the stage
+   :param outputs: Outputs of the stage, relative to workspace
+   :param deps: Names of stages this stage depends on (using their outputs)
+   :param workspace: Workspace the stage is run in
+   :param version: Stage version, part of the stage key. Change it to re-run the stage when code outside of func and
+      code_modules changes (changes to these are detected from their source code).
+   :param publish: Workspace (e.g. a shared output geodatabase) the outputs are copied to after the stage finishes
+      (see publishOutputs)
+   :return: stage dictionary
+   '''
+   return {'name': name, 'func': func, 'args': list(args), 'kwargs': dict(kwargs), 'inputs': list(inputs),
+           'outputs': list(outputs), 'deps': list(deps), 'workspace': workspace, 'version': version,
+           'publish': publish}
+
+
+def _jsonParam(a):
+   '''
+   JSON representation of parameters which are not JSON-serializable.
+   '''
+   if isinstance(a, dict) and 'hash' in a:
+      # Road graph
+      return a['hash']
+   if hasattr(a, 'tobytes'):
+      return hashlib.sha1(a.tobytes()).hexdigest()
+   if callable(a):
+      # By source code, so edits change the key, and the key is the same whether the module is run or imported
+      try:
+         return hashlib.sha1(inspect.getsource(a).encode()).hexdigest()
+      except (OSError, TypeError):
+         return getattr(a, '__qualname__', repr(a))
+   return str(a)
+
+
+def _keyParams(a):
+   '''
+   Parameters for stage keys, with parameters in ignore_params removed (including from option dictionaries).
+   '''
+   if isinstance(a, dict):
+      return {k: _keyParams(v) for k, v in a.items() if k not in ignore_params}
+   if isinstance(a, (list, tuple)):
+      return [_keyParams(v) for v in a]
+   return a
+
+
+def stageKey(s, runs):
+   '''
+   Compute the key of a stage.
+   :param s: stage dictionary
+   :param runs: dictionary of run ids of stages already computed, by name. Must include the stage's dependencies.
+   :return: key (hexadecimal string)
+   '''
+   missing = [d for d in s['deps'] if d not in runs]
+   if len(missing) > 0:
+      raise ValueError('Stage `' + s['name'] + '` depends on stages not declared before it: ' + ', '.join(missing))
+   key = {'func': _jsonParam(s['func']), 'version': s.get('version'), 'args': _keyParams(s['args']),
+          'kwargs': _keyParams(s['kwargs']), 'workspace': s['workspace'], 'code': codeVersion(),
+          'inputs': [datasetHash(i) for i in s['inputs']], 'deps': [runs[d] for d in s['deps']]}
+   return hashlib.sha1(json.dumps(key, sort_keys=True, default=_jsonParam).encode()).hexdigest()
+
+
+def loadCache(cache_file):
+   '''
+   Load stage keys and run ids from a cache file.
+   :param cache_file: Cache file (.json)
+   :return: dictionary of {'key', 'run'} dictionaries, by stage name
+   '''
+   if os.path.exists(cache_file):
+      with open(cache_file) as f:
+         return json.load(f)
+   else:
+      return {}
+
+
+def saveCache(cache, cache_file):
+   '''
+   Save stage keys and run ids to a cache file. The file is replaced in one step, so it is not left incomplete.
+   '''
+   with open(cache_file + '.tmp', 'w') as f:
+      json.dump(cache, f, indent=1, sort_keys=True)
+   os.replace(cache_file + '.tmp', cache_file)
+
+
+def isCurrent(s, key, cache):
+   '''
+   Check if a stage is current: its key matches the cache, and its outputs exist.
+   '''
+   if not isinstance(cache.get(s['name']), dict) or cache[s['name']].get('key') != key:
+      return False
+   with arcpy.EnvManager(workspace=s['workspace'] or arcpy.env.workspace):
+      return all(arcpy.Exists(o) for o in s['outputs'])
+
+
+def publishOutputs(s, missing_only=False):
+   '''
+   Copy a stage's outputs to its publish workspace, replacing existing copies. Only called from the parent process,
+   one stage at a time, so stages running in parallel never write to the shared workspace.
+   :param s: stage dictionary
+   :param missing_only: Only copy outputs which have no copy (for stages which are current)
+   '''
+   if s.get('publish') is None:
+      return
+   with arcpy.EnvManager(workspace=s['workspace'] or arcpy.env.workspace):
+      for o in s['outputs']:
+         out = os.path.join(s['publish'], os.path.basename(o))
+         if arcpy.Exists(out):
+            if missing_only:
+               continue
+            arcpy.Delete_management(out)
+         print('Copying `' + os.path.basename(o) + '` to ' + s['publish'] + '...')
+         arcpy.Copy_management(o, out)
+
+
+def _runStage(s, scratch=None, env={}):
+   '''
+   Run a stage. If scratch is given, the stage runs with its own workspace and scratch workspace in the scratch
+   folder, which is removed after the stage finishes. Used in worker processes, so environment settings are passed
+   in env.
+   :return: run time (seconds)
+   '''
+   t0 = time.time()
+   if scratch is None:
+      with arcpy.EnvManager(**env):
+         if s['workspace'] is not None:
+            arcpy.env.workspace = s['workspace']
+         s['func'](*s['args'], **s['kwargs'])
+   else:
+      if os.path.exists(scratch):
+         # Left from an interrupted run
+         shutil.rmtree(scratch)
+      os.makedirs(scratch)
+      gdb = arcpy.CreateFileGDB_management(scratch, 'scratch_work.gdb')[0]
+      with arcpy.EnvManager(workspace=gdb, scratchWorkspace=scratch, **env):
+         s['func'](*s['args'], **s['kwargs'])
+      arcpy.Delete_management(gdb)
+      shutil.rmtree(scratch, ignore_errors=True)
+   return time.time() - t0
+
+
+def criticalPath(stages, times):
+   '''
+   Find the critical path of stages: the chain of dependent stages with the longest total run time, which is the
+   shortest possible wall time with unlimited workers.
+   :param stages: list of stage dictionaries, with dependencies declared before dependents
+   :param times: dictionary of stage run times (seconds), by name
+   :return: tuple of (list of stage names, total run time)
+   '''
+   finish = {}
+   prev = {}
+   for s in stages:
+      prev[s['name']] = max(s['deps'], key=lambda d: finish[d], default=None)
+      finish[s['name']] = times.get(s['name'], 0) + (finish[prev[s['name']]] if prev[s['name']] else 0)
+   last = max(finish, key=finish.get)
+   path = []
+   while last is not None:
+      path.insert(0, last)
+      last = prev[last]
+   return path, finish[path[-1]]
+
+
+def runStages(stages, cache_file, force=[], workers=1, scratch=None, env={}):
+   '''
+   Run workflow stages, skipping stages which are current. A stage is re-run when its function, parameters, or input
+   datasets change, when any of its outputs are missing, or when a stage it depends on is re-run. With workers > 1,
+   stages run in parallel processes as soon as the stages they depend on are finished. Prints a report of stage run
+   times and the critical path.
+   :param stages: list of stage dictionaries (see stage), with dependencies declared before dependents
+   :param cache_file: Cache file (.json) of stage keys
+   :param force: Names of stages to re-run regardless of the cache
+   :param workers: Number of stages run in parallel
+   :param scratch: Folder for isolated stage workspaces (one sub-folder per stage). Required if workers > 1, since
+      stages use the same temporary dataset names. Stage outputs should then be full paths.
+   :param env: Environment settings for stages (e.g. snapRaster, extent), as a dictionary
+   :return: dictionary of stage keys, by stage name
+   '''
+   if workers > 1 and scratch is None:
+      raise ValueError('Stages can only run in parallel with isolated workspaces (scratch).')
+   cache = loadCache(cache_file)
+   # Stages are keyed in order, so a stage to be re-run gives its dependents a new run id (and key) before they are
+   # checked
+   nonce = uuid.uuid4().hex
+   keys, runs, pending = {}, {}, []
+   for s in stages:
+      n = s['name']
+      keys[n] = stageKey(s, runs)
+      if n not in force and isCurrent(s, keys[n], cache):
+         runs[n] = cache[n]['run']
+      else:
+         runs[n] = hashlib.sha1((keys[n] + nonce).encode()).hexdigest()
+         pending.append(s)
+   done = set([s['name'] for s in stages]) - set([s['name'] for s in pending])
+   for s in [s for s in stages if s['name'] in done]:
+      print('Stage `' + s['name'] + '` is current.')
+      publishOutputs(s, missing_only=True)
+   byName = {s['name']: s for s in stages}
+   times = {}
+   t0 = time.time()
+
+   def finished(n, t):
+      times[n] = t
+      done.add(n)
+      cache[n] = {'key': keys[n], 'run': runs[n]}
+      saveCache(cache, cache_file)
+      publishOutputs(byName[n])
+      print('Finished stage `' + n + '` (' + str(round(t / 60, 1)) + ' minutes) at ' + Hms() + '.')
+
+   if workers == 1:
+      for s in pending:
+         print('Running stage `' + s['name'] + '` at ' + Hms() + '...')
+         finished(s['name'], _runStage(s, None if scratch is None else os.path.join(scratch, s['name']), env))
+   else:
+      running = {}
+      error = None
+      with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+         while len(pending) > 0 or len(running) > 0:
+            for s in [s for s in pending if all(d in done for d in s['deps'])]:
+               print('Running stage `' + s['name'] + '` at ' + Hms() + '...')
+               running[pool.submit(_runStage, s, os.path.join(scratch, s['name']), env)] = s['name']
+               pending.remove(s)
+            fin, nf = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in fin:
+               n = running.pop(f)
+               try:
+                  finished(n, f.result())
+               except Exception as e:
+                  # Let running stages finish, but do not start new ones
+                  print('Stage `' + n + '` failed: ' + str(e))
+                  error = error or e
+                  pending = []
+      if error is not None:
+         raise error
+
+   # Report
+   wall = time.time() - t0
+   path, length = criticalPath(stages, times)
+   print('Stage run times (minutes): ' + ', '.join([n + ': ' + str(round(t / 60, 1)) for n, t in times.items()]))
+   print('Wall time: ' + str(round(wall / 60, 1)) + ' minutes; total stage time: ' +
+         str(round(sum(times.values()) / 60, 1)) + ' minutes.')
+   print('Critical path (' + str(round(length / 60, 1)) + ' minutes): ' + ' > '.join(path))
+   return keys
@@ -0,0 +1,41 @@
+"""
+Shared fixtures for tests. Modules are flat files in the repository root. Tests of modules which need arcpy (and
+helper_arcpy) are skipped where those are not available; networkGraph only needs NumPy/SciPy.
+"""
+
+import os
+import sys
+import struct
+import numpy
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def gridGraph(n, seed=0, one_way=0.1):
+   '''
+   Road graph on an n x n grid of nodes (100 m apart, jittered), with random travel times and some one-way segments.
+   '''
+   rng = numpy.random.default_rng(seed)
+   xy = numpy.array([(i * 100., j * 100.) for i in range(n) for j in range(n)]) + rng.uniform(-20, 20, (n * n, 2))
+   a = numpy.arange(n * n).reshape(n, n)
+   u = numpy.concatenate([a[:-1].ravel(), a[:, :-1].ravel()])
+   v = numpy.concatenate([a[1:].ravel(), a[:, 1:].ravel()])
+   tf = rng.uniform(0.2, 1.5, len(u))
+   tb = numpy.where(rng.random(len(u)) < one_way, numpy.inf, tf)
+   return {'xy': xy, 'seg_u': u, 'seg_v': v, 'seg_tf': tf, 'seg_tb': tb, 'seg_loc': numpy.ones(len(u), dtype=bool)}
+
+
+def wkbPolygon(rings):
+   '''
+   WKB (little-endian) of a polygon from closed rings.
+   '''
+   buf = struct.pack('<BII', 1, 3, len(rings))
+   for r in rings:
+      buf += struct.pack('<I', len(r)) + numpy.asarray(r, dtype='<f8').tobytes()
+   return buf
+
+
+@pytest.fixture
+def graph():
+   return gridGraph(20)
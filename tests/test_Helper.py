@@ -0,0 +1,50 @@
+"""
+Tests for Helper's in-memory catchment statistics. Helper imports arcpy and helper_arcpy, so these are skipped where
+they are not available. Raster and table reads are replaced with arrays.
+"""
+
+import types
+import numpy
+import pytest
+
+Helper = pytest.importorskip('Helper')
+from conftest import wkbPolygon
+
+grid = {'xmin': 0., 'ymax': 100., 'cell': 10., 'nrows': 10, 'ncols': 10, 'sr': None}
+
+
+def square(x0, y0, x1, y1):
+   return [numpy.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]], dtype='float64')]
+
+
+def test_secApportion(monkeypatch):
+   # Catchment 1 is columns 0-4, catchment 2 columns 5-9. PPAs 1 and 2 (accessible) overlap in 6 cells; PPA 3 (not
+   # accessible) covers 4 cells of each catchment; PPA 4 has a null ppa_access.
+   rings = [square(10, 60, 40, 90), square(20, 60, 40, 90), square(30, 10, 70, 30), square(60, 60, 90, 90)]
+   polys = {'id': numpy.arange(1, 5, dtype='int32'), 'wkb': [wkbPolygon(r) for r in rings],
+            'box': numpy.array([[(100 - r[0][:, 1].max()) / 10, (100 - r[0][:, 1].min()) / 10, r[0][:, 0].min() / 10,
+                                 r[0][:, 0].max() / 10] for r in rings]),
+            'cell': numpy.array([[2, 2], [2, 3], [8, 5], [2, 7]]), 'area': numpy.array([9., 6, 8, 9])}
+   rasters = {'cat': numpy.repeat([[1] * 5 + [2] * 5], 10, axis=0).astype('int32'), 'imp': numpy.full((10, 10), 20.)}
+   ppa = numpy.array([(1, 1, 0, 900), (2, 1, 0, 600), (3, 0, 10, 800), (4, -1, 50, 900)],
+                     dtype=[('OID', 'i4'), ('ppa_access', 'i4'), ('accgreen_acres', 'f8'), ('Shape_Area', 'f8')])
+   out = {}
+   rb = Helper.rasterBlocks
+   monkeypatch.setattr(rb, 'gridInfo', lambda r: grid)
+   monkeypatch.setattr(rb, 'nodataValue', lambda r: -1 if r == 'cat' else numpy.nan)
+   monkeypatch.setattr(rb, 'readWindow', lambda r, g, w, nd: rasters[r][w[0]:w[1], w[2]:w[3]].copy())
+   monkeypatch.setattr(rb, 'readPolygons', lambda feats, g, where_clause=None: polys)
+   monkeypatch.setattr(rb, 'tile_size', 3)
+   monkeypatch.setattr(Helper.arcpy, 'Describe', lambda d: types.SimpleNamespace(OIDFieldName='OID'))
+   monkeypatch.setattr(Helper.arcpy, 'Exists', lambda d: False)
+   monkeypatch.setattr(Helper.arcpy.env, 'workspace', 'ws')
+   monkeypatch.setattr(Helper.arcpy.da, 'TableToNumPyArray', lambda *a, **k: ppa.copy())
+   monkeypatch.setattr(Helper.arcpy.da, 'NumPyArrayToTable', lambda arr, path: out.update(arr=arr))
+   Helper.secApportion('sec', 'cat', 'grp', 'imp', 'out')
+   arr = out['arr']
+   assert arr['grp'].tolist() == [1, 2]
+   # Overlapping accessible PPAs are counted once: 9 cells of 100 m2
+   acres = 900 / 4046.856
+   assert numpy.allclose(arr['sec_acres'], [acres, 0])
+   assert numpy.allclose(arr['sec_impacc_acres'], [0.2 * acres, 0])
+   assert numpy.allclose(arr['sec_accgreen_acres'], [0.8 * acres + 5, 5])
@@ -0,0 +1,232 @@
+"""
+Tests for networkGraph solvers, against direct (untiled, brute-force) solutions on small random graphs.
+"""
+
+import numpy
+from scipy.sparse import csgraph
+
+import networkGraph
+from conftest import gridGraph
+
+
+def facilities(graph, nf, seed=1):
+   '''
+   Random facility points located on the graph.
+   '''
+   rng = numpy.random.default_rng(seed)
+   xy = rng.uniform(graph['xy'].min(axis=0), graph['xy'].max(axis=0), (nf, 2))
+   return networkGraph.snapToEdges(graph, xy, 500)
+
+
+def test_solveNearestGroups(graph):
+   loc = facilities(graph, 30)
+   matrix, node = networkGraph.sourceMatrix(graph, loc)
+   group = numpy.arange(len(node)) % 12
+   T, F = networkGraph.solveNearestGroups(graph, node, group, k=3, cutoff=6, matrix=matrix)
+   # Brute force: time from every source, then the best time of each group
+   ok = node >= 0
+   d = csgraph.dijkstra(matrix, directed=True, indices=node[ok], limit=6)[:, :len(graph['xy'])]
+   best = numpy.full((12, d.shape[1]), numpy.inf)
+   numpy.minimum.at(best, group[ok], d)
+   expect = numpy.sort(best, axis=0)[:3].T
+   assert numpy.allclose(T, expect, atol=1e-9) and numpy.array_equal(numpy.isinf(T), numpy.isinf(expect))
+   found = F >= 0
+   assert numpy.array_equal(found, numpy.isfinite(expect))
+
+
+def test_queryNearestIndex(graph, tmp_path):
+   loc = facilities(graph, 30)
+   matrix, node = networkGraph.sourceMatrix(graph, loc)
+   group = numpy.arange(len(node)) % 10
+   networkGraph.buildNearestIndex(graph, node, str(tmp_path / 'index'), k=2, cutoff=8, group=group, loc=loc,
+                                  matrix=matrix)
+   index = networkGraph.loadNearestIndex(str(tmp_path / 'index'))
+   keep = numpy.isin(group, [1, 2, 5]) & (numpy.arange(len(node)) != 15)
+   minutes, facility, unresolved = networkGraph.queryNearestIndex(index, keep, graph=graph)
+   expect, src = networkGraph.solveNearest(graph, node[keep], 8, matrix=matrix)
+   assert numpy.allclose(minutes, expect, atol=1e-4) and numpy.array_equal(numpy.isinf(minutes), numpy.isinf(expect))
+   assert numpy.array_equal(facility >= 0, src >= 0)
+   assert keep[facility[facility >= 0]].all()
+
+
+def test_snapToEdges(graph):
+   rng = numpy.random.default_rng(3)
+   xy = rng.uniform(-100, 2000, (500, 2))
+   loc = networkGraph.snapToEdges(graph, xy, 60)
+   # Brute force: distance to every segment where facilities can be located
+   a, b = graph['xy'][graph['seg_u']], graph['xy'][graph['seg_v']]
+   ab, ap = b - a, xy[:, None] - a
+   frac = numpy.clip((ap * ab).sum(axis=2) / (ab ** 2).sum(axis=1), 0, 1)
+   dist = numpy.hypot(*(ap - frac[..., None] * ab).transpose(2, 0, 1))
+   best = dist.min(axis=1)
+   assert numpy.array_equal(loc['seg'] >= 0, best <= 60)
+   ok = loc['seg'] >= 0
+   assert numpy.allclose(loc['dist'][ok], best[ok])
+
+
+def test_snapToEdges_long_segment():
+   # A point 10 m from the end of a 2 km highway, with 16 short stubs about 140 m away: the stubs have nearer midpoints
+   xy = numpy.array([[0., 0], [2000, 0]] + [[1900 + 5 * i, 150] for i in range(16)] +
+                    [[1900 + 5 * i, 152] for i in range(16)])
+   graph = {'xy': xy, 'seg_u': numpy.r_[0, numpy.arange(2, 18)], 'seg_v': numpy.r_[1, numpy.arange(18, 34)],
+            'seg_tf': numpy.ones(17), 'seg_tb': numpy.ones(17), 'seg_loc': numpy.ones(17, dtype=bool)}
+   loc = networkGraph.snapToEdges(graph, [[1990, 10]], 500)
+   assert loc['seg'].tolist() == [0] and numpy.allclose(loc['dist'], 10) and numpy.allclose(loc['frac'], 0.995)
+
+
+def test_coalesceLocations(graph):
+   u, v = graph['seg_u'][0], graph['seg_v'][0]
+   length = numpy.hypot(*(graph['xy'][v] - graph['xy'][u]))
+   # Facilities 0-1 are at u, 2-3 are 2 m apart mid-segment, 4 is in another group, 5 is not located
+   loc = {'seg': numpy.array([0, 0, 0, 0, 0, -1]),
+          'frac': numpy.array([0, 1 / length, 0.5, 0.5 + 2 / length, 0.5, 0])}
+   group = numpy.array([0, 0, 0, 0, 1, 0])
+   assert networkGraph.coalesceLocations(graph, loc, group).tolist() == [0, 1, 2, 3, 4, -1]
+   assert networkGraph.coalesceLocations(graph, loc, group, tolerance=3).tolist() == [0, 0, 2, 2, 4, -1]
+   assert networkGraph.coalesceLocations(graph, loc, None, tolerance="3 Meters").tolist() == [0, 0, 2, 2, 2, -1]
+
+
+def test_coalesceLocations_node():
+   # Facilities at the shared end node of two segments are coalesced
+   graph = gridGraph(3)
+   a, b = numpy.flatnonzero(graph['seg_v'] == 4)[:2]
+   loc = {'seg': numpy.array([a, b]), 'frac': numpy.array([1.0, 1.0])}
+   assert networkGraph.coalesceLocations(graph, loc).tolist() == [0, 0]
+
+
+def test_coalesceLocations_chain():
+   # Facilities 40 m apart along a 1 km segment: each source takes only the facilities within 50 m of its first one
+   graph = {'xy': numpy.array([[0., 0], [1000, 0]]), 'seg_u': numpy.array([0]), 'seg_v': numpy.array([1]),
+            'seg_tf': numpy.ones(1), 'seg_tb': numpy.ones(1), 'seg_loc': numpy.ones(1, dtype=bool)}
+   pos = 100 + 40 * numpy.arange(13)
+   loc = {'seg': numpy.zeros(13, dtype='int64'), 'frac': pos / 1000}
+   rep = networkGraph.coalesceLocations(graph, loc, tolerance="50 Meters")
+   assert rep.tolist() == [0, 0, 2, 2, 4, 4, 6, 6, 8, 8, 10, 10, 12]
+   assert (pos - pos[rep]).max() <= 50
+
+
+def test_solveTiled(graph):
+   loc = facilities(graph, 30)
+   matrix, node = networkGraph.sourceMatrix(graph, loc)
+   group = numpy.arange(len(node)) % 5
+   m1, s1, c1 = networkGraph.solveTiled(graph, matrix, node, 4, group, workers=1)
+   m2, s2, c2 = networkGraph.solveTiled(graph, matrix, node, 4, group, tile_size=600, workers=2)
+   assert numpy.allclose(m1, m2, atol=1e-9) and numpy.array_equal(numpy.isinf(m1), numpy.isinf(m2))
+   assert numpy.array_equal(s1, s2)
+   assert numpy.array_equal(c1, c2)
+
+
+def test_solveTiled_long_segment():
+   # A facility 20 m from node 1 on a 2 km segment from node 0, whose other end is outside node 1's tile and halo
+   xy = numpy.array([[-2000., 0]] + [[100. * i, 0] for i in range(31)])
+   tm = numpy.r_[2, numpy.full(30, 0.1)]
+   graph = {'xy': xy, 'seg_u': numpy.arange(31), 'seg_v': numpy.arange(1, 32), 'seg_tf': tm, 'seg_tb': tm,
+            'seg_loc': numpy.ones(31, dtype=bool)}
+   loc = {'seg': numpy.array([0]), 'frac': numpy.array([0.99])}
+   matrix, node = networkGraph.sourceMatrix(graph, loc)
+   m1, s1, c1 = networkGraph.solveTiled(graph, matrix, node, 1, workers=1)
+   m2, s2, c2 = networkGraph.solveTiled(graph, matrix, node, 1, tile_size=1000, workers=2)
+   assert numpy.isfinite(m1[1:10]).all()
+   assert numpy.allclose(m1, m2) and numpy.array_equal(s1, s2)
+
+
+def test_floatingCatchment():
+   from scipy import sparse
+   # Hard catchments: accessibility is the catchment's supply per person
+   times = sparse.csr_matrix(numpy.array([[5., 0], [5, 0], [0, 5]]))
+   access, ratio = networkGraph.floatingCatchment(times, [2, 3], [10, 30, 6], decay=[[30, 1]])
+   assert numpy.allclose(ratio, [2 / 40, 3 / 6])
+   assert numpy.allclose(access, [2 / 40, 2 / 40, 3 / 6])
+
+
+def test_floatingCatchment_decay():
+   from scipy import sparse
+   rng = numpy.random.default_rng(4)
+   dense = numpy.where(rng.random((50, 8)) < 0.4, rng.uniform(0.1, 30, (50, 8)), 0)
+   supply, demand = rng.uniform(1, 10, 8), rng.uniform(0, 100, 50)
+   access, ratio = networkGraph.floatingCatchment(sparse.csr_matrix(dense), supply, demand)
+   w = numpy.where(dense > 0, networkGraph.decayWeights(dense), 0)
+   expect = supply / (w.T @ demand)
+   assert numpy.allclose(ratio, expect)
+   assert numpy.allclose(access, w @ expect)
+   assert networkGraph.decayWeights([0.5, 10, 10.01, 20, 30, 30.5]).tolist() == [1, 1, 0.68, 0.68, 0.22, 0]
+
+
+def test_updateNearest(graph):
+   loc = facilities(graph, 40)
+   matrix, node = networkGraph.sourceMatrix(graph, loc)
+   node = node[node >= 0]
+   rng = numpy.random.default_rng(2)
+   use = rng.random(len(node)) < 0.5
+   for cutoff in [numpy.inf, 3]:
+      minutes, src = networkGraph.solveNearest(graph, node[use], cutoff, matrix=matrix)
+      remove, add = node[use][:5], node[~use][:5]
+      minutes, src, changed = networkGraph.updateNearest(graph, matrix, minutes, src, remove, add, cutoff, node[use])
+      keep = numpy.setdiff1d(numpy.union1d(node[use], add), remove)
+      m2, s2 = networkGraph.solveNearest(graph, keep, cutoff, matrix=matrix)
+      assert numpy.allclose(minutes, m2, atol=1e-9) and numpy.array_equal(numpy.isinf(minutes), numpy.isinf(m2))
+      # Random travel times have no ties, so sources match too
+      assert numpy.array_equal(src, s2)
+
+
+def test_updateNearest_unused_sources(graph):
+   # Facility nodes in the matrix which are not sources (e.g. of other layers) are not used when re-solving
+   loc = facilities(graph, 20)
+   matrix, node = networkGraph.sourceMatrix(graph, loc)
+   node = node[node >= 0]
+   minutes, src = networkGraph.solveNearest(graph, node[:10], matrix=matrix)
+   minutes, src, changed = networkGraph.updateNearest(graph, matrix, minutes, src, node[:3], sources=node[:10])
+   assert numpy.isin(src[src >= 0], node[3:10]).all()
+   assert numpy.allclose(minutes, networkGraph.solveNearest(graph, node[3:10], matrix=matrix)[0])
+
+
+def test_nodeLabels(graph):
+   loc = facilities(graph, 30)
+   matrix, node = networkGraph.sourceMatrix(graph, loc)
+   group = numpy.arange(len(node)) % 7
+   minutes, src = networkGraph.solveNearest(graph, node, 5, matrix=matrix)
+   lab = networkGraph.nodeLabels(src, node, group)
+   # Brute force: group of the nearest facility (by the best time of each group)
+   ok = node >= 0
+   d = csgraph.dijkstra(matrix, directed=True, indices=node[ok], limit=5)[:, :len(graph['xy'])]
+   best = numpy.full((7, d.shape[1]), numpy.inf)
+   numpy.minimum.at(best, group[ok], d)
+   expect = numpy.where(numpy.isfinite(best.min(axis=0)), best.argmin(axis=0), -1)
+   assert numpy.array_equal(lab, expect)
+
+
+def test_nodeLabels_shared_node():
+   # Facilities from different groups on the same node take the lowest group
+   src = numpy.array([4, 4, -1, 9, 9])
+   lab = networkGraph.nodeLabels(src, [9, 4, 4, -1], [2, 5, 3, 0], nodata=-9)
+   assert lab.tolist() == [3, 3, -9, 2, 2]
+
+
+def test_buildODMatrix(graph, tmp_path):
+   loc = facilities(graph, 20)
+   matrix, node = networkGraph.sourceMatrix(graph, loc)
+   rng = numpy.random.default_rng(2)
+   pts = networkGraph.snapToEdges(graph, rng.uniform(graph['xy'].min(axis=0), graph['xy'].max(axis=0), (300, 2)),
+                                  500, locate=False)
+   networkGraph.buildODMatrix(graph, pts, node, str(tmp_path / 'od'), 6, matrix=matrix, batch_size=3, chunk=500)
+   od = networkGraph.loadODMatrix(str(tmp_path / 'od'))
+   # Brute force: time through either end of each point's segment, from every facility
+   ok = node >= 0
+   d = csgraph.dijkstra(matrix, directed=True, indices=node[ok], limit=6)
+   seg, frac = pts['seg'], pts['frac']
+   t = numpy.minimum(d[:, graph['seg_u'][seg]] + frac * graph['seg_tb'][seg],
+                     d[:, graph['seg_v'][seg]] + (1 - frac) * graph['seg_tf'][seg])
+   expect = numpy.full((len(node), len(seg)), numpy.inf)
+   expect[ok] = numpy.where(t <= 6, t, numpy.inf)
+   dense = numpy.full(od['matrix'].shape, numpy.inf)
+   coo = od['matrix'].tocoo()
+   dense[coo.row, coo.col] = coo.data
+   assert numpy.allclose(dense, expect.T, atol=1e-4) and numpy.array_equal(numpy.isinf(dense), numpy.isinf(expect.T))
+   # Nearest of a subset of facilities
+   keep = numpy.arange(len(node)) % 3 != 0
+   minutes, facility = networkGraph.odNearest(od, keep, chunk=70)
+   sub = numpy.where(keep[:, None], expect, numpy.inf)
+   assert numpy.allclose(minutes, sub.min(axis=0), atol=1e-4)
+   found = numpy.isfinite(minutes)
+   assert numpy.array_equal(facility >= 0, found) and keep[facility[found]].all()
+   assert numpy.allclose(expect[facility[found], numpy.flatnonzero(found)], minutes[found], atol=1e-4)
@@ -0,0 +1,18 @@
+"""
+Tests for networkServiceAreas score compositing. networkServiceAreas imports arcpy and helper_arcpy, so these are
+skipped where they are not available.
+"""
+
+import numpy
+import pytest
+
+networkServiceAreas = pytest.importorskip('networkServiceAreas')
+
+
+def test_compositeScore():
+   cls = [numpy.array([1, 1, 9, 3, 0]), numpy.array([2, 1, 9, 4, 5])]
+   out = networkServiceAreas.compositeScore(cls, [50, 50])
+   # 1.5 and 3.5 round up; NoData (0) in any class is NoData
+   assert out.dtype == numpy.uint8 and out.tolist() == [2, 1, 9, 4, 0]
+   out = networkServiceAreas.compositeScore(cls, [25, 75])
+   assert out.tolist() == [2, 1, 9, 4, 0]
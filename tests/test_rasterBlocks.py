@@ -0,0 +1,131 @@
+"""
+Tests for the NumPy parts of rasterBlocks. rasterBlocks imports arcpy, so these are skipped where it is not available.
+"""
+
+import numpy
+import pytest
+
+rasterBlocks = pytest.importorskip('rasterBlocks')
+from conftest import wkbPolygon
+
+grid = {'xmin': 0., 'ymax': 100., 'cell': 10., 'nrows': 10, 'ncols': 10}
+
+
+def test_remapRange():
+   arr = numpy.array([[0, 0.5, 1, 1.5], [2, 3, 9, numpy.nan]])
+   out = rasterBlocks.remapRange(arr, [[1, 2, 2], [0, 1, 1]], out_nodata=255, missing="NODATA")
+   # Upper bounds are inclusive, lower bounds only for the lowest range
+   assert out.tolist() == [[1, 1, 1, 2], [2, 255, 255, 255]]
+   # Values outside of all ranges keep their value by default, as in Reclassify
+   out = rasterBlocks.remapRange(arr, [[1, 2, 2], [0, 1, 1]], out_nodata=255)
+   assert out.tolist() == [[1, 1, 1, 2], [2, 3, 9, 255]]
+   out = rasterBlocks.remapRange(numpy.array([-1, 5, 10, 12.7, 1e6]), [[0, 10, 7]], nodata=-1, dtype='int16')
+   assert out.dtype == numpy.int16 and out.tolist() == [0, 7, 7, 12, 32767]
+   with pytest.raises(ValueError):
+      rasterBlocks.remapRange(arr, [[0, 1, 1]], missing="IGNORE")
+
+def insideRings(rings, x, y):
+   '''
+   Even-odd point in polygon test.
+   '''
+   inside = numpy.zeros(x.shape, dtype=bool)
+   for r in rings:
+      for (x0, y0), (x1, y1) in zip(r[:-1], r[1:]):
+         cross = (y0 > y) != (y1 > y)
+         xc = x0 + (y - y0) * (x1 - x0) / numpy.where(y1 != y0, y1 - y0, 1)
+         inside ^= cross & (x < xc)
+   return inside
+
+@pytest.mark.parametrize('k', [1, 4])
+def test_polygonCells(k):
+   rings = [numpy.array([[-5., 30], [62, 107], [81, 12], [-5, 30]]),
+            numpy.array([[30., 40], [50, 40], [50, 60], [30, 60], [30, 40]])]
+   row, col, count = rasterBlocks.polygonCells(rings, grid, k)
+   got = numpy.zeros((grid['nrows'], grid['ncols']), dtype=int)
+   got[row, col] = count
+   # Brute force: sub-cell centers inside the polygon
+   s = (numpy.arange(grid['nrows'] * k) + 0.5) * grid['cell'] / k
+   x, y = numpy.meshgrid(grid['xmin'] + s, grid['ymax'] - s)
+   sub = insideRings(rings, x, y)
+   expect = sub.reshape(grid['nrows'], k, grid['ncols'], k).sum(axis=(1, 3))
+   assert numpy.array_equal(got, expect)
+   assert (count > 0).all()
+
+def test_polygonCells_outside():
+   row, col, count = rasterBlocks.polygonCells([numpy.array([[200., 0], [300, 0], [300, -50], [200, 0]])], grid, 4)
+   assert len(row) == len(col) == len(count) == 0
+
+def test_windowCoverage():
+   # A triangle, a thin polygon between sub-cell centers, and a polygon smaller than a sub-cell
+   rings = [[numpy.array([[-5.3, 30.7], [62.1, 107], [81.2, 12.9], [-5.3, 30.7]])],
+            [numpy.array([[12., 19], [58, 19], [58, 19.5], [12, 19.5], [12, 19]])],
+            [numpy.array([[71.3, 71.3], [71.8, 71.3], [71.8, 71.8], [71.3, 71.3]])]]
+   box = numpy.array([[(100 - r[0][:, 1].max()) / 10, (100 - r[0][:, 1].min()) / 10, r[0][:, 0].min() / 10,
+                       r[0][:, 0].max() / 10] for r in rings])
+   polys = {'id': numpy.array([1, 2, 3], dtype='int32'), 'wkb': [wkbPolygon(r) for r in rings], 'box': box,
+            'cell': numpy.array([[4, 4], [8, 3], [2, 7]]), 'area': numpy.array([39.0, 0.23, 0.00125])}
+   wgrid = dict(grid, sr=None)
+
+   def dense(windows):
+      out = numpy.zeros((4, grid['nrows'], grid['ncols']))
+      for w in windows:
+         cover = rasterBlocks.windowCoverage(polys, wgrid, w)
+         numpy.add.at(out, (cover['id'], cover['row'], cover['col']), cover['frac'])
+      return out
+
+   full = dense([(0, 10, 0, 10)])
+   # Coverage does not depend on the window size
+   assert numpy.allclose(dense(rasterBlocks.iterWindows(wgrid, 3)), full)
+   assert numpy.isclose(full[1].sum(), 39.0, rtol=0.05)
+   # Polygons covering no sub-cell center are kept in the cell holding their centroid
+   assert numpy.flatnonzero(full[2]).tolist() == [83] and numpy.isclose(full[2, 8, 3], 0.23)
+   assert numpy.flatnonzero(full[3]).tolist() == [27] and numpy.isclose(full[3, 2, 7], 0.00125)
+
+
+def bruteAllocation(arr, nodata):
+   '''
+   Value of the nearest cell with a value, the first in row-major order where several are equally near.
+   '''
+   sr, sc = numpy.nonzero(arr != nodata)
+   r, c = numpy.indices(arr.shape)
+   d2 = (r[..., None] - sr) ** 2 + (c[..., None] - sc) ** 2
+   best = d2.argmin(axis=-1)
+   return arr[sr[best], sc[best]]
+
+def test_allocateArray_ties():
+   arr = numpy.full((5, 5), -1)
+   arr[0, 0], arr[0, 4], arr[4, 0], arr[4, 4] = 1, 2, 3, 4
+   out, resolved = rasterBlocks.allocateArray(arr, -1)
+   assert resolved.all()
+   assert out.tolist() == [[1, 1, 1, 2, 2], [1, 1, 1, 2, 2], [1, 1, 1, 2, 2], [3, 3, 3, 4, 4], [3, 3, 3, 4, 4]]
+
+@pytest.mark.parametrize('seed', range(3))
+def test_allocateArray_windows(seed):
+   rng = numpy.random.default_rng(seed)
+   arr = numpy.where(rng.random((60, 70)) < 0.02, rng.integers(1, 50, (60, 70)), 0)
+   expect = bruteAllocation(arr, 0)
+   out, resolved = rasterBlocks.allocateArray(arr, 0)
+   assert numpy.array_equal(out, expect)
+   # A window allocated from an expanded window is the same where it is resolved within the halo
+   core = (slice(10, 30), slice(25, 45))
+   out, resolved = rasterBlocks.allocateArray(arr[5:35, 20:50], 0, (slice(5, 25), slice(5, 25)), 5)
+   assert resolved.any()
+   assert numpy.array_equal(out[resolved], expect[core][resolved])
+
+def test_eucAllocation_reference(tmp_path):
+   # Compared with arcpy.sa.EucAllocation itself, so this runs only where Spatial Analyst is available
+   import arcpy
+   if arcpy.CheckExtension('Spatial') != 'Available':
+      pytest.skip('Spatial Analyst is not available')
+   arcpy.CheckOutExtension('Spatial')
+   arcpy.env.overwriteOutput = True
+   # Sources on a lattice, so that many cells are equidistant to two or four sources
+   arr = numpy.full((40, 50), -1, dtype='int32')
+   arr[::8, ::8] = numpy.arange(1, arr[::8, ::8].size + 1).reshape(arr[::8, ::8].shape)
+   arr[20, 21] = 99
+   src = str(tmp_path / 'src.tif')
+   arcpy.NumPyArrayToRaster(arr, arcpy.Point(0, 0), 10, 10, -1).save(src)
+   expect = arcpy.RasterToNumPyArray(arcpy.sa.EucAllocation(src))
+   out = str(tmp_path / 'alloc.tif')
+   rasterBlocks.eucAllocation(src, src, out, size=16, halo=4, workers=2)
+   assert numpy.array_equal(arcpy.RasterToNumPyArray(out), expect)
@@ -0,0 +1,26 @@
+"""
+Tests for stage keys. stageCache imports arcpy (and Helper), so these are skipped where they are not available.
+"""
+
+import pytest
+
+stageCache = pytest.importorskip('stageCache')
+
+
+def work(a):
+   return a
+
+
+def test_stageKey_code(tmp_path, monkeypatch):
+   # Editing a module called by a stage function changes the stage's key
+   mod = tmp_path / 'stagemod.py'
+   mod.write_text('def f():\n   return 1\n')
+   monkeypatch.syspath_prepend(str(tmp_path))
+   monkeypatch.setattr(stageCache, 'code_modules', ['stagemod'])
+   monkeypatch.setattr(stageCache, '_code', {})
+   s = stageCache.stage('a', work, args=[1], kwargs={'workers': 4})
+   k0 = stageCache.stageKey(s, {})
+   assert stageCache.stageKey(stageCache.stage('a', work, args=[1], kwargs={'workers': 2}), {}) == k0
+   mod.write_text('def f():\n   return 2\n')
+   monkeypatch.setattr(stageCache, '_code', {})
+   assert stageCache.stageKey(s, {}) != k0